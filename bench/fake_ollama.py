@@ -0,0 +1,120 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from aiohttp import web
+
+WORDS = ("the list comprehension returns a new list from an iterable and each element is "
+         "computed by the expression while the optional condition filters items so that "
+         "only matching values are kept in the result see the tutorial for more examples").split()
+
+
+class FakeOllama:
+    """
+    Stand-in for Ollama's /api/generate that streams tokens like a real
+    model: the first token after ttft seconds (plus prompt processing at
+    prompt_rate tokens/s), then tokens_per_s tokens per second. At most
+    parallel requests generate at once, the rest queue like on a GPU.
+    The final chunk carries prompt_eval_count, eval_count and durations
+    in nanoseconds.
+    """
+
+    def __init__(self, tokens_per_s=40.0, ttft=0.3, answer_tokens=200, prompt_rate=2000.0,
+                 parallel=4, jitter=0.2):
+        self.tokens_per_s = tokens_per_s
+        self.ttft = ttft
+        self.answer_tokens = answer_tokens
+        self.prompt_rate = prompt_rate
+        self.jitter = jitter
+        self.slots = asyncio.Semaphore(parallel)
+        self.requests = 0
+        self.active = 0
+        self.app = web.Application()
+        self.app.router.add_post('/api/generate', self.generate)
+        self.app.router.add_get('/api/tags', self.tags)
+        self.app.router.add_get('/api/ps', self.tags)
+        self.app.router.add_get('/', self.root)
+
+    def vary(self, value):
+        return value * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def root(self, request):
+        return web.Response(text='Ollama is running')
+
+    async def tags(self, request):
+        return web.json_response({'models': [{'name': 'llama3.2:latest', 'model': 'llama3.2:latest'}]})
+
+    async def generate(self, request):
+        body = await request.json()
+        self.requests += 1
+        prompt = body.get('prompt', '')
+        if not prompt:
+            # Warm-up request: loads the model, generates nothing
+            return web.json_response({'model': body.get('model'), 'response': '', 'done': True})
+
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        async with self.slots:
+            self.active += 1
+            try:
+                prompt_tokens = max(1, len(prompt) // 4)
+                prompt_seconds = prompt_tokens / self.prompt_rate
+                started = time.perf_counter()
+                await asyncio.sleep(self.vary(self.ttft) + prompt_seconds)
+                eval_started = time.perf_counter()
+                count = max(1, int(self.vary(self.answer_tokens)))
+                for i in range(count):
+                    chunk = {'model': body.get('model'), 'response': random.choice(WORDS) + ' ', 'done': False}
+                    await response.write((json.dumps(chunk) + '\n').encode())
+                    await asyncio.sleep(1 / self.tokens_per_s)
+                eval_seconds = time.perf_counter() - eval_started
+                await response.write((json.dumps({
+                    'model': body.get('model'),
+                    'response': '',
+                    'done': True,
+                    'total_duration': int((time.perf_counter() - started) * 1e9),
+                    'prompt_eval_count': prompt_tokens,
+                    'prompt_eval_duration': int(prompt_seconds * 1e9),
+                    'eval_count': count,
+                    'eval_duration': int(eval_seconds * 1e9)
+                }) + '\n').encode())
+            finally:
+                self.active -= 1
+        await response.write_eof()
+        return response
+
+    async def start(self, host='127.0.0.1', port=11434):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def add_arguments(parser):
+    parser.add_argument('--ollama-tokens-per-s', type=float, default=40.0, help="generation speed")
+    parser.add_argument('--ollama-ttft', type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument('--ollama-answer-tokens', type=int, default=200)
+    parser.add_argument('--ollama-parallel', type=int, default=4, help="requests generated at once")
+
+
+def from_arguments(args):
+    return FakeOllama(args.ollama_tokens_per_s, args.ollama_ttft, args.ollama_answer_tokens,
+                      parallel=args.ollama_parallel)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Ollama server")
+    parser.add_argument('--port', type=int, default=11434)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    async def serve():
+        server = from_arguments(args)
+        await server.start('0.0.0.0', args.port)
+        print(f"Fake Ollama listening on :{args.port}")
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
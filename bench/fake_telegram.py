@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import json
+import math
+import sys
+import time
+from collections import defaultdict
+from aiohttp import web
+
+
+class FloodLimit:
+    """
+    Token bucket like Telegram's flood control: returns 0 when a request
+    is allowed, otherwise the whole seconds to wait
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return max(1, math.ceil((1 - self.tokens) / self.rate))
+
+
+class FakeTelegram:
+    """
+    Local stand-in for the Bot API: enough of getMe, getUpdates,
+    deleteWebhook, sendMessage and editMessageText for the bot to run,
+    with global and per-chat flood limits answered by 429 retry_after.
+
+    Every accepted message is recorded in messages[chat_id], with its time
+    in sent_at[chat_id]. inject() adds an incoming user message that the
+    bot receives through getUpdates.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, latency=0.0):
+        self.global_limit = FloodLimit(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_limits = {}
+        self.latency = latency
+        self.messages = defaultdict(list)
+        self.sent_at = defaultdict(list)
+        self.next_message_id = 1
+        self.rejected = 0
+        self.updates = []
+        self.new_updates = asyncio.Event()
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+
+    def inject(self, chat_id, text, user_id=None):
+        """
+        Queues a message from a user for the bot
+        """
+        message = self.message(chat_id, text)
+        message['from'] = {'id': user_id or chat_id, 'is_bot': False, 'first_name': f'User {chat_id}'}
+        self.updates.append({'update_id': len(self.updates) + 1, 'message': message})
+        self.new_updates.set()
+
+    async def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        deadline = time.monotonic() + min(float(params.get('timeout') or 0), 10)
+        while True:
+            # update_id is the position in self.updates plus one
+            pending = self.updates[max(offset - 1, 0):][:int(params.get('limit') or 100)]
+            remaining = deadline - time.monotonic()
+            if pending or remaining <= 0:
+                return pending
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def limited(self, chat_id):
+        limit = self.chat_limits.get(chat_id)
+        if limit is None:
+            limit = self.chat_limits[chat_id] = FloodLimit(self.chat_rate, self.chat_burst)
+        return limit.take() or self.global_limit.take()
+
+    def message(self, chat_id, text, message_id=None):
+        if message_id is None:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': text
+        }
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = dict(await request.post())
+        if not params and request.can_read_body:
+            params = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == 'getMe':
+            return ok({'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'})
+        if method == 'getUpdates':
+            return ok(await self.get_updates(params))
+        if method in ('deleteWebhook', 'close'):
+            return ok(True)
+        if method not in ('sendMessage', 'editMessageText'):
+            return error(400, f"Bad Request: method {method} is not supported by the fake server")
+
+        chat_id = int(params['chat_id'])
+        text = params.get('text', '')
+        if len(text) > 4096:
+            return error(400, "Bad Request: message is too long")
+        retry_after = self.limited(chat_id)
+        if retry_after:
+            self.rejected += 1
+            return error(429, f"Too Many Requests: retry after {retry_after}", {'retry_after': retry_after})
+
+        if method == 'sendMessage':
+            self.messages[chat_id].append(text)
+            self.sent_at[chat_id].append(time.monotonic())
+            return ok(self.message(chat_id, text))
+        return ok(self.message(chat_id, text, int(params['message_id'])))
+
+    async def start(self, host='127.0.0.1', port=8081):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def ok(result):
+    return web.json_response({'ok': True, 'result': result})
+
+
+def error(code, description, parameters=None):
+    body = {'ok': False, 'error_code': code, 'description': description}
+    if parameters:
+        body['parameters'] = parameters
+    return web.json_response(body, status=code)
+
+
+async def self_test(port, chats, length):
+    """
+    Sends a long answer to each of chats chats through an Outbox, once at
+    the default rates and once overdriven past the server's limits, and
+    checks every answer arrives complete and in order
+    """
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from outbox import Outbox
+
+    text = ' '.join(f"Sentence {i} of a long answer." for i in range(length // 30))
+    for name, outbox in (('default', Outbox()),
+                         ('overdriven', Outbox(global_rate=60, chat_rate=5, chat_burst=5))):
+        server = FakeTelegram()
+        await server.start(port=port)
+        bot = Bot('123:fake', session=AiohttpSession(api=TelegramAPIServer.from_base(f'http://127.0.0.1:{port}')))
+        try:
+            started = time.monotonic()
+            await asyncio.gather(*(outbox.send_text(bot, chat_id, text) for chat_id in range(1, chats + 1)))
+            elapsed = time.monotonic() - started
+        finally:
+            await bot.session.close()
+            await server.stop()
+
+        assert len(server.messages) == chats
+        for chat_id, parts in server.messages.items():
+            assert ''.join(parts) == text, f"chat {chat_id} got a garbled answer"
+            assert all(len(part) <= 4096 for part in parts)
+        print(f"{name}: {sum(map(len, server.messages.values()))} messages to {chats} chats "
+              f"in {elapsed:.1f}s, {server.rejected} rejected with 429")
+        print(json.dumps(outbox.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--global-rate', type=float, default=30)
+    parser.add_argument('--chat-rate', type=float, default=1)
+    parser.add_argument('--test', action='store_true', help="run the outbox self-test and exit")
+    parser.add_argument('--chats', type=int, default=40)
+    parser.add_argument('--length', type=int, default=9000, help="answer length in the self-test")
+    args = parser.parse_args()
+
+    if args.test:
+        asyncio.run(self_test(args.port, args.chats, args.length))
+        sys.exit(0)
+
+    async def serve():
+        server = FakeTelegram(args.global_rate, args.chat_rate)
+        await server.start('0.0.0.0', args.port)
+        print(f"Fake Bot API listening on :{args.port}")
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
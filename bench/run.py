@@ -0,0 +1,367 @@
+"""
+Load test of the whole system on one machine: Redis, the gateway, N workers
+and the bot run as local processes, with bench.fake_ollama in place of
+Ollama and bench.fake_telegram in place of Telegram. Questions are injected
+as Telegram messages at a target rate and timed until the bot's answer
+arrives at the fake Bot API.
+
+Retrieval is real, so the embedding model and the collection (or the NumPy
+index with RETRIEVAL_BACKEND=numpy) must be available as for a worker.
+
+    python -m bench.run --workers 1,2 --concurrency 4,8 --rate 2 --duration 60
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+import httpx
+import redis
+from bench.fake_ollama import add_arguments as add_ollama_arguments, from_arguments as fake_ollama
+from bench.fake_telegram import FakeTelegram
+from rag.trace_report import load_traces, stage_times
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_PATH = os.path.join(ROOT, 'bench', 'results', 'history.jsonl')
+REJECTED_PREFIX = "Too many questions right now"
+
+TOPICS = ["list comprehensions", "decorators", "context managers", "generators", "asyncio tasks",
+          "the with statement", "f-strings", "dataclasses", "type hints", "exceptions",
+          "reading a file", "sorting a dictionary", "the itertools module", "virtual environments",
+          "the logging module", "pathlib", "json parsing", "regular expressions", "threading",
+          "subprocess", "unittest", "argparse", "collections.Counter", "the walrus operator"]
+TEMPLATES = ["How do I use {}?", "What is the difference between {} and {}?", "Explain {} in Python",
+             "Can you show an example of {}?", "When should I use {}?"]
+
+
+def synthetic_questions(count, repeat_ratio, seed=0):
+    """
+    count questions from the templates; repeat_ratio of them repeat an
+    earlier question, to exercise the answer cache and coalescing
+    """
+    rng = random.Random(seed)
+    questions = []
+    for _ in range(count):
+        if questions and rng.random() < repeat_ratio:
+            questions.append(rng.choice(questions))
+            continue
+        template = rng.choice(TEMPLATES)
+        questions.append(template.format(*rng.sample(TOPICS, template.count('{}'))))
+    return questions
+
+
+def load_questions(path):
+    """
+    One question per line, or JSONL with a "text" or "question" field
+    """
+    questions = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                record = json.loads(line)
+                line = record.get('text') or record.get('question')
+            questions.append(line)
+    return questions
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    if len(values) == 1:
+        return {'p50': values[0], 'p95': values[0], 'p99': values[0]}
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return {'p50': cuts[49], 'p95': cuts[94], 'p99': cuts[98]}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class System:
+    """
+    Starts and stops the processes of one benchmark configuration
+    """
+
+    def __init__(self, args, workers, concurrency, trace_dir):
+        self.args = args
+        self.workers = workers
+        self.concurrency = concurrency
+        self.trace_dir = trace_dir
+        self.processes = []
+        self.redis_url = args.redis_url
+        self.gateway_port = free_port()
+
+    def env(self, **extra):
+        env = dict(os.environ)
+        env.update({
+            'REDIS_URL': self.redis_url,
+            'OLLAMA_URLS': ','.join(f'http://127.0.0.1:{port}' for port in self.args.ollama_ports),
+            'GATEWAY_URL': f'http://127.0.0.1:{self.gateway_port}',
+            'TELEGRAM_API_URL': f'http://127.0.0.1:{self.args.telegram_port}',
+            'BOT_TOKEN': '123456:bench',
+            'STREAM_ANSWERS': '0',
+            'TRACE_EXPORTER': 'jsonl',
+            'TRACE_DIR': self.trace_dir,
+            'WORKER_METRICS_PORT': '0',
+            'BOT_METRICS_PORT': '0',
+            'PYTHONUNBUFFERED': '1'
+        })
+        if self.args.no_cache:
+            env['ANSWER_CACHE_ENABLED'] = '0'
+        env.update(extra)
+        return env
+
+    def spawn(self, name, command, **env):
+        log = open(os.path.join(self.trace_dir, f'{name}.log'), 'w')
+        process = subprocess.Popen(command, cwd=ROOT, env=self.env(**env), stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append((name, process, log))
+        return process
+
+    async def start(self):
+        if self.redis_url is None:
+            if shutil.which('redis-server') is None:
+                raise SystemExit("redis-server not found; install it or pass --redis-url")
+            port = free_port()
+            self.redis_url = f'redis://127.0.0.1:{port}'
+            self.spawn('redis', ['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'])
+            await self.wait_for(lambda: redis.Redis.from_url(self.redis_url).ping(), 'Redis')
+        else:
+            # Each run starts from an empty database
+            redis.Redis.from_url(self.redis_url).flushdb()
+
+        self.spawn('gateway', [sys.executable, '-m', 'uvicorn', 'gateway:app',
+                               '--host', '127.0.0.1', '--port', str(self.gateway_port), '--log-level', 'warning'],
+                   READY_MIN_WORKERS=str(self.workers))
+        for index in range(self.workers):
+            self.spawn(f'worker-{index}', [sys.executable, 'worker.py', f'worker-bench-{index}'],
+                       WORKER_CONCURRENCY=str(self.concurrency))
+
+        async with httpx.AsyncClient() as client:
+            async def ready():
+                response = await client.get(f'http://127.0.0.1:{self.gateway_port}/ready')
+                return response.status_code == 200
+            await self.wait_for(ready, 'warm workers', timeout=self.args.startup_timeout)
+        self.spawn('bot', [sys.executable, 'bot.py'])
+
+    async def wait_for(self, check, what, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for name, process, _ in self.processes:
+                if process.poll() is not None:
+                    raise RuntimeError(f"{name} exited with {process.returncode}, see {self.trace_dir}/{name}.log")
+            try:
+                result = check()
+                if asyncio.iscoroutine(result):
+                    result = await result
+                if result:
+                    return
+            except Exception:
+                pass
+            await asyncio.sleep(0.5)
+        raise RuntimeError(f"Timed out waiting for {what}")
+
+    def stop(self):
+        # Bot and workers first, so nothing is left writing to Redis
+        for name, process, log in reversed(self.processes):
+            if process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            log.close()
+
+
+async def run_load(telegram, questions, rate, timeout):
+    """
+    Injects one question per chat at Poisson arrivals of rate per second and
+    waits for the answers
+
+    Returns:
+        Dictionary of chat_id -> (sent monotonic time, question)
+    """
+    sent = {}
+    for chat_id, question in enumerate(questions, start=1):
+        sent[chat_id] = (time.monotonic(), question)
+        telegram.inject(chat_id, question)
+        await asyncio.sleep(random.expovariate(rate))
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and any(chat_id not in telegram.sent_at for chat_id in sent):
+        await asyncio.sleep(0.2)
+    return sent
+
+
+def summarize(sent, telegram, trace_dir, started):
+    latencies = []
+    finished = []
+    rejected = 0
+    for chat_id, (sent_at, _) in sent.items():
+        if chat_id not in telegram.sent_at:
+            continue
+        if telegram.messages[chat_id][0].startswith(REJECTED_PREFIX):
+            rejected += 1
+            continue
+        # An answer split over several messages is complete with the last one
+        done = telegram.sent_at[chat_id][-1]
+        latencies.append(done - sent_at)
+        finished.append(done)
+
+    traces = load_traces(trace_dir)
+    queue_waits = [s['duration'] for spans in traces.values() for s in spans if s['name'] == 'worker.queue_wait']
+    stages = {}
+    for spans in traces.values():
+        for name, seconds in stage_times(spans).items():
+            stages.setdefault(name, []).append(seconds)
+
+    elapsed = (max(finished) - started) if finished else 0.0
+    return {
+        'questions': len(sent),
+        'answered': len(latencies),
+        'rejected': rejected,
+        'unanswered': len(sent) - len(latencies) - rejected,
+        'answers_per_s': len(latencies) / elapsed if elapsed else 0.0,
+        'latency_s': percentiles(latencies),
+        'queue_wait_s': percentiles(queue_waits),
+        'stage_mean_s': {name: statistics.fmean(values) for name, values in sorted(stages.items())},
+        'telegram_429': telegram.rejected
+    }
+
+
+async def run_config(args, questions, workers, concurrency):
+    trace_dir = os.path.join(args.work_dir, f'w{workers}-c{concurrency}')
+    shutil.rmtree(trace_dir, ignore_errors=True)
+    os.makedirs(trace_dir)
+
+    ollamas = [fake_ollama(args) for _ in args.ollama_ports]
+    telegram = FakeTelegram(args.telegram_global_rate)
+    for ollama, port in zip(ollamas, args.ollama_ports):
+        await ollama.start(port=port)
+    await telegram.start(port=args.telegram_port)
+    system = System(args, workers, concurrency, trace_dir)
+    try:
+        await system.start()
+        # Lets the bot start polling before the first question
+        await asyncio.sleep(2)
+        started = time.monotonic()
+        sent = await run_load(telegram, questions, args.rate, args.timeout)
+    finally:
+        system.stop()
+        await telegram.stop()
+        for ollama in ollamas:
+            await ollama.stop()
+    return summarize(sent, telegram, trace_dir, started)
+
+
+def print_result(result, previous):
+    latency, wait = result['latency_s'], result['queue_wait_s']
+    line = (f"workers={result['workers']} concurrency={result['concurrency']}: "
+            f"{result['answered']}/{result['questions']} answered, {result['rejected']} rejected, "
+            f"{result['answers_per_s']:.2f} answers/s, latency p50/p95/p99 = "
+            f"{fmt(latency['p50'])}/{fmt(latency['p95'])}/{fmt(latency['p99'])}s, "
+            f"queue wait p50/p95/p99 = {fmt(wait['p50'])}/{fmt(wait['p95'])}/{fmt(wait['p99'])}s")
+    print(line)
+    if previous is not None and previous['latency_s']['p95'] and latency['p95']:
+        change = latency['p95'] / previous['latency_s']['p95'] - 1
+        print(f"  vs {previous['commit']} ({previous['timestamp']}): p95 {change:+.0%}, "
+              f"answers/s {previous['answers_per_s']:.2f} -> {result['answers_per_s']:.2f}")
+
+
+def fmt(value):
+    return '-' if value is None else f'{value:.2f}'
+
+
+def previous_result(result):
+    """
+    Latest saved result with the same settings, for comparison
+    """
+    if not os.path.exists(RESULTS_PATH):
+        return None
+    keys = ('workers', 'concurrency', 'rate', 'questions', 'settings')
+    latest = None
+    with open(RESULTS_PATH, encoding='utf-8') as f:
+        for line in f:
+            saved = json.loads(line)
+            if all(saved.get(key) == result.get(key) for key in keys):
+                latest = saved
+    return latest
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load test with a fake Ollama and a fake Telegram")
+    parser.add_argument('--workers', default='1', help="comma-separated worker process counts")
+    parser.add_argument('--concurrency', default='4', help="comma-separated WORKER_CONCURRENCY values")
+    parser.add_argument('--rate', type=float, default=1.0, help="questions per second")
+    parser.add_argument('--duration', type=float, default=60, help="seconds of load")
+    parser.add_argument('--questions', help="file with recorded questions (text or JSONL)")
+    parser.add_argument('--repeat-ratio', type=float, default=0.1,
+                        help="share of synthetic questions repeating an earlier one")
+    parser.add_argument('--no-cache', action='store_true', help="disable the answer cache")
+    parser.add_argument('--timeout', type=float, default=300, help="seconds to wait for answers after the load")
+    parser.add_argument('--startup-timeout', type=float, default=300)
+    parser.add_argument('--redis-url', help="existing Redis to use (flushed!) instead of starting redis-server")
+    parser.add_argument('--telegram-global-rate', type=float, default=30)
+    parser.add_argument('--work-dir', default=os.path.join(ROOT, 'bench', 'runs'))
+    parser.add_argument('--no-save', action='store_true', help=f"do not append to {RESULTS_PATH}")
+    parser.add_argument('--ollama-backends', type=int, default=1, help="fake Ollama servers behind OLLAMA_URLS")
+    add_ollama_arguments(parser)
+    args = parser.parse_args()
+    args.ollama_ports = [free_port() for _ in range(args.ollama_backends)]
+    args.telegram_port = free_port()
+
+    count = max(1, int(args.rate * args.duration))
+    if args.questions:
+        recorded = load_questions(args.questions)
+        questions = [recorded[i % len(recorded)] for i in range(count)]
+    else:
+        questions = synthetic_questions(count, args.repeat_ratio)
+
+    settings = {
+        'ollama_tokens_per_s': args.ollama_tokens_per_s,
+        'ollama_ttft': args.ollama_ttft,
+        'ollama_answer_tokens': args.ollama_answer_tokens,
+        'ollama_parallel': args.ollama_parallel,
+        'ollama_backends': args.ollama_backends,
+        'cache': not args.no_cache,
+        'question_set': args.questions or f'synthetic:{args.repeat_ratio}'
+    }
+    for workers in map(int, args.workers.split(',')):
+        for concurrency in map(int, args.concurrency.split(',')):
+            result = {
+                'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'commit': git_commit(),
+                'workers': workers,
+                'concurrency': concurrency,
+                'rate': args.rate,
+                'settings': settings
+            }
+            result.update(await run_config(args, questions, workers, concurrency))
+            print_result(result, previous_result(result))
+            if not args.no_save:
+                os.makedirs(os.path.dirname(RESULTS_PATH), exist_ok=True)
+                with open(RESULTS_PATH, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(result) + '\n')
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -5,13 +5,51 @@ from aiogram import Bot, Dispatcher, html
 from aiogram.filters import CommandStart
 from aiogram.types import Message
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 import redis.asyncio as aioredis
-import json
+import os
+import socket
+import time
 import httpx
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+from rag.results import results_streams, read_result, RESULTS_GROUP, FAILED_ANSWER
+from rag.storage import unpack_text, trim_acked_entries, TASK_RESULT_TTL
+from outbox import Outbox, split_message, OUTBOX_MAX_PENDING
+from rag import metrics, tracing
 
 TOKEN = getenv("BOT_TOKEN")
 REDIS_URL = getenv("REDIS_URL", "redis://redis:6379")
 GATEWAY_URL = getenv("GATEWAY_URL", "http://gateway:8000")
+STREAM_ANSWERS = getenv("STREAM_ANSWERS", "1") == "1"
+# Telegram allows roughly one edit per second in a chat
+STREAM_EDIT_INTERVAL = float(getenv("STREAM_EDIT_INTERVAL", "1.5"))
+STREAM_TIMEOUT = float(getenv("STREAM_TIMEOUT", "300"))
+# Bot API server, e.g. a local fake one for testing (bench/fake_telegram.py)
+TELEGRAM_API_URL = getenv("TELEGRAM_API_URL")
+# Stable per replica (e.g. BOT_ID=bot-1) so a restarted bot replays its own pending results
+CONSUMER_NAME = getenv("BOT_ID", f"bot-{socket.gethostname()}-{os.getpid()}")
+RESULT_CLAIM_IDLE_MS = int(getenv("RESULT_CLAIM_IDLE_MS", "60000"))
+# Telegram serves getUpdates to one consumer per token, so with several
+# replicas only one polls (or use a webhook); the others deliver results
+POLL_UPDATES = getenv("BOT_POLL_UPDATES", "1") == "1"
+# Seconds a streamed result waits for its stream to show up before it is
+# sent as a message instead (the gateway can answer from the cache before
+# the handler has registered the stream)
+STREAM_HANDOFF_S = float(getenv("STREAM_HANDOFF_S", "10"))
+
+stream_redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+results_redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+# Shared by all handlers, opened in main()
+gateway_client = None
+# Every message and edit the bot sends goes through the outbox
+outbox = Outbox()
+# Results read from the stream whose delivery has not finished yet
+deliveries = set()
+delivering = set()
+delivery_slots = asyncio.Semaphore(OUTBOX_MAX_PENDING)
+# Tasks whose answer a handler of this replica is streaming
+streaming = set()
 
 dp = Dispatcher()
 
@@ -21,42 +59,259 @@ async def start_message_handler(message: Message):
 
 @dp.message()
 async def rag_answer(message: Message):
+    """
+    Starts the message's trace; its context goes to the gateway in the
+    traceparent header and comes back with the result
+    """
     url = f'{GATEWAY_URL}/tasks'
     load = {
         'user_id': message.from_user.id,
         'chat_id': message.chat.id,
-        'text': message.text
+        'text': message.text,
+        'stream': STREAM_ANSWERS
     }
-    async with httpx.AsyncClient() as client:
-        await client.post(url, json=load)
+    with tracing.span('bot.message', chat_id=message.chat.id, stream=STREAM_ANSWERS) as trace:
+        try:
+            with tracing.span('bot.submit'):
+                response = await gateway_client.post(url, json=load, headers={tracing.TRACEPARENT: trace.traceparent})
+        except httpx.HTTPError as e:
+            logging.error(f"Could not submit the question to the gateway: {e!r}")
+            trace.set(status='error')
+            await reply(message, FAILED_ANSWER)
+            return
+        trace.set(status=response.status_code)
+        if response.status_code in (429, 503):
+            retry_after = response.headers.get('Retry-After', '30')
+            busy = "Too many questions" if response.status_code == 429 else "The service is busy"
+            await reply(message, f"{busy} right now, please try again in {retry_after} seconds.")
+            return
+        if response.is_error:
+            logging.error(f"Gateway rejected the question with {response.status_code}: {response.text[:200]}")
+            await reply(message, FAILED_ANSWER)
+            return
+        task_id = response.json()['task_id']
+        trace.set(task_id=task_id)
+        if STREAM_ANSWERS:
+            # Until the stream ends, whichever replica reads the result leaves it to this handler
+            streaming.add(task_id)
+            shown = False
+            try:
+                await results_redis.set(f'task:{task_id}:streamer', CONSUMER_NAME, ex=int(STREAM_TIMEOUT) + 60)
+                placeholder = await outbox.submit(message.chat.id, lambda: message.answer("…", parse_mode=None))
+                with tracing.span('bot.stream'):
+                    shown = await stream_answer(placeholder, task_id)
+            finally:
+                try:
+                    await end_stream(task_id, shown)
+                finally:
+                    streaming.discard(task_id)
+
+async def reply(message: Message, text: str):
+    await outbox.submit(message.chat.id, lambda: message.answer(text, parse_mode=None))
+
+async def end_stream(task_id: str, shown: bool):
+    """
+    Unregisters the stream of task_id; shown marks that it edited in the
+    final answer, so the result is acked without being sent again
+    """
+    async with results_redis.pipeline(transaction=False) as pipe:
+        if shown:
+            pipe.set(f'task:{task_id}:streamed', 1, ex=TASK_RESULT_TTL)
+        pipe.delete(f'task:{task_id}:streamer')
+        await pipe.execute()
+
+async def edit_answer(placeholder: Message, text: str):
+    """
+    Returns True if the message was edited
+    """
+    try:
+        await outbox.submit(placeholder.chat.id, lambda: placeholder.edit_text(text, parse_mode=None))
+        return True
+    except Exception as e:
+        logging.warning(f"Could not edit streamed message: {e}")
+        return False
+
+async def stream_answer(placeholder: Message, task_id: str):
+    """
+    Follows the task's token stream and edits the placeholder message as the
+    answer is generated, no more often than STREAM_EDIT_INTERVAL. Returns
+    True if the complete answer was shown.
+    """
+    key = f'task:{task_id}:tokens'
+    last_id = '0'
+    text = ''
+    shown = ''
+    last_edit = 0.0
+    deadline = time.monotonic() + STREAM_TIMEOUT
+
+    while time.monotonic() < deadline:
+        entries = await stream_redis.xread({key: last_id}, block=int(STREAM_EDIT_INTERVAL * 1000))
+        for _, items in entries or []:
+            for entry_id, fields in items:
+                last_id = entry_id
+                if fields['type'] == 'token':
+                    text += fields['text']
+                    continue
+                final = unpack_text(fields, 'text') if fields['type'] == 'done' else FAILED_ANSWER
+                first, *rest = split_message(final)
+                if not await edit_answer(placeholder, first):
+                    return False
+                # Whatever does not fit into the edited message follows as new messages
+                for part in rest:
+                    await outbox.submit(placeholder.chat.id,
+                                        lambda part=part: placeholder.answer(part, parse_mode=None))
+                return True
+
+        if text != shown and time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+            # Only the first message is edited while streaming
+            await edit_answer(placeholder, split_message(text + " …")[0])
+            shown = text
+            last_edit = time.monotonic()
+
+    logging.warning(f"Stream for task {task_id} timed out")
+    return False
+
+async def shown_by_stream(stream: str, entry_id: str, task_id: str):
+    """
+    Waits while a handler streams the answer of task_id into its chat, and
+    keeps the result from being claimed by another replica meanwhile.
+
+    Returns:
+        True if the stream showed the final answer, False if no stream is
+        showing it (it timed out or failed, or the bot restarted)
+    """
+    last_refresh = time.monotonic()
+    while True:
+        streamed, streamer = await results_redis.mget(f'task:{task_id}:streamed', f'task:{task_id}:streamer')
+        if streamed:
+            return True
+        # A registration left behind by this replica before a restart is stale
+        stale = streamer == CONSUMER_NAME and task_id not in streaming
+        if (not streamer or stale) and metrics.entry_age(entry_id) >= STREAM_HANDOFF_S:
+            return False
+        if time.monotonic() - last_refresh >= RESULT_CLAIM_IDLE_MS / 3000:
+            last_refresh = time.monotonic()
+            await results_redis.xclaim(stream, RESULTS_GROUP, CONSUMER_NAME, 0, [entry_id], justid=True)
+        await asyncio.sleep(STREAM_EDIT_INTERVAL)
+
+async def deliver(bot: Bot, stream: str, entry_id: str, fields: dict):
+    """
+    Sends a result to its chat; returns True if it was sent here. A streamed
+    result is only sent when its stream did not show the answer.
+    """
+    result = read_result(fields)
+    if result['stream'] and await shown_by_stream(stream, entry_id, result['task_id']):
+        return False
+    try:
+        await outbox.send_text(bot, result['chat_id'], result['result'])
+        return True
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        # Retrying cannot succeed (bot blocked, chat gone), so the result is dropped
+        logging.warning(f"Dropping result {result['task_id']}: {e}")
+        return False
+
+async def deliver_and_ack(bot: Bot, stream: str, entry_id: str, fields: dict):
+    try:
+        with tracing.span('bot.deliver', parent=fields.get(tracing.TRACEPARENT), task_id=fields.get('task_id')):
+            if await deliver(bot, stream, entry_id, fields):
+                metrics.DELIVERY_SECONDS.observe(metrics.entry_age(entry_id))
+        # Acked only after a successful send; otherwise the entry stays
+        # pending and is retried on replay or by whichever replica claims it
+        await results_redis.xack(stream, RESULTS_GROUP, entry_id)
+    except Exception as e:
+        logging.warning(f"Could not deliver result {entry_id}: {e}")
+    finally:
+        delivering.discard(entry_id)
+        delivery_slots.release()
+
+async def handle_results(bot: Bot, entries):
+    """
+    Starts delivering each entry in the background, so a chat waiting out
+    a flood limit does not hold up the others. Blocks once OUTBOX_MAX_PENDING
+    deliveries are in flight.
+    """
+    for stream, items in entries or []:
+        for entry_id, fields in items:
+            if entry_id in delivering:
+                # Replayed from the pending list while still being sent
+                continue
+            await delivery_slots.acquire()
+            delivering.add(entry_id)
+            task = asyncio.create_task(deliver_and_ack(bot, stream, entry_id, fields))
+            deliveries.add(task)
+            task.add_done_callback(deliveries.discard)
 
 async def listen(bot: Bot):
+    """
+    Reads results from the results stream(s) as part of the bots consumer
+    group, so each result goes to exactly one bot replica. Entries left
+    pending by this consumer are replayed on start, and entries idle for
+    RESULT_CLAIM_IDLE_MS in other (crashed) consumers are claimed.
+    """
+    streams = results_streams()
+    for stream in streams:
+        try:
+            await results_redis.xgroup_create(stream, RESULTS_GROUP, id="0", mkstream=True)
+        except aioredis.ResponseError:
+            pass
+
+    # Position in this consumer's pending list while replaying, None otherwise
+    replay = {stream: '0' for stream in streams}
+    last_claim = 0.0
+    last_gauges = 0.0
     while True:
         try:
-            redis = aioredis.from_url(REDIS_URL, decode_responses=True)
-            pubsub = redis.pubsub()
-            await pubsub.subscribe('results')
-
-            logging.info("Connected to Redis and subscribed to 'results' channel")
-
-            async for message in pubsub.listen():
-                if message['type'] == 'message':
-                    data = json.loads(message['data'])
-                    user_id = data['user_id']
-                    result = data['result']
-                    await bot.send_message(user_id, result, parse_mode=None)
+            if time.monotonic() - last_gauges >= 5:
+                last_gauges = time.monotonic()
+                await metrics.update_stream_gauges(results_redis, [(stream, RESULTS_GROUP) for stream in streams])
+            if replay:
+                entries = await results_redis.xreadgroup(RESULTS_GROUP, CONSUMER_NAME, replay, count=100)
+                for stream, items in entries or []:
+                    if items:
+                        replay[stream] = items[-1][0]
+                if not any(items for _, items in entries or []):
+                    replay = None
+            else:
+                entries = await results_redis.xreadgroup(RESULTS_GROUP, CONSUMER_NAME,
+                                                         {stream: '>' for stream in streams},
+                                                         count=100, block=5000)
+            await handle_results(bot, entries)
+
+            if time.monotonic() - last_claim >= RESULT_CLAIM_IDLE_MS / 1000:
+                last_claim = time.monotonic()
+                for stream in streams:
+                    _, claimed, _ = await results_redis.xautoclaim(
+                        stream, RESULTS_GROUP, CONSUMER_NAME, RESULT_CLAIM_IDLE_MS, count=100)
+                    await handle_results(bot, [(stream, claimed)])
+                    await trim_acked_entries(results_redis, stream, RESULTS_GROUP)
         except Exception as e:
-            logging.exception(f"Redis error: {e}")
+            logging.exception(f"Result delivery error: {e}")
+            # Entries read but not sent are replayed from the pending list
+            replay = {stream: '0' for stream in streams}
             await asyncio.sleep(5)
 
 
 async def main():
-    bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+    global gateway_client
+    gateway_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(connect=3.0, read=10.0, write=5.0, pool=5.0),
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60)
+    )
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+    bot = Bot(token=TOKEN, session=session, default=DefaultBotProperties(parse_mode="HTML"))
+    metrics.serve_metrics(metrics.BOT_METRICS_PORT)
+    tracing.configure('bot')
     task = asyncio.create_task(listen(bot))
     try:
-        await dp.start_polling(bot)
+        if POLL_UPDATES:
+            await dp.start_polling(bot)
+        else:
+            await task
     finally:
         task.cancel()
+        await gateway_client.aclose()
+        await stream_redis.aclose()
+        await results_redis.aclose()
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -1,13 +1,60 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Header
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 from pydantic import BaseModel
 import uuid
-import redis.asyncio as aioredis
+import json
+import time
+import asyncio
+import redis
+from contextlib import asynccontextmanager
 from os import getenv
-
-app = FastAPI()
+from rag.rag import init_embedding_function
+from rag.cache import AnswerCache, CACHE_ENABLED
+from rag.redis_stats import connect, count_round_trips, RoundTripStats
+from rag.results import add_result, CompletionNotifier, results_streams, RESULTS_GROUP
+from rag.storage import pack_text, unpack_fields, TASK_RESULT_TTL, TASKS_STREAM_MAXLEN
+from rag.scheduling import FairQueue, RateLimiter, AdmissionControl, FAIR_QUEUE_ENABLED, FAIR_PREFIX
+from rag import metrics, tracing
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
 REDIS_URL = getenv("REDIS_URL", "redis://redis:6379")
-task_queue = aioredis.from_url(REDIS_URL, decode_responses=True)
+TOKEN_STREAM_TTL = int(getenv("TOKEN_STREAM_TTL", "3600"))
+READY_TTL = float(getenv("READY_TTL", "15"))
+READY_MIN_WORKERS = int(getenv("READY_MIN_WORKERS", "1"))
+TASK_WAIT_MAX_S = float(getenv("TASK_WAIT_MAX_S", "60"))
+SSE_MAX_S = float(getenv("SSE_MAX_S", "900"))
+task_queue = connect(REDIS_URL)
+round_trip_stats = RoundTripStats('gateway')
+answer_cache = None
+fair_queue = FairQueue(task_queue) if FAIR_QUEUE_ENABLED else None
+rate_limiter = RateLimiter(task_queue)
+admission = AdmissionControl(task_queue, ready_ttl=READY_TTL)
+notifier = CompletionNotifier(task_queue)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global answer_cache
+    tracing.configure('gateway')
+    if CACHE_ENABLED:
+        # The cache embeds questions, so the model is loaded at startup
+        # rather than on the first request
+        embed = await asyncio.to_thread(init_embedding_function)
+        answer_cache = AnswerCache(task_queue, embed)
+    try:
+        # The fair queue dispatches against the group's lag, so the group has
+        # to exist before the first task, even when no worker has started
+        await task_queue.xgroup_create("tasks", "workers", id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+    background = [asyncio.create_task(admission.run()), asyncio.create_task(notifier.run())]
+    yield
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    await task_queue.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 class Task(BaseModel):
     """
@@ -18,39 +65,289 @@ class Task(BaseModel):
     user_id: int
     chat_id: int
     text: str
+    stream: bool = False
+    # Trace context for tasks in a batch; POST /tasks reads the header
+    traceparent: str | None = None
+
+class TaskBatch(BaseModel):
+    tasks: list[Task]
+
+def task_entry(task_id: str, task: Task):
+    entry = {
+        'task_id': task_id,
+        'user_id': task.user_id,
+        'chat_id': task.chat_id,
+        'text': task.text,
+        'stream': int(task.stream),
+        # Lets the worker measure the wait including the per-user queue
+        'queued_at': f'{time.time():.3f}'
+    }
+    traceparent = tracing.current_traceparent()
+    if traceparent:
+        entry[tracing.TRACEPARENT] = traceparent
+    return entry
+
+def add_cached(pipe, task_id: str, task: Task, cached: str):
+    """
+    Adds the writes that complete a task answered from the cache to pipe
+    """
+    pipe.hset(f"task:{task_id}", mapping={
+        'status': 'complete',
+        'chat_id': task.chat_id,
+        **pack_text('result', cached)
+    })
+    pipe.expire(f"task:{task_id}", TASK_RESULT_TTL)
+    pipe.xadd(f"task:{task_id}:tokens", {'type': 'done', **pack_text('text', cached)})
+    pipe.expire(f"task:{task_id}:tokens", TOKEN_STREAM_TTL)
+    add_result(pipe, {
+        'task_id': task_id,
+        'user_id': task.user_id,
+        'chat_id': task.chat_id,
+        'stream': task.stream,
+        tracing.TRACEPARENT: tracing.current_traceparent()
+    }, cached)
+
+async def add_queued(client, task_id: str, task: Task):
+    """
+    Writes the queued status and enqueues the task. client is a pipeline,
+    or the Redis client itself for a single task on the fair queue, whose
+    script does both writes in one call.
+    """
+    status = {'status': 'queued', 'chat_id': task.chat_id, 'result': ''}
+    if fair_queue is not None:
+        await fair_queue.enqueue(task.user_id, task_entry(task_id, task), status, client=client)
+    else:
+        client.hset(f"task:{task_id}", mapping=status)
+        client.xadd("tasks", task_entry(task_id, task), maxlen=TASKS_STREAM_MAXLEN or None, approximate=True)
+
+async def lookup_cached(texts: list):
+    if answer_cache is None:
+        return [None] * len(texts)
+    try:
+        with tracing.span('gateway.cache_lookup', queries=len(texts)):
+            embeddings = await answer_cache.embed_queries(texts)
+            return await answer_cache.lookup_many(texts, embeddings)
+    except Exception as e:
+        print(f'Answer cache lookup failed: {e}')
+        return [None] * len(texts)
+
+def too_many_requests(error: str, retry_after: int):
+    return JSONResponse({"error": error, "retry_after": retry_after},
+                        status_code=429, headers={"Retry-After": str(retry_after)})
 
 @app.post("/tasks")
-async def create_task(task: Task):
+async def create_task(task: Task, traceparent: str | None = Header(default=None)):
     """
     Puts user message into queue 
     Args:
         Object of task class which confirms structure of added data
 
     Returns:
-        Dictionary with task identifier and status of task
+        Dictionary with task identifier and status of task, or status 429
+        with Retry-After when the user's rate limit or the queue is full
     """
+    with tracing.span('gateway.create_task', parent=traceparent or task.traceparent) as request_span:
+        response = await submit_task(task)
+        if isinstance(response, dict):
+            request_span.set(task_id=response['task_id'], status=response['status'])
+        else:
+            request_span.set(status=response.status_code)
+        return response
+
+async def submit_task(task: Task):
+    round_trips = count_round_trips()
+    retry_after = await rate_limiter.retry_after(task.user_id)
+    if retry_after:
+        metrics.TASKS_SUBMITTED.labels('rate_limited').inc()
+        return too_many_requests("Rate limit exceeded", retry_after)
+
     task_id = str(uuid.uuid4())
-    new_task = {
-        'task_id': task_id,
-        'user_id': task.user_id,
-        'chat_id': task.chat_id,
-        'text': task.text
-    }
-    await task_queue.xadd("tasks", new_task)
-    await task_queue.hset(f"task:{task_id}", mapping={
-        'status': 'queued', 
-        'chat_id': task.chat_id, 
-        'result': ''
-    })
+    cached = (await lookup_cached([task.text]))[0]
+    if cached is not None:
+        # Cache hit: finish the task here without going through a worker
+        async with task_queue.pipeline(transaction=False) as pipe:
+            add_cached(pipe, task_id, task, cached)
+            await pipe.execute()
+        round_trip_stats.add(round_trips)
+        metrics.TASKS_SUBMITTED.labels('cached').inc()
+        print(f'Task {task_id} was answered from cache')
+        return {'task_id': task_id, 'status': 'complete'}
+
+    retry_after = admission.check()
+    if retry_after:
+        metrics.TASKS_SUBMITTED.labels('rejected').inc()
+        return too_many_requests("Too many tasks queued", retry_after)
+
+    if fair_queue is not None:
+        await add_queued(task_queue, task_id, task)
+    else:
+        async with task_queue.pipeline(transaction=False) as pipe:
+            await add_queued(pipe, task_id, task)
+            await pipe.execute()
+    round_trip_stats.add(round_trips)
+    metrics.TASKS_SUBMITTED.labels('queued').inc()
     print(f'Task {task_id} was added to queue')
     return {'task_id': task_id, 'status': 'queued'}
 
+@app.post("/tasks/batch")
+async def create_tasks(batch: TaskBatch):
+    """
+    Puts many messages into the queue with one embedding call for the cache
+    lookups and one pipeline for all writes. Meant for internal integrations
+    and traffic replay, so per-user rate limits do not apply; admission
+    control does.
+
+    Returns:
+        List with a task identifier and status per task, in request order.
+        Tasks rejected by admission control have status "rejected" and a
+        retry_after.
+    """
+    round_trips = count_round_trips()
+    results = []
+    cached_answers = await lookup_cached([task.text for task in batch.tasks])
+
+    async with task_queue.pipeline(transaction=False) as pipe:
+        for task, cached in zip(batch.tasks, cached_answers):
+            task_id = str(uuid.uuid4())
+            with tracing.span('gateway.create_task', parent=task.traceparent, task_id=task_id, batch=True) as task_span:
+                if cached is not None:
+                    add_cached(pipe, task_id, task, cached)
+                    results.append({'task_id': task_id, 'status': 'complete'})
+                else:
+                    retry_after = admission.check()
+                    if retry_after:
+                        results.append({'task_id': None, 'status': 'rejected', 'retry_after': retry_after})
+                    else:
+                        await add_queued(pipe, task_id, task)
+                        results.append({'task_id': task_id, 'status': 'queued'})
+                task_span.set(status=results[-1]['status'])
+        await pipe.execute()
+
+    for result in results:
+        metrics.TASKS_SUBMITTED.labels(result['status'].replace('complete', 'cached')).inc()
+    accepted = sum(1 for result in results if result['task_id'])
+    if accepted:
+        round_trip_stats.add(round_trips, accepted)
+    print(f'Batch of {len(batch.tasks)} tasks: {accepted} accepted')
+    return results
+
 @app.get("/tasks/{id}")
-async def get_task_status(id: str):
+async def get_task_status(id: str, wait: float = 0):
+    """
+    Returns the task's status and result. With wait=<seconds> (at most
+    TASK_WAIT_MAX_S), the request is held open until the task completes or
+    fails, woken by the worker's completion notification.
+    """
+    with notifier.watch(id) as done:
+        task_hash = await task_queue.hgetall(f"task:{id}")
+        if task_hash and wait > 0 and task_hash.get('status') not in ('complete', 'failed'):
+            try:
+                await asyncio.wait_for(done, min(wait, TASK_WAIT_MAX_S))
+                task_hash = await task_queue.hgetall(f"task:{id}")
+            except asyncio.TimeoutError:
+                pass
+    if not task_hash:
+        return {"error": "Task not found"}
+    return unpack_fields(task_hash, 'result')
+
+def sse_event(event_type: str, text: str) -> str:
+    return f"event: {event_type}\ndata: {json.dumps({'text': text})}\n\n"
+
+async def final_event(id: str):
+    """
+    Returns the done or error event of a finished task from its hash, or
+    None while it is still queued or processing. Used when the token stream
+    has nothing to read: it expires after TOKEN_STREAM_TTL, while the task
+    hash is kept for TASK_RESULT_TTL.
+    """
     task_hash = await task_queue.hgetall(f"task:{id}")
     if not task_hash:
+        return sse_event('error', 'Task not found')
+    if task_hash.get('status') == 'complete':
+        return sse_event('done', unpack_fields(task_hash, 'result')['result'])
+    if task_hash.get('status') == 'failed':
+        return sse_event('error', 'Task failed')
+    return None
+
+@app.get("/tasks/{id}/stream")
+async def stream_task(id: str):
+    """
+    Streams the answer of a task as Server-Sent Events while it is generated
+
+    Returns:
+        text/event-stream with "token" events carrying text chunks, followed
+        by one "done" event with the full answer or an "error" event. The
+        connection is closed with an error event after SSE_MAX_S seconds.
+    """
+    if not await task_queue.exists(f"task:{id}"):
         return {"error": "Task not found"}
-    return task_hash
+
+    async def events():
+        last_id = '0'
+        deadline = time.monotonic() + SSE_MAX_S
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                yield sse_event('error', 'Stream timed out')
+                return
+            entries = await task_queue.xread(
+                {f"task:{id}:tokens": last_id}, block=max(1, int(min(remaining, 15) * 1000)))
+            if not entries:
+                # The final event is written with the status, so a finished
+                # task with nothing to read has lost its token stream
+                event = await final_event(id)
+                if event:
+                    yield event
+                    return
+                # Keeps proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+                continue
+            for _, items in entries:
+                for entry_id, fields in items:
+                    last_id = entry_id
+                    text = unpack_fields(fields, 'text')['text']
+                    yield sse_event(fields['type'], text)
+                    if fields['type'] != 'token':
+                        return
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.get("/stats")
+async def stats():
+    """
+    Redis round trips spent per accepted task in POST /tasks and /tasks/batch
+    """
+    return round_trip_stats.stats()
+
+@app.get(metrics.GATEWAY_METRICS_PATH)
+async def prometheus_metrics():
+    """
+    Prometheus metrics; stream lag and queue gauges are read from Redis on
+    each scrape
+    """
+    try:
+        await metrics.update_stream_gauges(
+            task_queue, [('tasks', 'workers')] + [(stream, RESULTS_GROUP) for stream in results_streams()])
+        metrics.FAIR_QUEUED.set(int(await task_queue.get(f'{FAIR_PREFIX}:queued') or 0))
+    except Exception as e:
+        print(f'Could not read queue metrics: {e}')
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness probe: the gateway is ready when at least READY_MIN_WORKERS
+    workers have finished warming up and sent a heartbeat within READY_TTL
+
+    Returns:
+        Number of warm workers, with status 503 while there are too few
+    """
+    try:
+        warm = await task_queue.zcount('workers:ready', time.time() - READY_TTL, '+inf')
+    except Exception as e:
+        return JSONResponse({"status": "not ready", "detail": str(e)}, status_code=503)
+    body = {"status": "ready" if warm >= READY_MIN_WORKERS else "not ready", "warm_workers": warm}
+    return JSONResponse(body, status_code=200 if warm >= READY_MIN_WORKERS else 503)
 
 @app.get("/health")
 async def health():
@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import statistics
+import time
+from collections import deque
+from os import getenv
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+from rag import metrics
+
+# Telegram allows about 30 messages per second overall and one per second in a chat
+TELEGRAM_GLOBAL_RATE = float(getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_CHAT_RATE = float(getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(getenv("TELEGRAM_CHAT_BURST", "3"))
+OUTBOX_MAX_PENDING = int(getenv("OUTBOX_MAX_PENDING", "1000"))
+OUTBOX_MAX_RETRIES = int(getenv("OUTBOX_MAX_RETRIES", "5"))
+MESSAGE_LIMIT = 4096
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """
+    Splits text into parts of at most limit characters, cutting at the last
+    paragraph break, line break, sentence end or space in the second half
+    of each part, and mid-word only when there is none
+    """
+    parts = []
+    while len(text) > limit:
+        for separator in ('\n\n', '\n', '. ', ' '):
+            cut = text.rfind(separator, limit // 2, limit)
+            if cut != -1:
+                cut += len(separator)
+                break
+        else:
+            cut = limit
+        if text[:cut].strip():
+            parts.append(text[:cut])
+        text = text[cut:]
+    if text.strip() or not parts:
+        parts.append(text)
+    return parts
+
+
+class TokenBucket:
+    """
+    Bucket of burst tokens refilled at rate per second. Tokens are reserved
+    ahead, so concurrent callers are spaced out instead of all waking at
+    once when the bucket refills.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        self._refill()
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+    def pause(self, seconds):
+        """
+        Makes the next token available only after seconds (Telegram's
+        retry_after). Pauses that overlap do not add up.
+        """
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class Outbox:
+    """
+    Sends Telegram requests through a global and a per-chat token bucket.
+
+    Requests for one chat go out in order, requests for different chats in
+    parallel. A RetryAfter from Telegram pauses that chat's bucket and the
+    request is retried. When the flood limit looks global, because the wait
+    is longer than the chat interval or another chat is still waiting out
+    its own, the global bucket is paused as well. Network and server errors
+    are retried with backoff. At most max_pending requests wait at once;
+    submit() blocks beyond that.
+
+    Requests are zero-argument callables returning the API call's
+    awaitable, so a retry can make the call again.
+    """
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 chat_burst=TELEGRAM_CHAT_BURST, max_pending=OUTBOX_MAX_PENDING,
+                 max_retries=OUTBOX_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, max(1, int(global_rate)))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.slots = asyncio.Semaphore(max_pending)
+        self.queues = {}
+        self.buckets = {}
+        self.drains = set()
+        # Chat of the last RetryAfter and when its wait ends
+        self.flooded_chat = None
+        self.flood_until = 0.0
+        self.pending = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.latencies = deque(maxlen=1000)
+
+    async def submit(self, chat_id, request):
+        """
+        Queues request for chat_id and returns its result once sent
+        """
+        await self.slots.acquire()
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = deque()
+            drain = asyncio.create_task(self.drain(chat_id, queue))
+            self.drains.add(drain)
+            drain.add_done_callback(self.drains.discard)
+        queue.append((request, future, time.monotonic()))
+        self.pending += 1
+        metrics.OUTBOX_QUEUE_DEPTH.inc()
+        return await future
+
+    async def send_text(self, bot, chat_id, text):
+        """
+        Sends text as one or more messages, split at safe boundaries
+        """
+        messages = []
+        for part in split_message(text):
+            messages.append(await self.submit(
+                chat_id, lambda part=part: bot.send_message(chat_id, part, parse_mode=None)))
+        return messages
+
+    async def drain(self, chat_id, queue):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        try:
+            while queue:
+                request, future, enqueued = queue.popleft()
+                try:
+                    result = await self.send(chat_id, bucket, request)
+                    self.sent += 1
+                    self.latencies.append(time.monotonic() - enqueued)
+                    metrics.TELEGRAM_SEND_SECONDS.observe(time.monotonic() - enqueued)
+                    metrics.TELEGRAM_REQUESTS.labels('sent').inc()
+                    if self.sent % 500 == 0:
+                        logging.info(f"Outbox: {self.stats()}")
+                    if not future.done():
+                        future.set_result(result)
+                except Exception as e:
+                    self.failed += 1
+                    metrics.TELEGRAM_REQUESTS.labels('failed').inc()
+                    if not future.done():
+                        future.set_exception(e)
+                finally:
+                    self.pending -= 1
+                    metrics.OUTBOX_QUEUE_DEPTH.dec()
+                    self.slots.release()
+        finally:
+            del self.queues[chat_id]
+            if len(self.buckets) > 10000:
+                self.buckets = {chat: b for chat, b in self.buckets.items()
+                                if chat in self.queues or not b.idle()}
+
+    async def send(self, chat_id, bucket, request):
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await request()
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                metrics.TELEGRAM_RETRIES.labels('flood').inc()
+                bucket.pause(e.retry_after)
+                if self.global_flood(chat_id, e.retry_after):
+                    self.global_bucket.pause(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError):
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                metrics.TELEGRAM_RETRIES.labels('error').inc()
+                await asyncio.sleep(min(2 ** attempt, 30))
+
+    def global_flood(self, chat_id, retry_after):
+        """
+        Whether a RetryAfter for chat_id is likely the global limit rather
+        than the chat's: it asks for a longer wait than the chat interval,
+        or another chat got one that has not run out yet
+        """
+        now = time.monotonic()
+        other_chat = self.flooded_chat not in (None, chat_id) and now < self.flood_until
+        self.flooded_chat = chat_id
+        self.flood_until = max(self.flood_until, now + retry_after)
+        return retry_after > 1 / self.chat_rate or other_chat
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            'queue_depth': self.pending,
+            'active_chats': len(self.queues),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+            'p50_send_latency_ms': 1000 * statistics.median(latencies) if latencies else 0.0,
+            'p95_send_latency_ms': 1000 * latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0,
+            'max_send_latency_ms': 1000 * latencies[-1] if latencies else 0.0
+        }
@@ -1,3 +1,3 @@
-from .rag import answer, generate_answer
+from .rag import answer, generate_answer, init, warm_up, open_http_client, close_http_client
 
-__all__ = ['answer', 'generate_answer']
\ No newline at end of file
+__all__ = ['answer', 'generate_answer', 'init', 'warm_up', 'open_http_client', 'close_http_client']
\ No newline at end of file
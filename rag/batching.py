@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+
+class MicroBatcher:
+    """
+    Collects requests arriving within window_ms, up to max_batch_size units
+    in total, and runs them as one run_batch call on the executor. Each
+    caller gets back only its own result.
+
+    Args:
+        run_batch: list of requests -> list with one result per request,
+            run on the executor
+        executor: concurrent.futures executor for run_batch
+        name: label of the periodic stats line
+    """
+
+    def __init__(self, run_batch, executor, window_ms, max_batch_size, name='Batcher'):
+        self.run_batch = run_batch
+        self.executor = executor
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.name = name
+        self.pending = []
+        self.pending_size = 0
+        self.timer = None
+        self.running = set()
+        self.batches = 0
+        self.requests = 0
+        self.units = 0
+        self.max_seen_batch = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run_time = 0.0
+
+    async def submit(self, request, size=1):
+        """
+        Returns the result of request once its batch has run. size is what
+        the request counts against max_batch_size, e.g. its number of texts;
+        a request larger than max_batch_size runs as its own batch.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((request, size, future, time.monotonic()))
+        self.pending_size += size
+
+        if self.pending_size >= self.max_batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending, self.pending_size = self.pending, [], 0
+        if batch:
+            task = asyncio.create_task(self.run(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def run(self, batch):
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+
+        try:
+            results = await loop.run_in_executor(self.executor, self.run_batch, [request for request, _, _, _ in batch])
+        except Exception as e:
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, _, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+        waits = [started - enqueued for _, _, _, enqueued in batch]
+        self.batches += 1
+        self.requests += len(batch)
+        self.units += sum(size for _, size, _, _ in batch)
+        self.max_seen_batch = max(self.max_seen_batch, len(batch))
+        self.total_wait += sum(waits)
+        self.max_wait = max(self.max_wait, *waits)
+        self.total_run_time += time.monotonic() - started
+        if self.batches % 100 == 0:
+            print(f"{self.name}: {self.stats()}")
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'requests': self.requests,
+            'units': self.units,
+            'mean_batch_size': self.requests / self.batches if self.batches else 0.0,
+            'mean_units_per_batch': self.units / self.batches if self.batches else 0.0,
+            'max_batch_size': self.max_seen_batch,
+            'mean_wait_ms': 1000 * self.total_wait / self.requests if self.requests else 0.0,
+            'max_wait_ms': 1000 * self.max_wait,
+            'mean_batch_time_ms': 1000 * self.total_run_time / self.batches if self.batches else 0.0
+        }
@@ -0,0 +1,276 @@
+import asyncio
+import base64
+import time
+import uuid
+import numpy as np
+import redis
+from rag.storage import pack_text, unpack_text
+from rag.metrics import CACHE_LOOKUPS
+from os import getenv
+
+CACHE_PREFIX = 'answer_cache'
+CACHE_ENABLED = getenv('ANSWER_CACHE_ENABLED', '1') == '1'
+CACHE_MAX_DISTANCE = float(getenv('ANSWER_CACHE_MAX_DISTANCE', '0.08'))
+CACHE_TTL = int(getenv('ANSWER_CACHE_TTL', '86400'))
+CACHE_MAX_ENTRIES = int(getenv('ANSWER_CACHE_MAX_ENTRIES', '2000'))
+CACHE_POLICY = getenv('ANSWER_CACHE_POLICY', 'lru')
+CACHE_LFU_HALF_LIFE = int(getenv('ANSWER_CACHE_LFU_HALF_LIFE', '3600'))
+
+
+class AnswerCache:
+    """
+    Semantic cache of final answers stored in Redis.
+
+    A cached answer is returned for any query whose embedding lies within
+    max_distance (cosine) of a previously answered query. Entries expire after
+    ttl seconds, the cache is capped at max_entries using LRU or LFU eviction,
+    and everything lives under a generation number that is bumped whenever
+    the py_docs collection is rebuilt.
+
+    Every process keeps a local copy of the query vectors. Stores and
+    removals are appended to a per-generation log stream, so a process only
+    reads the changes made since its last lookup; it reloads all vectors
+    when it falls behind the trimmed log or the generation changes.
+
+    Args:
+        redis: redis.asyncio client created with decode_responses=True
+        embed: Chroma-style embedding function, list of texts -> list of vectors
+    """
+
+    def __init__(self, redis, embed, max_distance=CACHE_MAX_DISTANCE, ttl=CACHE_TTL,
+                 max_entries=CACHE_MAX_ENTRIES, policy=CACHE_POLICY, lfu_half_life=CACHE_LFU_HALF_LIFE):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        self.redis = redis
+        self.embed = embed
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.policy = policy
+        self.lfu_half_life = lfu_half_life
+        self.log_maxlen = max(4 * max_entries, 1000)
+        # Local mirror of the cached query vectors, kept in sync through the
+        # log: the generation and the id of the last log entry applied
+        self._generation = None
+        self._log_id = None
+        self._vectors = {}
+        self._ids = []
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+
+    def _key(self, generation, name):
+        return f'{CACHE_PREFIX}:{generation}:{name}'
+
+    async def embed_query(self, query):
+        return (await self.embed_queries([query]))[0]
+
+    async def embed_queries(self, queries):
+        """
+        Embeds queries in one call; returns unit vectors, one per row
+        """
+        vectors = np.asarray(await asyncio.to_thread(self.embed, queries), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    async def _load_vectors(self):
+        generation = generation_or_zero(await self.redis.get(f'{CACHE_PREFIX}:generation'))
+        if generation != self._generation:
+            await self._reload(generation)
+            return generation
+
+        log = self._key(generation, 'log')
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.xrange(log, min=f'({self._log_id}')
+            pipe.xrange(log, count=1)
+            changes, first = await pipe.execute()
+        if first and stream_id(first[0][0]) > stream_id(self._log_id):
+            # Entries we have not applied yet may have been trimmed
+            await self._reload(generation)
+        elif changes:
+            await self._apply(generation, changes)
+        return generation
+
+    async def _reload(self, generation):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hgetall(self._key(generation, 'vectors'))
+            pipe.xrevrange(self._key(generation, 'log'), count=1)
+            raw, last = await pipe.execute()
+        self._vectors = {entry_id: decode_vector(vector) for entry_id, vector in raw.items()}
+        self._generation = generation
+        self._log_id = last[0][0] if last else '0-0'
+        self._rebuild()
+
+    async def _apply(self, generation, changes):
+        added = []
+        for entry_id, fields in changes:
+            if fields['op'] == 'add':
+                added.append(fields['id'])
+            else:
+                for removed in fields['ids'].split():
+                    self._vectors.pop(removed, None)
+                    if removed in added:
+                        added.remove(removed)
+        if added:
+            vectors = await self.redis.hmget(self._key(generation, 'vectors'), added)
+            for added_id, vector in zip(added, vectors):
+                # Missing when removed after the log was read; the removal
+                # is applied on the next sync
+                if vector is not None:
+                    self._vectors[added_id] = decode_vector(vector)
+        self._log_id = changes[-1][0]
+        self._rebuild()
+
+    def _rebuild(self):
+        self._ids = list(self._vectors)
+        if self._ids:
+            self._matrix = np.stack([self._vectors[i] for i in self._ids])
+        else:
+            self._matrix = np.zeros((0, 0), dtype=np.float32)
+
+    async def lookup(self, query, embedding=None):
+        """
+        Returns the cached answer for the nearest stored query, or None if
+        nothing is within max_distance
+        """
+        if embedding is None:
+            embedding = await self.embed_query(query)
+        return (await self.lookup_many([query], [embedding]))[0]
+
+    async def lookup_many(self, queries, embeddings=None):
+        """
+        lookup for many queries at once: one sync of the vectors, one
+        matrix product, one pipeline reading the hits and one updating
+        their recency and frequency
+        """
+        if embeddings is None:
+            embeddings = await self.embed_queries(queries)
+        answers = await self._lookup_many(np.asarray(embeddings, dtype=np.float32).reshape(len(queries), -1))
+        for answer in answers:
+            CACHE_LOOKUPS.labels('miss' if answer is None else 'hit').inc()
+        return answers
+
+    async def _lookup_many(self, embeddings):
+        answers = [None] * len(embeddings)
+        generation = await self._load_vectors()
+        if not self._ids:
+            return answers
+
+        distances = 1.0 - embeddings @ self._matrix.T
+        best = np.argmin(distances, axis=1)
+        hits = {row: self._ids[column] for row, column in enumerate(best) if distances[row, column] <= self.max_distance}
+        if not hits:
+            return answers
+
+        entry_ids = list(dict.fromkeys(hits.values()))
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for entry_id in entry_ids:
+                pipe.hgetall(self._key(generation, f'entry:{entry_id}'))
+            entries = await pipe.execute()
+        found = {entry_id: unpack_text(entry, 'answer') for entry_id, entry in zip(entry_ids, entries)}
+
+        expired = [entry_id for entry_id, answer in found.items() if answer is None]
+        if expired:
+            # Entries expired, drop their vectors so the next lookup skips them
+            await self._remove(generation, expired)
+
+        uses = {}
+        for row, entry_id in hits.items():
+            answers[row] = found[entry_id]
+            if answers[row] is not None:
+                uses[entry_id] = uses.get(entry_id, 0) + 1
+        if uses:
+            now = time.time()
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.zadd(self._key(generation, 'recency'), {entry_id: now for entry_id in uses})
+                for entry_id, count in uses.items():
+                    pipe.zincrby(self._key(generation, 'frequency'), count, entry_id)
+                await pipe.execute()
+        return answers
+
+    async def store(self, query, answer, embedding=None):
+        if embedding is None:
+            embedding = await self.embed_query(query)
+        generation = generation_or_zero(await self.redis.get(f'{CACHE_PREFIX}:generation'))
+        entry_id = uuid.uuid4().hex
+        now = time.time()
+        if self.policy == 'lfu' and await self.redis.set(
+                self._key(generation, 'decayed'), 1, nx=True, ex=self.lfu_half_life):
+            # Halves all use counts once per half-life, so entries that were
+            # popular long ago make room for the current ones. Done before
+            # adding the new entry, which starts at one use.
+            await self.redis.zunionstore(
+                self._key(generation, 'frequency'), {self._key(generation, 'frequency'): 0.5})
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self._key(generation, f'entry:{entry_id}'), mapping={
+                'query': query,
+                **pack_text('answer', answer),
+                'created': now
+            })
+            pipe.expire(self._key(generation, f'entry:{entry_id}'), self.ttl)
+            pipe.hset(self._key(generation, 'vectors'), entry_id,
+                      base64.b64encode(embedding.astype(np.float32).tobytes()).decode())
+            pipe.zadd(self._key(generation, 'created'), {entry_id: now})
+            pipe.zadd(self._key(generation, 'recency'), {entry_id: now})
+            # The question that produced the answer counts as the first use,
+            # so new entries are not the first LFU victims
+            pipe.zadd(self._key(generation, 'frequency'), {entry_id: 1})
+            pipe.xadd(self._key(generation, 'log'), {'op': 'add', 'id': entry_id},
+                      maxlen=self.log_maxlen, approximate=True)
+            await pipe.execute()
+
+        await self._evict(generation, now, entry_id)
+
+    async def _evict(self, generation, now, stored_id):
+        expired = await self.redis.zrangebyscore(self._key(generation, 'created'), '-inf', now - self.ttl)
+        if expired:
+            await self._remove(generation, expired)
+
+        excess = await self.redis.zcard(self._key(generation, 'created')) - self.max_entries
+        if excess > 0:
+            ranking = 'recency' if self.policy == 'lru' else 'frequency'
+            # The entry just stored is never its own victim, even when its
+            # use count ties with older entries
+            victims = await self.redis.zrange(self._key(generation, ranking), 0, excess)
+            await self._remove(generation, [i for i in victims if i != stored_id][:excess])
+
+    async def _remove(self, generation, entry_ids):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for entry_id in entry_ids:
+                pipe.delete(self._key(generation, f'entry:{entry_id}'))
+            pipe.hdel(self._key(generation, 'vectors'), *entry_ids)
+            for name in ('created', 'recency', 'frequency'):
+                pipe.zrem(self._key(generation, name), *entry_ids)
+            pipe.xadd(self._key(generation, 'log'), {'op': 'remove', 'ids': ' '.join(entry_ids)},
+                      maxlen=self.log_maxlen, approximate=True)
+            await pipe.execute()
+
+
+def generation_or_zero(value):
+    return int(value) if value else 0
+
+
+def stream_id(entry_id):
+    return tuple(int(part) for part in entry_id.split('-'))
+
+
+def decode_vector(value):
+    return np.frombuffer(base64.b64decode(value), dtype=np.float32)
+
+
+def invalidate_answer_cache(redis_url=None):
+    """
+    Starts a new cache generation and deletes the keys of the old one.
+    Called after the py_docs collection is rebuilt, so cached answers never
+    outlive the documents they were generated from.
+    """
+    redis_url = redis_url or getenv('REDIS_URL', 'redis://redis:6379')
+    client = redis.Redis.from_url(redis_url, decode_responses=True)
+    try:
+        old_generation = generation_or_zero(client.get(f'{CACHE_PREFIX}:generation'))
+        client.incr(f'{CACHE_PREFIX}:generation')
+        old_keys = list(client.scan_iter(match=f'{CACHE_PREFIX}:{old_generation}:*'))
+        if old_keys:
+            client.delete(*old_keys)
+        return len(old_keys)
+    finally:
+        client.close()
@@ -0,0 +1,138 @@
+import os
+import re
+from bisect import bisect_left, bisect_right
+
+# Bump when chunking changes so vector_db re-chunks unchanged documents
+CHUNKER_VERSION = 4
+
+# all-MiniLM-L6-v2 reads at most 256 word pieces including [CLS] and [SEP]
+chunk_tokens = int(os.getenv('CHUNK_TOKENS', '254'))
+chunk_overlap_tokens = int(os.getenv('CHUNK_OVERLAP_TOKENS', '48'))
+chunk_min_chars = int(os.getenv('CHUNK_MIN_CHARS', '50'))
+tokenizer_name = os.getenv('CHUNK_TOKENIZER', 'sentence-transformers/all-MiniLM-L6-v2')
+
+sentence_end = re.compile(r'(?<=[.!?])\s+')
+line_break = re.compile(r'\n')
+tokenizer = None
+
+
+def get_tokenizer():
+    global tokenizer
+    if tokenizer is None:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    return tokenizer
+
+
+def count_tokens(text):
+    """
+    Number of word pieces of text, without the [CLS] and [SEP] the model
+    adds. all-MiniLM-L6-v2 truncates its input at 256 word pieces including
+    those two, so text above 254 is only partially embedded.
+    """
+    return len(get_tokenizer()(text, add_special_tokens=False, verbose=False)['input_ids'])
+
+
+def document_sections(doc):
+    """
+    Sections of a parsed document. Documents scraped before sections were
+    recorded are treated as one untitled section of paragraphs.
+    """
+    if doc.get('sections'):
+        return doc['sections']
+    blocks = [{'type': 'p', 'text': text} for text in doc['content'].split('\n\n') if text.strip()]
+    return [{'heading': '', 'blocks': blocks}]
+
+
+def token_spans(text):
+    """
+    Character (start, end) of each word piece of text, from one tokenizer call
+    """
+    return get_tokenizer()(text, add_special_tokens=False, return_offsets_mapping=True,
+                           verbose=False)['offset_mapping']
+
+
+def split_block(block, max_tokens):
+    """
+    Returns (text, tokens) pieces of a block. A block that fits the budget is
+    kept whole; longer code is split at line breaks and longer prose at
+    sentence ends. Each piece takes as many whole lines or sentences as fit,
+    falling back to word boundaries for a line or sentence that alone is too
+    long. The block is tokenized once and cut at token indices.
+    """
+    text = block['text']
+    spans = token_spans(text)
+    if len(spans) <= max_tokens:
+        return [(text, len(spans))]
+
+    separator = line_break if block['type'] == 'pre' else sentence_end
+    starts = [start for start, _ in spans]
+    # Token indices at which a line or sentence, or a word, starts
+    part_starts = sorted({bisect_left(starts, match.end()) for match in separator.finditer(text)} | {len(spans)})
+    word_starts = [i for i in range(1, len(spans)) if spans[i][0] > spans[i - 1][1]] + [len(spans)]
+
+    pieces = []
+    first = 0
+    while first < len(spans):
+        limit = first + max_tokens
+        last = (furthest(part_starts, first, limit) or furthest(word_starts, first, limit)
+                or min(limit, len(spans)))
+        pieces.append((text[spans[first][0]:spans[last - 1][1]], last - first))
+        first = last
+    return pieces
+
+
+def furthest(indices, first, limit):
+    """
+    Largest of the sorted indices in (first, limit], or None
+    """
+    position = bisect_right(indices, limit)
+    if position and indices[position - 1] > first:
+        return indices[position - 1]
+    return None
+
+
+def chunk_document(doc, max_tokens=chunk_tokens, overlap_tokens=chunk_overlap_tokens):
+    """
+    Packs the blocks of each section into chunks of at most max_tokens.
+    Chunks never span two sections and code blocks are only split when they
+    alone exceed the budget. The last block of a chunk is repeated at the
+    start of the next one when it is no longer than overlap_tokens.
+
+    Returns:
+        List of dictionaries with the chunk text, its section heading and
+        its token count
+    """
+    chunks = []
+
+    for section in document_sections(doc):
+        current = []
+        current_tokens = 0
+
+        for block in section['blocks']:
+            for text, tokens in split_block(block, max_tokens):
+                if current and current_tokens + tokens > max_tokens:
+                    chunks.append((section['heading'], current))
+                    last_text, last_tokens = current[-1]
+                    if last_tokens <= overlap_tokens and last_tokens + tokens <= max_tokens:
+                        current = [(last_text, last_tokens)]
+                        current_tokens = last_tokens
+                    else:
+                        current = []
+                        current_tokens = 0
+                current.append((text, tokens))
+                current_tokens += tokens
+
+        if current:
+            chunks.append((section['heading'], current))
+
+    result = []
+    for heading, pieces in chunks:
+        text = '\n\n'.join(piece for piece, _ in pieces)
+        if len(text) >= chunk_min_chars:
+            result.append({
+                'text': text,
+                'heading': heading,
+                'tokens': sum(tokens for _, tokens in pieces)
+            })
+    return result
@@ -0,0 +1,48 @@
+import json
+import os
+from pathlib import Path
+
+corpus_path = Path(os.getenv('CORPUS_PATH', 'data/docs/python_docs.jsonl'))
+
+
+def read_corpus(path=corpus_path):
+    """
+    Yields documents one at a time from a JSONL corpus, so memory does not
+    grow with the size of the corpus. The legacy python_docs.json array is
+    still accepted.
+    """
+    path = Path(path)
+    if path.suffix == '.json':
+        with open(path, 'r', encoding='utf-8') as f:
+            yield from json.load(f)
+        return
+
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def tee_corpus(documents, path=corpus_path):
+    """
+    Writes each document to a JSONL corpus as it passes through and yields it
+    on. The file is written under a temporary name and only replaces the
+    previous corpus once the stream is exhausted.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    count = 0
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for doc in documents:
+            f.write(json.dumps(doc, ensure_ascii=False) + '\n')
+            count += 1
+            yield doc
+    tmp_path.replace(path)
+    print(f"Saved {count} documents to {path}")
+
+
+def write_corpus(documents, path=corpus_path):
+    for _ in tee_corpus(documents, path):
+        pass
+    return Path(path)
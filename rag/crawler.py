@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlsplit
+import httpx
+
+crawl_concurrency = int(os.getenv('CRAWL_CONCURRENCY', '8'))
+crawl_per_host = int(os.getenv('CRAWL_PER_HOST', '4'))
+crawl_delay = float(os.getenv('CRAWL_DELAY', '0.1'))
+http_cache_dir = Path(os.getenv('HTTP_CACHE_DIR', 'data/docs/http_cache'))
+
+
+class HttpCache:
+    """
+    On-disk cache with one JSON file per URL holding the validators
+    (ETag, Last-Modified) and the document parsed from that response
+    """
+
+    def __init__(self, directory=http_cache_dir):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, url):
+        return self.directory / f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}.json"
+
+    def get(self, url):
+        path = self.path(url)
+        if not path.exists():
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, url, entry):
+        path = self.path(url)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        tmp_path.replace(path)
+
+
+class Crawler:
+    """
+    Fetches pages concurrently with revalidation against the HttpCache.
+
+    At most concurrency requests run at once and at most per_host of them
+    against the same host, with requests to one host spaced by delay
+    seconds. Pages answered with 304 Not Modified are taken from the cache
+    without being parsed again. A page that cannot be fetched (timeout,
+    error status) is also taken from the cache if it is there, so a flaky
+    refresh does not drop it from the corpus and the index.
+
+    Args:
+        parse: function (url, html) -> document dict or None
+    """
+
+    def __init__(self, parse, concurrency=crawl_concurrency, per_host=crawl_per_host,
+                 delay=crawl_delay, cache=None):
+        self.parse = parse
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.delay = delay
+        self.cache = cache if cache is not None else HttpCache()
+        self.stats = {'fetched': 0, 'not_modified': 0, 'stale': 0, 'failed': 0}
+
+    async def wait_turn(self, host):
+        async with self.host_locks[host]:
+            delay = self.next_request.get(host, 0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_request[host] = time.monotonic() + self.delay
+
+    async def fetch(self, client, url):
+        host = urlsplit(url).netloc
+        if host not in self.host_slots:
+            self.host_slots[host] = asyncio.Semaphore(self.per_host)
+            self.host_locks[host] = asyncio.Lock()
+
+        entry = self.cache.get(url)
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            async with self.slots, self.host_slots[host]:
+                await self.wait_turn(host)
+                response = await client.get(url, headers=headers)
+
+            if response.status_code == 304 and entry:
+                self.stats['not_modified'] += 1
+                return entry['document']
+
+            response.raise_for_status()
+            document = await asyncio.to_thread(self.parse, url, response.text)
+            self.cache.put(url, {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'document': document
+            })
+            self.stats['fetched'] += 1
+            return document
+        except Exception as e:
+            if entry:
+                print(f'Error processing {url}, keeping the cached copy: {e}')
+                self.stats['stale'] += 1
+                return entry['document']
+            print(f'Error processing {url}: {e}')
+            self.stats['failed'] += 1
+            return None
+
+    def client(self):
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.host_slots = {}
+        self.host_locks = {}
+        self.next_request = {}
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(10.0),
+            follow_redirects=True,
+            headers={'User-Agent': 'async-rag-system docs crawler'},
+            limits=httpx.Limits(max_connections=self.concurrency)
+        )
+
+    def report(self, count):
+        print(f"Crawled {count} URLs: {self.stats['fetched']} fetched, "
+              f"{self.stats['not_modified']} not modified, {self.stats['stale']} kept from the cache "
+              f"after an error, {self.stats['failed']} failed")
+
+    async def crawl(self, urls):
+        """
+        Returns the parsed documents of urls in their original order,
+        skipping duplicates, failures and pages without content
+        """
+        urls = list(dict.fromkeys(urls))
+        async with self.client() as client:
+            documents = await asyncio.gather(*(self.fetch(client, url) for url in urls))
+
+        self.report(len(urls))
+        return [doc for doc in documents if doc and doc['content']]
+
+    async def iter_crawl(self, urls, buffer_size=32):
+        """
+        Yields documents in completion order as soon as they are parsed.
+        At most buffer_size finished documents wait for the consumer, so a
+        slow consumer slows the crawl down instead of growing memory.
+        """
+        urls = list(dict.fromkeys(urls))
+        pending = asyncio.Queue()
+        for url in urls:
+            pending.put_nowait(url)
+        results = asyncio.Queue(maxsize=buffer_size)
+
+        async def work(client):
+            while not pending.empty():
+                url = pending.get_nowait()
+                await results.put(await self.fetch(client, url))
+
+        async with self.client() as client:
+            workers = [asyncio.create_task(work(client)) for _ in range(self.concurrency)]
+            try:
+                for _ in urls:
+                    doc = await results.get()
+                    if doc and doc['content']:
+                        yield doc
+            finally:
+                for worker in workers:
+                    worker.cancel()
+
+        self.report(len(urls))
+
+
+def test_crawler():
+    """
+    Crawls fixture pages served by a local HTTP server twice and checks that
+    the second run is answered from the cache with 304s
+    """
+    from rag.python_document_parser import parse_html
+
+    with tempfile.TemporaryDirectory() as root:
+        site = Path(root) / 'site'
+        site.mkdir()
+        for i in range(5):
+            (site / f'page{i}.html').write_text(
+                f"<html><body><h1>Page {i}</h1><div class='body'>"
+                f"<p>Fixture paragraph number {i} with enough text to be kept.</p>"
+                f"<pre>print('fixture code block {i}')</pre></div></body></html>",
+                encoding='utf-8'
+            )
+
+        handler = partial(SimpleHTTPRequestHandler, directory=str(site))
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        urls = [f'http://127.0.0.1:{server.server_port}/page{i}.html' for i in range(5)]
+
+        try:
+            cache = HttpCache(Path(root) / 'cache')
+            first = Crawler(parse_html, concurrency=4, per_host=2, delay=0, cache=cache)
+            documents = asyncio.run(first.crawl(urls))
+            assert len(documents) == 5 and first.stats['fetched'] == 5, first.stats
+
+            second = Crawler(parse_html, concurrency=4, per_host=2, delay=0, cache=cache)
+            cached = asyncio.run(second.crawl(urls))
+            assert second.stats['not_modified'] == 5, second.stats
+            assert cached == documents
+
+            async def collect():
+                return [doc async for doc in Crawler(parse_html, delay=0, cache=cache).iter_crawl(urls, 2)]
+            streamed = asyncio.run(collect())
+            assert sorted(doc['url'] for doc in streamed) == urls
+
+            # A page that fails to load keeps its cached document
+            (site / 'page0.html').unlink()
+            flaky = Crawler(parse_html, concurrency=4, per_host=2, delay=0, cache=cache)
+            kept = asyncio.run(flaky.crawl(urls))
+            assert flaky.stats['stale'] == 1 and kept == documents, flaky.stats
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    print("Crawler test passed")
+
+
+if __name__ == "__main__":
+    test_crawler()
@@ -0,0 +1,81 @@
+import asyncio
+import base64
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+import numpy as np
+from fastapi import FastAPI
+from pydantic import BaseModel
+from rag.batching import MicroBatcher
+from rag.embeddings import get_embedding_function
+
+# Backend of the model held by the server; clients use EMBEDDING_BACKEND=remote
+server_backend = os.getenv('EMBEDDING_SERVER_BACKEND', 'sentence_transformers')
+embed_batch_window_ms = float(os.getenv('EMBED_BATCH_WINDOW_MS', '5'))
+embed_max_batch = int(os.getenv('EMBED_MAX_BATCH', '64'))
+
+
+def embed_requests(embed, requests):
+    """
+    Encodes the texts of all requests in one call and splits the matrix
+    back into one slice per request
+    """
+    matrix = np.asarray(embed([text for texts in requests for text in texts]), dtype=np.float32)
+    slices = []
+    start = 0
+    for texts in requests:
+        slices.append(matrix[start:start + len(texts)])
+        start += len(texts)
+    return slices
+
+
+batcher = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global batcher
+    start = time.perf_counter()
+    embed = await asyncio.to_thread(get_embedding_function, server_backend)
+    await asyncio.to_thread(embed, ["warm up"])
+    print(f"Loaded {server_backend} embedder in {time.perf_counter() - start:.2f}s")
+    # One thread: the model parallelizes each forward pass internally
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='embed')
+    batcher = MicroBatcher(partial(embed_requests, embed), executor, embed_batch_window_ms, embed_max_batch,
+                           name='Embedding batcher')
+    yield
+    batcher.executor.shutdown(wait=False)
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+class EmbedRequest(BaseModel):
+    texts: list[str]
+
+
+@app.post("/embed")
+async def embed(request: EmbedRequest):
+    """
+    Embeds texts together with concurrent requests
+
+    Returns:
+        Row-major float32 matrix, base64 encoded, and its shape
+    """
+    matrix = await batcher.submit(request.texts, len(request.texts)) if request.texts else np.zeros((0, 0), dtype=np.float32)
+    return {
+        'shape': list(matrix.shape),
+        'data': base64.b64encode(np.ascontiguousarray(matrix).tobytes()).decode()
+    }
+
+
+@app.get("/stats")
+async def stats():
+    return batcher.stats()
+
+
+@app.get("/health")
+async def health():
+    return {"status": "healthy", "backend": server_backend}
@@ -0,0 +1,203 @@
+import os
+import sys
+import time
+from itertools import islice
+from pathlib import Path
+import base64
+import numpy as np
+from chromadb import EmbeddingFunction
+from chromadb.utils import embedding_functions
+
+embedding_model = os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+# "sentence_transformers" (reference), "torch_int8", "onnx", or "remote" for
+# the shared embedding server (python -m uvicorn rag.embedding_server:app)
+embedding_backend = os.getenv('EMBEDDING_BACKEND', 'sentence_transformers')
+embedding_server_url = os.getenv('EMBEDDING_SERVER_URL', 'http://embedder:8001')
+embedding_threads = int(os.getenv('EMBEDDING_THREADS', str(os.cpu_count() or 1)))
+embedding_batch_size = int(os.getenv('EMBEDDING_BATCH_SIZE', '32'))
+onnx_path = Path(os.getenv('EMBEDDING_ONNX_PATH', 'data/models/all-MiniLM-L6-v2-int8.onnx'))
+max_sequence_length = 256
+
+
+def hub_name(model_name):
+    return model_name if '/' in model_name else f'sentence-transformers/{model_name}'
+
+
+class TransformerEmbeddingFunction(EmbeddingFunction):
+    """
+    Computes the same embeddings as SentenceTransformerEmbeddingFunction
+    (mean pooling, unit length) with a faster CPU runtime:
+
+        torch_int8: the PyTorch model with Linear layers dynamically quantized to int8
+        onnx:       an ONNX export of the model (see export_onnx) on onnxruntime
+
+    Texts are sorted by length and each batch is only padded to its longest
+    member, so short questions are not padded to the 256 token limit.
+    """
+
+    def __init__(self, backend, model_name=embedding_model, threads=embedding_threads,
+                 batch_size=embedding_batch_size, model_path=onnx_path):
+        from transformers import AutoTokenizer
+
+        self.backend = backend
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(hub_name(model_name))
+
+        if backend == 'onnx':
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+            self.session = onnxruntime.InferenceSession(str(model_path), options, providers=['CPUExecutionProvider'])
+            self.input_names = [i.name for i in self.session.get_inputs()]
+        elif backend == 'torch_int8':
+            import torch
+            from transformers import AutoModel
+            torch.set_num_threads(threads)
+            model = AutoModel.from_pretrained(hub_name(model_name)).eval()
+            self.model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        else:
+            raise ValueError(f"Unknown embedding backend: {backend}")
+
+    def encode(self, texts):
+        encoded = self.tokenizer(texts, padding='longest', truncation=True,
+                                 max_length=max_sequence_length, return_tensors='np')
+        if self.backend == 'onnx':
+            hidden = self.session.run(None, {name: encoded[name].astype(np.int64) for name in self.input_names})[0]
+        else:
+            import torch
+            with torch.inference_mode():
+                output = self.model(**{name: torch.from_numpy(value) for name, value in encoded.items()})
+            hidden = output.last_hidden_state.numpy()
+
+        mask = encoded['attention_mask'][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+    def __call__(self, input):
+        order = sorted(range(len(input)), key=lambda i: len(input[i]))
+        embeddings = [None] * len(input)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            for i, vector in zip(batch, self.encode([input[i] for i in batch])):
+                embeddings[i] = vector.tolist()
+        return embeddings
+
+
+class RemoteEmbeddingFunction(EmbeddingFunction):
+    """
+    Embeds through the shared embedding server, which holds the only model
+    instance and batches requests from all processes together. Calls are
+    synchronous like the local functions, so Chroma and the retrieval
+    threads use it the same way.
+    """
+
+    def __init__(self, url=embedding_server_url, timeout=30.0):
+        import httpx
+        self.client = httpx.Client(base_url=url, timeout=timeout)
+
+    def __call__(self, input):
+        if not input:
+            return []
+        response = self.client.post('/embed', json={'texts': list(input)})
+        response.raise_for_status()
+        body = response.json()
+        matrix = np.frombuffer(base64.b64decode(body['data']), dtype=np.float32).reshape(body['shape'])
+        return matrix.tolist()
+
+
+def get_embedding_function(backend=embedding_backend):
+    if backend == 'remote':
+        return RemoteEmbeddingFunction()
+    if backend == 'sentence_transformers':
+        return embedding_functions.SentenceTransformerEmbeddingFunction(model_name=embedding_model)
+    return TransformerEmbeddingFunction(backend)
+
+
+def export_onnx(path=onnx_path, quantize=True):
+    """
+    Exports the model to ONNX and, with quantize=True, stores a dynamically
+    int8-quantized version at path. Needs torch, onnx and onnxruntime.
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fp32_path = path.with_name(path.stem + '-fp32.onnx') if quantize else path
+
+    tokenizer = AutoTokenizer.from_pretrained(hub_name(embedding_model))
+    model = AutoModel.from_pretrained(hub_name(embedding_model)).eval()
+    sample = tokenizer(["How do I open a file?"], return_tensors='pt')
+    names = list(sample.keys())
+    torch.onnx.export(
+        model,
+        tuple(sample[name] for name in names),
+        str(fp32_path),
+        input_names=names,
+        output_names=['last_hidden_state'],
+        dynamic_axes={name: {0: 'batch', 1: 'sequence'} for name in names + ['last_hidden_state']},
+        opset_version=17
+    )
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(str(fp32_path), str(path), weight_type=QuantType.QInt8)
+    print(f"Exported {embedding_model} to {path}")
+    return path
+
+
+def check_rankings(candidate, reference=None, k=5, tolerance=0.1, sample_size=2000):
+    """
+    Embeds corpus chunks and the evaluation questions with both embedding
+    functions and compares them: per-chunk cosine similarity between the two
+    embeddings, and the overlap of each question's top-k chunks. Passes if
+    the mean overlap is at least 1 - tolerance.
+    """
+    from rag.chunker import chunk_document
+    from rag.corpus import read_corpus
+    from rag.evaluation import QUESTIONS
+
+    reference = reference or get_embedding_function('sentence_transformers')
+    texts = list(islice((chunk['text'] for doc in read_corpus() for chunk in chunk_document(doc)), sample_size))
+    questions = [question for question, _ in QUESTIONS]
+
+    embedded = {}
+    for name, function in (('reference', reference), ('candidate', candidate)):
+        start = time.perf_counter()
+        docs = np.asarray(function(texts), dtype=np.float32)
+        elapsed = time.perf_counter() - start
+        queries = np.asarray(function(questions), dtype=np.float32)
+        docs /= np.linalg.norm(docs, axis=1, keepdims=True)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        embedded[name] = (docs, queries)
+        print(f"{name}: {len(texts) / elapsed:.1f} chunks/s")
+
+    ref_docs, ref_queries = embedded['reference']
+    cand_docs, cand_queries = embedded['candidate']
+    similarity = (ref_docs * cand_docs).sum(axis=1)
+    ref_top = np.argsort(-(ref_queries @ ref_docs.T), axis=1)[:, :k]
+    cand_top = np.argsort(-(cand_queries @ cand_docs.T), axis=1)[:, :k]
+    overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(ref_top, cand_top)])
+
+    report = {
+        'mean_cosine': float(similarity.mean()),
+        'min_cosine': float(similarity.min()),
+        f'top{k}_overlap': float(overlap),
+        'passed': bool(overlap >= 1 - tolerance)
+    }
+    print(report)
+    return report
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check'
+    if command == 'export':
+        export_onnx()
+    else:
+        backend = sys.argv[2] if len(sys.argv) > 2 else embedding_backend
+        check_rankings(get_embedding_function(backend))
+
+
+if __name__ == "__main__":
+    main()
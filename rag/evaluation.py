@@ -0,0 +1,78 @@
+import statistics
+import time
+from rag.chunker import count_tokens
+
+docs_url = 'https://docs.python.org/3/'
+
+# Fixed question set with the pages that answer each question
+QUESTIONS = [
+    ("How do I open and read a file in Python?", ['tutorial/inputoutput.html', 'library/functions.html']),
+    ("What is a list comprehension?", ['tutorial/datastructures.html', 'howto/functional.html']),
+    ("How do I define a class that inherits from another class?", ['tutorial/classes.html']),
+    ("How do I handle exceptions with try and except?", ['tutorial/errors.html']),
+    ("How do I create a virtual environment?", ['tutorial/venv.html', 'library/venv.html']),
+    ("How do I parse command line arguments?", ['library/argparse.html', 'howto/argparse.html']),
+    ("How do I find all matches of a regular expression?", ['library/re.html', 'howto/regex.html']),
+    ("How do I sort a list of dictionaries by a key?", ['howto/sorting.html', 'library/stdtypes.html']),
+    ("What does functools.lru_cache do?", ['library/functools.html']),
+    ("How do I run coroutines concurrently with asyncio?", ['library/asyncio-task.html']),
+    ("How do I serialize a Python object to JSON?", ['library/json.html']),
+    ("How do I read rows from a CSV file?", ['library/csv.html']),
+    ("How do I format a datetime as a string?", ['library/datetime.html']),
+    ("How do I count occurrences with Counter?", ['library/collections.html']),
+    ("How do I define a dataclass with default values?", ['library/dataclasses.html']),
+    ("How do I run a subprocess and capture its output?", ['library/subprocess.html']),
+    ("How do I join paths with pathlib?", ['library/pathlib.html']),
+    ("How do I configure logging to write to a file?", ['howto/logging.html', 'library/logging.html', 'howto/logging-cookbook.html']),
+    ("How do I start a new thread?", ['library/threading.html']),
+    ("How do I annotate a function with type hints?", ['library/typing.html']),
+    ("How do I create a temporary file?", ['library/tempfile.html']),
+    ("How do I compute a SHA-256 hash of a string?", ['library/hashlib.html']),
+    ("How do I write a context manager with contextlib?", ['library/contextlib.html']),
+    ("How do I pickle an object to a file?", ['library/pickle.html']),
+]
+
+
+def evaluate(retrieve_batch, k=5, questions=QUESTIONS):
+    """
+    Runs the question set one query at a time through retrieve_batch
+    (queries, n) -> contexts and reports recall@k, MRR, latency and the size
+    of the context that would be sent to the LLM
+    """
+    hits = 0
+    reciprocal_ranks = []
+    latencies = []
+    context_tokens = []
+
+    for question, pages in questions:
+        expected = [docs_url + page for page in pages]
+        start = time.perf_counter()
+        context = retrieve_batch([question], k)[0]
+        latencies.append(time.perf_counter() - start)
+
+        rank = next((i + 1 for i, chunk in enumerate(context) if chunk['url'] in expected), None)
+        if rank is not None:
+            hits += 1
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+        context_tokens.append(count_tokens("\n\n".join(chunk['content'] for chunk in context)))
+
+    return {
+        'questions': len(questions),
+        f'recall@{k}': hits / len(questions),
+        'mrr': statistics.mean(reciprocal_ranks),
+        'p50_latency_ms': 1000 * statistics.median(latencies),
+        'max_latency_ms': 1000 * max(latencies),
+        'mean_context_tokens': statistics.mean(context_tokens)
+    }
+
+
+def main():
+    from rag.rag import init, retrieve_batch
+
+    init()
+    for name, value in evaluate(retrieve_batch).items():
+        print(f"{name}: {value:.3f}" if isinstance(value, float) else f"{name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
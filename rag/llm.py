@@ -0,0 +1,426 @@
+import asyncio
+import json
+import time
+import uuid
+from contextlib import asynccontextmanager
+from os import getenv
+import httpx
+from rag import metrics
+
+# Requests one Ollama host generates at once, across all worker processes
+# sharing the pool's Redis; more wait for a free slot
+OLLAMA_BACKEND_CONCURRENCY = int(getenv('OLLAMA_BACKEND_CONCURRENCY', '4'))
+# Longest a request holds a shared slot; slots of crashed workers free up after this
+OLLAMA_SLOT_TTL_S = float(getenv('OLLAMA_SLOT_TTL_S', '600'))
+# How often a request waiting for a shared slot checks again
+SLOT_POLL_S = 0.2
+# Longest wait for a free slot on any backend
+OLLAMA_QUEUE_TIMEOUT_S = float(getenv('OLLAMA_QUEUE_TIMEOUT_S', '30'))
+# Consecutive failures that open a backend's circuit breaker
+OLLAMA_BREAKER_FAILURES = int(getenv('OLLAMA_BREAKER_FAILURES', '3'))
+# Seconds an open breaker waits before letting one trial request through
+OLLAMA_BREAKER_RESET_S = float(getenv('OLLAMA_BREAKER_RESET_S', '30'))
+OLLAMA_HEALTH_INTERVAL_S = float(getenv('OLLAMA_HEALTH_INTERVAL_S', '10'))
+OLLAMA_HEALTH_TIMEOUT_S = float(getenv('OLLAMA_HEALTH_TIMEOUT_S', '2'))
+
+
+# Takes a slot on the least loaded backend below its cap. Each backend's
+# slots are a sorted set of lease ids scored by expiry, so leases of dead
+# processes drop out. Backends loading the model are only taken when no
+# other one has a free slot.
+# KEYS: slot set per candidate backend
+# ARGV: now, expiry (ms), lease id, then cap and loading (1/0) per backend
+TAKE_SLOT_SCRIPT = """
+local best, best_count, best_loading
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', ARGV[1])
+    local count = redis.call('ZCARD', key)
+    local loading = ARGV[3 + i * 2] == '1'
+    if count < tonumber(ARGV[2 + i * 2]) and (best == nil or (best_loading and not loading)
+            or (best_loading == loading and count < best_count)) then
+        best, best_count, best_loading = i, count, loading
+    end
+end
+if best == nil then
+    return 0
+end
+redis.call('ZADD', KEYS[best], ARGV[2], ARGV[3])
+redis.call('PEXPIREAT', KEYS[best], ARGV[2])
+return best
+"""
+
+
+class NoBackendAvailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Closed while requests succeed. After max_failures consecutive failures
+    it opens and rejects requests for reset_s seconds, then lets a single
+    trial request through (half-open): its success closes the breaker, its
+    failure opens it again.
+    """
+
+    def __init__(self, max_failures=OLLAMA_BREAKER_FAILURES, reset_s=OLLAMA_BREAKER_RESET_S):
+        self.max_failures = max_failures
+        self.reset_s = reset_s
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_s:
+            return 'half-open'
+        return 'open'
+
+    def allows(self):
+        state = self.state
+        return state == 'closed' or (state == 'half-open' and not self.trial)
+
+    def start(self):
+        """
+        Returns True if the request starting now is the half-open trial
+        """
+        if self.state == 'half-open':
+            self.trial = True
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        self.trial = False
+        if self.opened_at is not None or self.failures >= self.max_failures:
+            self.open()
+
+    def open(self):
+        self.opened_at = time.monotonic()
+        self.trial = False
+
+
+class Backend:
+    def __init__(self, url, timeout, limits, concurrency=OLLAMA_BACKEND_CONCURRENCY):
+        self.url = url
+        self.client = httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits)
+        self.concurrency = concurrency
+        self.outstanding = 0
+        self.breaker = CircuitBreaker()
+        # Set by the health check while the host does not respond
+        self.down = False
+        # Set while the backend is loading the model, so requests go elsewhere if they can
+        self.loading = False
+
+    def usable(self):
+        return not self.down and self.breaker.allows()
+
+    def available(self):
+        return self.outstanding < self.concurrency and self.usable()
+
+    def succeeded(self):
+        self.breaker.success()
+        metrics.LLM_BACKEND_REQUESTS.labels(self.url, 'success').inc()
+
+    def failed(self):
+        self.breaker.failure()
+        metrics.LLM_BACKEND_REQUESTS.labels(self.url, 'failure').inc()
+
+
+class Slot:
+    """
+    A request's place on a backend: lease is its id in the shared slot set,
+    trial whether it is the breaker's half-open trial
+    """
+
+    def __init__(self, backend, lease=None):
+        self.backend = backend
+        self.lease = lease
+        self.trial = False
+
+
+class BackendPool:
+    """
+    Ollama hosts behind one interface. Each request goes to the available
+    backend with the fewest outstanding requests, where available means
+    below its concurrency cap and not cut off by its circuit breaker;
+    backends loading the model are used only when no other one is free.
+    A request that fails before its first token is retried on another
+    backend. A background task checks every backend's health and reloads
+    the model (with keep_alive) on hosts that have unloaded it.
+
+    With redis set, slots and load are counted in Redis across all worker
+    processes, so concurrency caps a host rather than a process; without
+    it they are counted in this process only.
+
+    Args:
+        urls: Ollama base URLs
+        model: model the pool keeps loaded
+        keep_alive: how long Ollama keeps the model loaded after a request
+        redis: redis.asyncio client shared by the worker processes, or None
+    """
+
+    def __init__(self, urls, model, keep_alive, timeout, limits, concurrency=OLLAMA_BACKEND_CONCURRENCY,
+                 queue_timeout=OLLAMA_QUEUE_TIMEOUT_S, health_interval=OLLAMA_HEALTH_INTERVAL_S, redis=None):
+        if not urls:
+            raise ValueError("At least one Ollama URL is needed")
+        self.backends = [Backend(url, timeout, limits, concurrency) for url in urls]
+        self.model = model
+        self.keep_alive = keep_alive
+        self.queue_timeout = queue_timeout
+        self.health_interval = health_interval
+        self.changed = None
+        self.health_task = None
+        self.loads = set()
+        self.redis = None
+        if redis is not None:
+            self.share_slots(redis)
+
+    def share_slots(self, redis):
+        """
+        Counts slots in Redis from now on, shared with the other processes
+        """
+        self.redis = redis
+        self._take_slot = redis.register_script(TAKE_SLOT_SCRIPT)
+
+    def start(self):
+        """
+        Starts the health checks; needs a running event loop
+        """
+        if self.health_task is None and self.health_interval > 0:
+            self.health_task = asyncio.get_running_loop().create_task(self.check_health())
+
+    async def close(self):
+        tasks = list(self.loads) + ([self.health_task] if self.health_task is not None else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.health_task = None
+        for backend in self.backends:
+            await backend.client.aclose()
+
+    @property
+    def is_closed(self):
+        return self.backends[0].client.is_closed
+
+    async def pick(self, exclude):
+        """
+        Takes a slot on the least loaded backend not in exclude that is up
+        and below its cap, or returns None
+        """
+        candidates = [b for b in self.backends if b not in exclude and b.usable()]
+        if self.redis is None:
+            candidates = [b for b in candidates if b.available()]
+            ready = [b for b in candidates if not b.loading] or candidates
+            backend = min(ready, key=lambda b: b.outstanding, default=None)
+            return Slot(backend) if backend is not None else None
+        if not candidates:
+            return None
+
+        lease = uuid.uuid4().hex
+        now = int(time.time() * 1000)
+        args = [now, now + int(OLLAMA_SLOT_TTL_S * 1000), lease]
+        for backend in candidates:
+            args += [backend.concurrency, int(backend.loading)]
+        index = await self._take_slot(keys=[slot_key(b) for b in candidates], args=args)
+        return Slot(candidates[index - 1], lease) if index else None
+
+    async def reserve(self, exclude=()):
+        """
+        Returns a Slot on the least loaded available backend. Waits up to
+        queue_timeout while all backends are at their concurrency cap.
+        Raises NoBackendAvailable when every backend not in exclude is down
+        or has an open breaker, or none frees up in time.
+        """
+        if self.changed is None:
+            self.changed = asyncio.Condition()
+        deadline = time.monotonic() + self.queue_timeout
+        async with self.changed:
+            while (slot := await self.pick(exclude)) is None:
+                if not any(b.usable() for b in self.backends if b not in exclude):
+                    raise NoBackendAvailable("No Ollama backend is reachable")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise NoBackendAvailable("All Ollama backends are busy")
+                # Slots freed by other processes are not notified, so those are polled
+                if self.redis is not None:
+                    remaining = min(remaining, SLOT_POLL_S)
+                try:
+                    await asyncio.wait_for(self.changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            slot.backend.outstanding += 1
+            slot.trial = slot.backend.breaker.start()
+        metrics.LLM_BACKEND_OUTSTANDING.labels(slot.backend.url).inc()
+        return slot
+
+    async def release(self, slot):
+        """
+        Frees the slot. A trial request that neither succeeded nor failed
+        (the caller stopped reading, it was cancelled, or the response was
+        malformed) counts as a failure, so the breaker cannot stay stuck
+        half-open with its trial taken.
+        """
+        backend = slot.backend
+        if slot.trial and backend.breaker.trial:
+            backend.failed()
+        backend.outstanding -= 1
+        metrics.LLM_BACKEND_OUTSTANDING.labels(backend.url).dec()
+        if slot.lease is not None:
+            try:
+                await self.redis.zrem(slot_key(backend), slot.lease)
+            except Exception as e:
+                # The lease expires after OLLAMA_SLOT_TTL_S
+                print(f"Could not release the slot on {backend.url}: {e}")
+        async with self.changed:
+            self.changed.notify_all()
+
+    @asynccontextmanager
+    async def acquire(self, exclude=()):
+        slot = await self.reserve(exclude)
+        try:
+            yield slot.backend
+        finally:
+            await self.release(slot)
+
+    async def generate(self, payload):
+        """
+        Streams /api/generate from the least loaded backend and yields the
+        decoded chunks up to the one with "done". Connection errors, timeouts
+        and error statuses before the first chunk fail over to another
+        backend; after it they are raised, since the tokens already yielded
+        cannot be taken back. Use with contextlib.aclosing.
+        """
+        tried = set()
+        last_error = None
+        while True:
+            try:
+                slot = await self.reserve(exclude=tried)
+            except NoBackendAvailable as e:
+                if last_error is not None:
+                    raise NoBackendAvailable(f"{e} (last error: {last_error})") from last_error
+                raise
+            backend = slot.backend
+            tried.add(backend)
+            started = False
+            try:
+                async with backend.client.stream("POST", "/api/generate", json=payload) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        started = True
+                        chunk = json.loads(line)
+                        yield chunk
+                        if chunk.get('done'):
+                            break
+                backend.succeeded()
+                return
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                backend.failed()
+                if started:
+                    raise
+                print(f"Ollama backend {backend.url} failed ({type(e).__name__}: {e}), trying another")
+                last_error = e
+            finally:
+                await self.release(slot)
+
+    async def load_model(self, backend):
+        """
+        Sends an empty prompt, which makes Ollama load the model and keep
+        it loaded for keep_alive
+        """
+        backend.loading = True
+        try:
+            response = await backend.client.post(
+                "/api/generate", json={"model": self.model, "prompt": "", "keep_alive": self.keep_alive})
+            response.raise_for_status()
+            backend.breaker.success()
+        finally:
+            backend.loading = False
+
+    async def warm_up(self):
+        """
+        Loads the model on every backend
+
+        Returns:
+            Dictionary of URL to the seconds spent, or the error
+        """
+        async def load(backend):
+            start = time.perf_counter()
+            try:
+                await self.load_model(backend)
+                return time.perf_counter() - start
+            except httpx.HTTPError as e:
+                backend.failed()
+                return f"{type(e).__name__}: {e}"
+
+        results = await asyncio.gather(*(load(backend) for backend in self.backends))
+        return dict(zip((backend.url for backend in self.backends), results))
+
+    async def check_backend(self, backend):
+        """
+        Marks the backend down while /api/ps fails, and starts loading the
+        model in the background when the host has unloaded it
+        """
+        try:
+            response = await backend.client.get("/api/ps", timeout=OLLAMA_HEALTH_TIMEOUT_S)
+            response.raise_for_status()
+            loaded = [model.get('name', '') for model in response.json().get('models', [])]
+        except (httpx.HTTPError, ValueError, AttributeError, TypeError) as e:
+            # AttributeError and TypeError: a body that is not the expected JSON object
+            if not backend.down:
+                print(f"Ollama backend {backend.url} failed its health check: {e}")
+            backend.down = True
+            metrics.LLM_BACKEND_UP.labels(backend.url).set(0)
+            return
+
+        if backend.down:
+            print(f"Ollama backend {backend.url} is reachable again")
+        backend.down = False
+        metrics.LLM_BACKEND_UP.labels(backend.url).set(1)
+        if not backend.loading and not any(name == self.model or name.startswith(f"{self.model}:") for name in loaded):
+            print(f"Model {self.model} is not loaded on {backend.url}, loading it")
+            backend.loading = True
+            task = asyncio.create_task(self.reload(backend))
+            self.loads.add(task)
+            task.add_done_callback(self.loads.discard)
+
+    async def reload(self, backend):
+        try:
+            await self.load_model(backend)
+        except httpx.HTTPError as e:
+            print(f"Could not load {self.model} on {backend.url}: {e}")
+            backend.failed()
+
+    async def check_health(self):
+        while True:
+            try:
+                await asyncio.gather(*(self.check_backend(backend) for backend in self.backends))
+                if self.changed is not None:
+                    async with self.changed:
+                        self.changed.notify_all()
+            except Exception as e:
+                # One bad round must not end the checks, or backends marked
+                # down would never come back
+                print(f"Ollama health check failed: {e!r}")
+            await asyncio.sleep(self.health_interval)
+
+    def stats(self):
+        return [{
+            'url': backend.url,
+            'outstanding': backend.outstanding,
+            'breaker': backend.breaker.state,
+            'down': backend.down,
+            'loading': backend.loading
+        } for backend in self.backends]
+
+
+def slot_key(backend):
+    return f'llm:slots:{backend.url}'
@@ -0,0 +1,133 @@
+import os
+import time
+from os import getenv
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, start_http_server
+from prometheus_client import multiprocess
+
+GATEWAY_METRICS_PATH = '/metrics'
+WORKER_METRICS_PORT = int(getenv('WORKER_METRICS_PORT', '9101'))
+BOT_METRICS_PORT = int(getenv('BOT_METRICS_PORT', '9102'))
+# Worker processes started by the supervisor write their metrics here and
+# the supervisor serves the sum on WORKER_METRICS_PORT
+MULTIPROC_DIR_ENV = 'PROMETHEUS_MULTIPROC_DIR'
+
+# Seconds, from a few milliseconds (cache, Redis) to minutes (queueing, generation)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200)
+
+# Gateway
+TASKS_SUBMITTED = Counter('rag_gateway_tasks_total', 'Tasks submitted to the gateway by outcome',
+                          ['outcome'])
+STREAM_LAG = Gauge('rag_stream_lag', 'Entries not yet delivered to the consumer group',
+                   ['stream', 'group'], multiprocess_mode='max')
+STREAM_PENDING = Gauge('rag_stream_pending', 'Entries delivered to the consumer group but not acked',
+                       ['stream', 'group'], multiprocess_mode='max')
+FAIR_QUEUED = Gauge('rag_fair_queued', 'Tasks waiting in the per-user queues', multiprocess_mode='max')
+
+# Worker
+QUEUE_WAIT = Histogram('rag_queue_wait_seconds',
+                       'Time from enqueue to a worker starting the task; "stream" counts from the '
+                       'tasks stream entry, "total" from submission including the per-user queue',
+                       ['queue'], buckets=LATENCY_BUCKETS)
+TASK_SECONDS = Histogram('rag_task_seconds', 'Time a worker spends on a task', ['outcome'],
+                         buckets=LATENCY_BUCKETS)
+TASKS_PROCESSED = Counter('rag_worker_tasks_total', 'Tasks finished by workers by outcome', ['outcome'])
+TASKS_RECLAIMED = Counter('rag_worker_tasks_reclaimed_total',
+                          'Pending tasks claimed from other workers (retried, failed or already finished) '
+                          'or failed when trimmed (expired)', ['result'])
+RETRIEVAL_SECONDS = Histogram('rag_retrieval_seconds', 'Retrieval per question, including batching wait',
+                              buckets=LATENCY_BUCKETS)
+EMBEDDING_SECONDS = Histogram('rag_embedding_seconds', 'Embedding one batch of queries',
+                              buckets=LATENCY_BUCKETS)
+VECTOR_QUERY_SECONDS = Histogram('rag_vector_query_seconds', 'Vector store query for one batch of queries',
+                                 ['backend'], buckets=LATENCY_BUCKETS)
+LLM_TIME_TO_FIRST_TOKEN = Histogram('rag_llm_time_to_first_token_seconds',
+                                    'Time from the generate request to the first token',
+                                    buckets=LATENCY_BUCKETS)
+LLM_GENERATION_SECONDS = Histogram('rag_llm_generation_seconds', 'Time from the generate request to the last token',
+                                   buckets=LATENCY_BUCKETS)
+LLM_PROMPT_TOKENS = Histogram('rag_llm_prompt_tokens', 'Prompt tokens per generation (prompt_eval_count)',
+                              buckets=TOKEN_BUCKETS)
+LLM_EVAL_TOKENS = Histogram('rag_llm_eval_tokens', 'Generated tokens per generation (eval_count)',
+                            buckets=TOKEN_BUCKETS)
+LLM_EVAL_RATE = Histogram('rag_llm_eval_tokens_per_second', 'eval_count / eval_duration reported by Ollama',
+                          buckets=RATE_BUCKETS)
+LLM_PROMPT_RATE = Histogram('rag_llm_prompt_tokens_per_second',
+                            'prompt_eval_count / prompt_eval_duration reported by Ollama',
+                            buckets=RATE_BUCKETS + (500, 1000, 2000, 5000))
+LLM_ERRORS = Counter('rag_llm_errors_total', 'Failed generate requests by error type', ['error'])
+LLM_BACKEND_OUTSTANDING = Gauge('rag_llm_backend_outstanding', 'Generate requests in flight per Ollama backend',
+                                ['backend'], multiprocess_mode='livesum')
+LLM_BACKEND_REQUESTS = Counter('rag_llm_backend_requests_total', 'Requests per Ollama backend by outcome',
+                               ['backend', 'outcome'])
+LLM_BACKEND_UP = Gauge('rag_llm_backend_up', 'Whether the last health check of an Ollama backend passed',
+                       ['backend'], multiprocess_mode='livemin')
+
+# Gateway and worker
+CACHE_LOOKUPS = Counter('rag_answer_cache_lookups_total', 'Answer cache lookups by result', ['result'])
+REDIS_ROUND_TRIPS = Counter('rag_redis_round_trips_total', 'Redis round trips made for tasks', ['service'])
+REDIS_ROUND_TRIP_TASKS = Counter('rag_redis_round_trip_tasks_total',
+                                 'Tasks whose Redis round trips are counted in rag_redis_round_trips_total',
+                                 ['service'])
+
+# Bot
+DELIVERY_SECONDS = Histogram('rag_bot_delivery_seconds',
+                             'Time from a result entering the results stream to its last message being sent',
+                             buckets=LATENCY_BUCKETS)
+TELEGRAM_SEND_SECONDS = Histogram('rag_telegram_send_seconds',
+                                  'Time a Telegram request spends in the outbox, queueing and retries included',
+                                  buckets=LATENCY_BUCKETS)
+TELEGRAM_REQUESTS = Counter('rag_telegram_requests_total', 'Telegram requests by outcome', ['outcome'])
+TELEGRAM_RETRIES = Counter('rag_telegram_retries_total', 'Telegram requests retried by reason', ['reason'])
+OUTBOX_QUEUE_DEPTH = Gauge('rag_outbox_queue_depth', 'Telegram requests waiting in the outbox')
+
+
+def entry_age(entry_id, now=None):
+    """
+    Seconds since a stream entry was added, from the millisecond time in its ID
+    """
+    return (now or time.time()) - int(entry_id.split('-')[0]) / 1000
+
+
+async def update_stream_gauges(redis, streams):
+    """
+    Sets the lag and pending gauges from XINFO GROUPS.
+
+    Args:
+        streams: (stream, group) pairs
+    """
+    for stream, group in streams:
+        try:
+            groups = await redis.xinfo_groups(stream)
+        except Exception:
+            continue
+        for info in groups:
+            if info['name'] == group:
+                # lag is None when Redis cannot compute it (e.g. after XDEL)
+                if info.get('lag') is not None:
+                    STREAM_LAG.labels(stream, group).set(info['lag'])
+                STREAM_PENDING.labels(stream, group).set(info['pending'])
+
+
+def serve_metrics(port):
+    """
+    Serves /metrics on port unless it is 0. In a process started by the
+    supervisor nothing is served, its metrics are collected from
+    PROMETHEUS_MULTIPROC_DIR.
+    """
+    if port and not os.environ.get(MULTIPROC_DIR_ENV):
+        start_http_server(port)
+
+
+def serve_multiprocess_metrics(port):
+    """
+    Serves the metrics of all processes writing to PROMETHEUS_MULTIPROC_DIR
+    """
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(port, registry=registry)
+
+
+def mark_process_dead(pid):
+    multiprocess.mark_process_dead(pid)
@@ -0,0 +1,178 @@
+import json
+import os
+import statistics
+from pathlib import Path
+import numpy as np
+
+numpy_index_path = Path(os.getenv('NUMPY_INDEX_PATH', 'data/numpy_index'))
+numpy_index_dtype = os.getenv('NUMPY_INDEX_DTYPE', 'float16')
+
+
+def export_index(collection, directory=numpy_index_path, dtype=numpy_index_dtype, page_size=1000):
+    """
+    Writes the embeddings, documents and metadata of a Chroma collection as
+    flat arrays that NumpyIndex can memory-map.
+
+    Layout of directory:
+        embeddings.npy   (n, dim) float16, or int8 with per-dimension scales.npy
+        text.bin         UTF-8 chunk texts back to back, sliced by offsets.npy
+        chunk_meta.npy   (n, 3) int32: source row, heading row, chunk index
+        sources.json     unique [title, url] pairs
+        headings.json    unique section headings
+        index.json       count, dimension and dtype
+    """
+    if dtype not in ('float16', 'int8'):
+        raise ValueError(f"Unsupported dtype: {dtype}")
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    embeddings = []
+    offsets = [0]
+    chunk_meta = []
+    sources = {}
+    headings = {}
+    total = collection.count()
+
+    with open(directory / 'text.bin', 'wb') as text_file:
+        for offset in range(0, total, page_size):
+            page = collection.get(include=['embeddings', 'documents', 'metadatas'],
+                                  limit=page_size, offset=offset)
+            for embedding, document, metadata in zip(page['embeddings'], page['documents'], page['metadatas']):
+                encoded = document.encode('utf-8')
+                text_file.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+                source = sources.setdefault((metadata['title'], metadata['url']), len(sources))
+                heading = headings.setdefault(metadata.get('heading', ''), len(headings))
+                chunk_meta.append((source, heading, metadata.get('chunk_index', 0)))
+                embeddings.append(embedding)
+
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    # Unit vectors turn both cosine and L2 search into a dot product
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    if dtype == 'int8':
+        scales = np.maximum(np.abs(matrix).max(axis=0), 1e-12) / 127
+        np.save(directory / 'scales.npy', scales.astype(np.float32))
+        matrix = np.round(matrix / scales).astype(np.int8)
+    else:
+        matrix = matrix.astype(np.float16)
+
+    np.save(directory / 'embeddings.npy', matrix)
+    np.save(directory / 'offsets.npy', np.asarray(offsets, dtype=np.int64))
+    np.save(directory / 'chunk_meta.npy', np.asarray(chunk_meta, dtype=np.int32).reshape(-1, 3))
+    with open(directory / 'sources.json', 'w', encoding='utf-8') as f:
+        json.dump([list(pair) for pair in sources], f, ensure_ascii=False)
+    with open(directory / 'headings.json', 'w', encoding='utf-8') as f:
+        json.dump(list(headings), f, ensure_ascii=False)
+    with open(directory / 'index.json', 'w', encoding='utf-8') as f:
+        json.dump({'count': len(chunk_meta), 'dimension': int(matrix.shape[1]) if len(matrix) else 0,
+                   'dtype': dtype}, f)
+
+    print(f"Exported {len(chunk_meta)} chunks to {directory} ({dtype})")
+    return directory
+
+
+class NumpyIndex:
+    """
+    Exact top-k search over an exported index. The arrays are opened with
+    mmap, so worker processes on one host share them through the page cache
+    instead of each loading its own copy.
+
+    query() returns the same structure as collection.query so it can be used
+    in place of the Chroma collection. Distances are squared L2 between unit
+    vectors, the same scale the relevance threshold was tuned on.
+    """
+
+    block_rows = 16384
+
+    def __init__(self, directory=numpy_index_path):
+        directory = Path(directory)
+        with open(directory / 'index.json', 'r', encoding='utf-8') as f:
+            self.info = json.load(f)
+        self.embeddings = np.load(directory / 'embeddings.npy', mmap_mode='r')
+        self.scales = np.load(directory / 'scales.npy') if self.info['dtype'] == 'int8' else None
+        self.offsets = np.load(directory / 'offsets.npy', mmap_mode='r')
+        self.chunk_meta = np.load(directory / 'chunk_meta.npy', mmap_mode='r')
+        self.text = np.memmap(directory / 'text.bin', dtype=np.uint8, mode='r') if self.offsets[-1] else b''
+        with open(directory / 'sources.json', 'r', encoding='utf-8') as f:
+            self.sources = json.load(f)
+        with open(directory / 'headings.json', 'r', encoding='utf-8') as f:
+            self.headings = json.load(f)
+
+    def count(self):
+        return self.info['count']
+
+    def document(self, row):
+        return bytes(self.text[self.offsets[row]:self.offsets[row + 1]]).decode('utf-8')
+
+    def metadata(self, row):
+        source, heading, chunk_index = self.chunk_meta[row]
+        title, url = self.sources[source]
+        return {'title': title, 'url': url, 'heading': self.headings[heading], 'chunk_index': int(chunk_index)}
+
+    def query(self, query_embeddings, n_results):
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        # Not in place: asarray returns the caller's array when it is float32
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        if self.scales is not None:
+            # Fold the dequantization into the queries: (q * s) . x == q . (s * x)
+            queries = queries * self.scales
+        # Scores every chunk against every query in the batch. Blocks are
+        # widened to float32 first so the product runs through BLAS.
+        scores = np.empty((self.count(), len(queries)), dtype=np.float32)
+        for start in range(0, self.count(), self.block_rows):
+            block = self.embeddings[start:start + self.block_rows].astype(np.float32)
+            scores[start:start + len(block)] = block @ queries.T
+        k = min(n_results, self.count())
+
+        results = {'ids': [], 'documents': [], 'metadatas': [], 'distances': []}
+        if k == 0:
+            for values in results.values():
+                values.extend([] for _ in queries)
+            return results
+        for column in scores.T:
+            top = np.argpartition(-column, k - 1)[:k] if k < len(column) else np.arange(len(column))
+            top = top[np.argsort(-column[top])]
+            results['ids'].append([str(row) for row in top])
+            results['documents'].append([self.document(row) for row in top])
+            results['metadatas'].append([self.metadata(row) for row in top])
+            results['distances'].append([float(2 - 2 * column[row]) for row in top])
+        return results
+
+
+def compare(k=5):
+    """
+    Latency and recall of the exported index against the Chroma collection
+    on the evaluation question set, plus how much of Chroma's top-k the
+    exact search returns as well
+    """
+    import chromadb
+    from rag.rag import chroma_path, init_embedding_function, contexts_from_results
+    from rag.evaluation import evaluate, QUESTIONS
+
+    embedding_function = init_embedding_function()
+    collection = chromadb.PersistentClient(path=chroma_path).get_collection(
+        name='py_docs', embedding_function=embedding_function
+    )
+    index = NumpyIndex()
+
+    def chroma_batch(queries, n):
+        return contexts_from_results(collection.query(query_texts=queries, n_results=n))
+
+    def numpy_batch(queries, n):
+        return contexts_from_results(index.query(embedding_function(queries), n))
+
+    reports = {'chroma': evaluate(chroma_batch, k), f"numpy ({index.info['dtype']})": evaluate(numpy_batch, k)}
+    for name, report in reports.items():
+        print(f"{name}: " + ", ".join(f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}"
+                                      for key, value in report.items()))
+
+    overlaps = []
+    for question, _ in QUESTIONS:
+        chroma_hits = {(c['url'], c['content']) for c in chroma_batch([question], k)[0]}
+        numpy_hits = {(c['url'], c['content']) for c in numpy_batch([question], k)[0]}
+        overlaps.append(len(chroma_hits & numpy_hits) / max(len(chroma_hits), 1))
+    print(f"Overlap with Chroma top-{k}: {statistics.mean(overlaps):.3f}")
+
+
+if __name__ == "__main__":
+    compare()
@@ -1,41 +1,63 @@
 import requests
+import asyncio
+import queue
+import threading
 from bs4 import BeautifulSoup
 from pathlib import Path
-import time
-import json
+from rag.crawler import Crawler
+from rag.corpus import write_corpus
 
 base_url="https://docs.python.org/3/"
-visited_urls = set()
 output_dir = Path("data/docs")
 output_dir.mkdir(parents=True, exist_ok=True)
 
+def parse_html(url, html):
+    res = BeautifulSoup(html, 'html.parser')
+    for element in res.find_all(['nav', 'aside', 'footer', 'script', 'style']):
+        element.decompose()
+    main_content = res.find('div', {'class': 'body'}) or res.find('main') or res.find('article')
+    if not main_content:
+        main_content = res.find('body')
+    chunks = []
+    for element in main_content.find_all(['p', 'pre', 'h2', 'h3', 'dl']):
+        text = element.get_text(strip=True)
+        if text and len(text) > 20:
+            chunks.append(text)
+    title = res.find('h1')
+    title = title.get_text(strip=True) if title else "No title"
+    return {
+        'url': url,
+        'title': title,
+        'content': '\n\n'.join(chunks),
+        'sections': parse_sections(main_content)
+    }
+
+def parse_sections(main_content):
+    """
+    Groups paragraphs, code blocks and API signatures under the h2/h3/h4
+    heading they belong to, keeping the line breaks of code blocks
+    """
+    sections = [{'heading': '', 'blocks': []}]
+    for element in main_content.find_all(['h2', 'h3', 'h4', 'p', 'pre', 'dt']):
+        if element.name == 'pre':
+            text = element.get_text().strip()
+        else:
+            text = element.get_text(' ', strip=True).replace('¶', '').strip()
+        if element.name in ('h2', 'h3', 'h4'):
+            sections.append({'heading': text, 'blocks': []})
+        elif text and len(text) > 20:
+            sections[-1]['blocks'].append({'type': element.name, 'text': text})
+    return [section for section in sections if section['blocks']]
+
 def parse_url(url):
     try:
         responce = requests.get(url, timeout=10)
-        res = BeautifulSoup(responce.text, 'html.parser')
-        for element in res.find_all(['nav', 'aside', 'footer', 'script', 'style']):
-            element.decompose()
-        main_content = res.find('div', {'class': 'body'}) or res.find('main') or res.find('article')
-        if not main_content:
-            main_content = res.find('body')
-        chunks = []
-        for element in main_content.find_all(['p', 'pre', 'h2', 'h3', 'dl']):
-            text = element.get_text(strip=True)
-            if text and len(text) > 20:
-                chunks.append(text)
-        title = res.find('h1')
-        title = title.get_text(strip=True) if title else "No title"
-        return {
-            'url': url,
-            'title': title,
-            'content': '\n\n'.join(chunks)
-        }
+        return parse_html(url, responce.text)
     except Exception as e:
         print(f'Error processing{url}: {e}')
         return None
     
-def scrape_all_sections():
-    important_urls = [
+important_urls = [
     # ==================== TUTORIAL ====================
     f"{base_url}tutorial/index.html",
     f"{base_url}tutorial/appetite.html",
@@ -380,31 +402,49 @@ def scrape_all_sections():
     f"{base_url}faq/extending.html",
     f"{base_url}faq/windows.html",
     f"{base_url}faq/gui.html",
-    ]
-    documents = []
-    for url in important_urls:
-        if url in visited_urls:
-            continue
-        print(f'Scraping: {url}')
-        doc = parse_url(url)
-        if doc and doc['content']:
-            documents.append(doc)
-            visited_urls.add(url)
-        time.sleep(0.5)
+]
+
+def scrape_all_sections():
+    print(f'Scraping {len(important_urls)} pages')
+    return asyncio.run(Crawler(parse_html).crawl(important_urls))
+
+def iter_all_sections(buffer_size=32):
+    """
+    Yields documents while the crawl is still running. The crawler runs on
+    its own event loop in a background thread and hands documents over
+    through a bounded queue, so this can feed synchronous consumers such as
+    vector_db.process.
+    """
+    documents = queue.Queue(maxsize=buffer_size)
+    finished = object()
+    errors = []
+
+    async def produce():
+        async for doc in Crawler(parse_html).iter_crawl(important_urls, buffer_size):
+            await asyncio.to_thread(documents.put, doc)
+
+    def run():
+        try:
+            asyncio.run(produce())
+        except Exception as e:
+            errors.append(e)
+        finally:
+            documents.put(finished)
 
-    return documents
+    print(f'Scraping {len(important_urls)} pages')
+    threading.Thread(target=run, daemon=True).start()
+    while (doc := documents.get()) is not finished:
+        yield doc
+    if errors:
+        raise errors[0]
 
 def save_documents(documents):
-    output_file = output_dir / 'python_docs.json'
-    with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(documents, f, indent=2, ensure_ascii=False)
-    print(f"Saved {len(documents)} documents to {output_file}")
-    return output_file
+    return write_corpus(documents, output_dir / 'python_docs.jsonl')
 
 def main():
-    documents = scrape_all_sections()
+    documents = iter_all_sections()
     output_file = save_documents(documents)
     print(f'saved to: {output_file}')
 
-if __name__ == main():
+if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,36 +1,168 @@
-import chromadb
 import httpx
 import os
 import asyncio
-from chromadb.utils import embedding_functions
+import threading
+import time
+from contextlib import aclosing
+from concurrent.futures import ThreadPoolExecutor
+from rag import metrics, tracing
+from rag.batching import MicroBatcher
+from rag.llm import BackendPool, NoBackendAvailable
 chroma_path = os.getenv('CHROMA_PATH', 'data/chroma_db')
-    
-client = chromadb.PersistentClient(path=chroma_path)
-embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-    model_name="all-MiniLM-L6-v2"
+
+# "chroma" queries the persistent collection, "numpy" an index exported
+# with python -m rag.vector_db --export-numpy
+retrieval_backend = os.getenv('RETRIEVAL_BACKEND', 'chroma')
+
+# Created by init() rather than on import, so importing the package stays
+# cheap and services decide when to pay for loading the model
+client = None
+embedding_function = None
+collection = None
+init_lock = threading.Lock()
+
+def init_embedding_function():
+    global embedding_function
+    with init_lock:
+        if embedding_function is None:
+            from rag.embeddings import get_embedding_function
+            embedding_function = get_embedding_function()
+    return embedding_function
+
+def init():
+    """
+    Loads the embedding model and opens the vector store
+
+    Returns:
+        Dictionary with the seconds spent in each phase
+    """
+    global client, collection
+    timings = {}
+    start = time.perf_counter()
+    init_embedding_function()
+    timings['embedder_load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with init_lock:
+        if collection is None:
+            if retrieval_backend == 'numpy':
+                from rag.numpy_index import NumpyIndex
+                collection = NumpyIndex()
+            else:
+                import chromadb
+                client = chromadb.PersistentClient(path=chroma_path)
+                collection = client.get_collection(
+                    name='py_docs',
+                    embedding_function=embedding_function
+                )
+    timings['collection_open'] = time.perf_counter() - start
+    return timings
+
+# Embedding and the HNSW search are CPU bound and synchronous, so they run
+# here instead of on the event loop
+retrieval_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('RETRIEVAL_THREADS', '2')),
+    thread_name_prefix='retrieval'
 )
 
-collection = client.get_collection(
-    name='py_docs',
-    embedding_function=embedding_function
+ollama_url = os.getenv('OLLAMA_URL', 'http://host.docker.internal:11434')
+# Comma separated Ollama hosts to spread generation over; defaults to OLLAMA_URL
+ollama_urls = [url.strip() for url in os.getenv('OLLAMA_URLS', ollama_url).split(',') if url.strip()]
+ollama_model = os.getenv('OLLAMA_MODEL', 'llama3.2')
+# How long Ollama keeps the model loaded after a request
+ollama_keep_alive = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+
+# One pooled client per backend and process. The read timeout applies between streamed
+# chunks, so it bounds time to first token and stalls, not the whole answer.
+ollama_timeout = httpx.Timeout(
+    connect=float(os.getenv('OLLAMA_CONNECT_TIMEOUT', '5')),
+    read=float(os.getenv('OLLAMA_READ_TIMEOUT', '60')),
+    write=float(os.getenv('OLLAMA_WRITE_TIMEOUT', '10')),
+    pool=float(os.getenv('OLLAMA_POOL_TIMEOUT', '30'))
+)
+ollama_limits = httpx.Limits(
+    max_connections=int(os.getenv('OLLAMA_MAX_CONNECTIONS', '16')),
+    max_keepalive_connections=int(os.getenv('OLLAMA_MAX_KEEPALIVE', '8')),
+    keepalive_expiry=60
 )
+ollama_pool = None
 
-ollama_url = 'http://host.docker.internal:11434'
-ollama_model = 'llama3.2'
+def open_http_client(redis=None):
+    """
+    Returns the process's Ollama backend pool, creating it if needed. Health
+    checks start once it is opened on a running event loop. With redis,
+    backend slots are shared with the other worker processes.
+    """
+    global ollama_pool
+    if ollama_pool is None or ollama_pool.is_closed:
+        ollama_pool = BackendPool(ollama_urls, ollama_model, ollama_keep_alive, ollama_timeout, ollama_limits)
+    if redis is not None and ollama_pool.redis is not redis:
+        ollama_pool.share_slots(redis)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return ollama_pool
+    ollama_pool.start()
+    return ollama_pool
+
+async def close_http_client():
+    global ollama_pool
+    if ollama_pool is not None:
+        await ollama_pool.close()
+        ollama_pool = None
+
+retrieval_batch_window_ms = float(os.getenv('RETRIEVAL_BATCH_WINDOW_MS', '5'))
+retrieval_max_batch = int(os.getenv('RETRIEVAL_MAX_BATCH', '16'))
+
+def search(queries, n_top_results):
+    if collection is None:
+        init()
+    # One call encodes all texts in a single forward pass
+    with metrics.EMBEDDING_SECONDS.time():
+        embeddings = embedding_function(queries)
+    with metrics.VECTOR_QUERY_SECONDS.labels(retrieval_backend).time():
+        if retrieval_backend == 'numpy':
+            return collection.query(embeddings, n_top_results)
+        return collection.query(query_embeddings=embeddings, n_results=n_top_results)
+
+def contexts_from_results(results):
+    contexts = []
+
+    for docs, metadatas, distances in zip(results['documents'], results['metadatas'], results['distances']):
+        context = []
+        for doc, metadata, distance in zip(docs, metadatas, distances):
+            context.append({
+                'content': doc,
+                'title': metadata['title'],
+                'heading': metadata.get('heading', ''),
+                'url': metadata['url'],
+                'distance': distance
+            })
+        contexts.append(context)
+
+    return contexts
+
+def retrieve_batch(queries, n_top_results):
+    return contexts_from_results(search(queries, n_top_results))
 
 def retrieve(query, n_top_results):
-    results = collection.query(query_texts=[query], n_results=n_top_results)
-    context = []
-    
-    for doc, metadata, distance in zip(results['documents'][0], results['metadatas'][0], results['distances'][0]):
-        context.append({
-            'content': doc,
-            'title': metadata['title'],
-            'url': metadata['url'],
-            'distance': distance
-        })
-    
-    return context
+    return retrieve_batch([query], n_top_results)[0]
+
+def retrieve_requests(requests):
+    """
+    Runs (query, n_top_results) requests as one retrieve_batch call
+    """
+    contexts = retrieve_batch([query for query, _ in requests], max(n for _, n in requests))
+    return [context[:n] for (_, n), context in zip(requests, contexts)]
+
+retrieval_batcher = MicroBatcher(retrieve_requests, retrieval_executor, retrieval_batch_window_ms,
+                                 retrieval_max_batch, name='Retrieval batcher')
+
+async def retrieve_async(query, n_top_results):
+    if retrieval_batch_window_ms > 0:
+        return await retrieval_batcher.submit((query, n_top_results))
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(retrieval_executor, retrieve, query, n_top_results)
 
 def check_relevance(query, context, threshold=0.5):
     if not context:
@@ -40,8 +172,13 @@ def check_relevance(query, context, threshold=0.5):
         return False, f"Best relevance too low (distance: {best_distance:.3f})"
     return True, "Relevant context found"
 
+def source_label(chunk):
+    if chunk.get('heading'):
+        return f"{chunk['title']} / {chunk['heading']}"
+    return chunk['title']
+
 def system_prompt(query, context):
-    context_text = "\n\n".join([f"[Source: {i['title']}]\n{i['content']}" for i in context])
+    context_text = "\n\n".join([f"[Source: {source_label(i)}]\n{i['content']}" for i in context])
     
     prompt = f"""You are a helpful Python programming assistant. Answer the user's question based on the provided Python documentation context.
 
@@ -63,8 +200,32 @@ Answer:"""
     
     return prompt
 
-async def generate_answer(query):
-    context = retrieve(query, 5)
+def observe_generation(chunk, started, first_token_at, generation):
+    """
+    Records the timings of a finished generation in the metrics and on the
+    generation's span. The last chunk Ollama streams carries token counts
+    and durations in nanoseconds.
+    """
+    finished = time.perf_counter()
+    generation.set(prompt_tokens=chunk.get('prompt_eval_count'), eval_tokens=chunk.get('eval_count'))
+    if first_token_at is not None:
+        metrics.LLM_TIME_TO_FIRST_TOKEN.observe(first_token_at - started)
+        generation.set(time_to_first_token_s=first_token_at - started)
+    metrics.LLM_GENERATION_SECONDS.observe(finished - started)
+    if chunk.get('prompt_eval_count'):
+        metrics.LLM_PROMPT_TOKENS.observe(chunk['prompt_eval_count'])
+        if chunk.get('prompt_eval_duration'):
+            metrics.LLM_PROMPT_RATE.observe(chunk['prompt_eval_count'] / chunk['prompt_eval_duration'] * 1e9)
+    if chunk.get('eval_count'):
+        metrics.LLM_EVAL_TOKENS.observe(chunk['eval_count'])
+        if chunk.get('eval_duration'):
+            metrics.LLM_EVAL_RATE.observe(chunk['eval_count'] / chunk['eval_duration'] * 1e9)
+            generation.set(eval_tokens_per_s=chunk['eval_count'] / chunk['eval_duration'] * 1e9)
+
+async def generate_answer(query, on_token=None):
+    with metrics.RETRIEVAL_SECONDS.time(), tracing.span('rag.retrieve') as retrieval:
+        context = await retrieve_async(query, 5)
+        retrieval.set(best_distance=context[0]['distance'] if context else None)
     prompt = system_prompt(query, context)
     is_relevant, relevance_msg = check_relevance(query, context)
     if not is_relevant:
@@ -77,22 +238,34 @@ async def generate_answer(query):
             'validation_issues': [relevance_msg]
         }
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(
-                f"{ollama_url}/api/generate",
-                json={
-                    "model": ollama_model,
-                    "prompt": prompt,
-                    "stream": False,
-                    "options": {
-                        "temperature": 0.1,
-                        "num_predict": 500
-                    }
+        pool = open_http_client()
+        started = time.perf_counter()
+        first_token_at = None
+        with tracing.span('llm.generate', model=ollama_model) as generation:
+            chunks = pool.generate({
+                "model": ollama_model,
+                "prompt": prompt,
+                "stream": True,
+                "keep_alive": ollama_keep_alive,
+                "options": {
+                    "temperature": 0.1,
+                    "num_predict": 500
                 }
-            )
-            response.raise_for_status()
-            result = response.json()
-            answer = result.get('response', 'No response generated')
+            })
+            # Ollama streams one JSON object per line until "done"
+            tokens = []
+            async with aclosing(chunks):
+                async for chunk in chunks:
+                    token = chunk.get('response', '')
+                    if token:
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                        tokens.append(token)
+                        if on_token is not None:
+                            await on_token(token)
+                    if chunk.get('done'):
+                        observe_generation(chunk, started, first_token_at, generation)
+        answer = ''.join(tokens) or 'No response generated'
         
         sources = list({chunk['url'] for chunk in context[:3]})
         
@@ -102,21 +275,59 @@ async def generate_answer(query):
             'context_chunks': context
         }
         
+    # Errors are raised, not turned into answer text, so the task ends as failed
+    except NoBackendAvailable:
+        metrics.LLM_ERRORS.labels('no_backend').inc()
+        raise
     except httpx.ConnectError:
-        return {
-            'answer': "Cannot connect to Ollama. Make sure Ollama is running (ollama serve)",
-            'sources': [],
-            'context_chunks': []
-        }
+        metrics.LLM_ERRORS.labels('connect').inc()
+        raise
+    except httpx.TimeoutException:
+        metrics.LLM_ERRORS.labels('timeout').inc()
+        raise
     except Exception as e:
-        return {
-            'answer': f"Encountered an error: {str(e)}",
-            'sources': [],
-            'context_chunks': []
-        }
+        metrics.LLM_ERRORS.labels(type(e).__name__).inc()
+        raise
+
+async def warm_up():
+    """
+    Initializes the RAG resources and runs each of them once: a forward pass
+    of the embedder, one retrieval and an empty generate request that makes
+    every Ollama backend load the model and keep it loaded for ollama_keep_alive
+
+    Returns:
+        Dictionary with the seconds spent in each phase
+    """
+    loop = asyncio.get_running_loop()
+    timings = await loop.run_in_executor(retrieval_executor, init)
+
+    start = time.perf_counter()
+    await loop.run_in_executor(retrieval_executor, embedding_function, ["warm up"])
+    timings['embedder_warmup'] = time.perf_counter() - start
 
-async def answer(query):
-    result = await generate_answer(query)
+    start = time.perf_counter()
+    await loop.run_in_executor(retrieval_executor, retrieve, "How do I open a file?", 1)
+    timings['retrieval_warmup'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for url, result in (await open_http_client().warm_up()).items():
+        if isinstance(result, str):
+            print(f"Ollama warm-up failed on {url}: {result}")
+    timings['ollama_load'] = time.perf_counter() - start
+    return timings
+
+async def answer(query, cache=None, on_token=None):
+    if cache is not None:
+        with tracing.span('rag.cache_lookup') as lookup:
+            embedding = await cache.embed_query(query)
+            cached = await cache.lookup(query, embedding)
+            lookup.set(hit=cached is not None)
+        if cached is not None:
+            print(f"Query: {query}")
+            print("Answer served from cache")
+            return cached
+
+    result = await generate_answer(query, on_token)
     ans = result['answer']
     sources = result['sources']
     
@@ -126,10 +337,14 @@ async def answer(query):
     
     if sources:
         ans += "\n\nSources:\n" + "\n".join(f"- {url}" for url in sources[:3])
+        # Only grounded answers are cached, errors and refusals are not
+        if cache is not None:
+            await cache.store(query, ans, embedding)
     
     return ans
 
 async def test_rag():
+    init()
     test_questions = [
         "How do I open and read a file in Python?",  # Valid
         "How pytorch works?",  # Invalid - not in docs
@@ -145,5 +360,7 @@ async def test_rag():
         ans = await answer(question)
         print(f"A: {ans}")
 
+    await close_http_client()
+
 if __name__ == "__main__":
     asyncio.run(test_rag())
\ No newline at end of file
@@ -0,0 +1,87 @@
+from contextvars import ContextVar
+from urllib.parse import urlparse
+import redis.asyncio as aioredis
+from redis.asyncio.connection import (Connection, ConnectionPool, SSLConnection, UnixDomainSocketConnection,
+                                      parse_url)
+from rag import metrics
+
+_counter = ContextVar('redis_round_trips', default=None)
+
+
+class CountingMixin:
+    """
+    Counts the requests a connection sends. A pipeline goes out as one
+    request, so the count is the number of network round trips to Redis.
+    """
+
+    async def send_packed_command(self, command, check_health=True):
+        counter = _counter.get()
+        if counter is not None:
+            counter[0] += 1
+        await super().send_packed_command(command, check_health)
+
+
+class CountingConnection(CountingMixin, Connection):
+    pass
+
+
+class CountingSSLConnection(CountingMixin, SSLConnection):
+    pass
+
+
+class CountingUnixDomainSocketConnection(CountingMixin, UnixDomainSocketConnection):
+    pass
+
+
+CONNECTION_CLASSES = {
+    'redis': CountingConnection,
+    'rediss': CountingSSLConnection,
+    'unix': CountingUnixDomainSocketConnection
+}
+
+
+def connect(url):
+    """
+    Client for url whose connections count round trips, keeping the
+    connection type of the URL scheme (TLS for rediss://)
+    """
+    options = parse_url(url)
+    # Set after parsing: depending on the redis-py version, from_url lets
+    # either the URL's connection class or the keyword argument win
+    options['connection_class'] = CONNECTION_CLASSES[urlparse(url).scheme]
+    return aioredis.Redis.from_pool(ConnectionPool(decode_responses=True, **options))
+
+
+def count_round_trips():
+    """
+    Starts counting the round trips made by the current asyncio task (and
+    tasks it creates). Returns a one-element list updated in place.
+    """
+    counter = [0]
+    _counter.set(counter)
+    return counter
+
+
+class RoundTripStats:
+    """
+    Round trips per task of one service, also exported as the
+    rag_redis_round_trips_total and rag_redis_round_trip_tasks_total counters
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.tasks = 0
+        self.round_trips = 0
+
+    def add(self, counter, tasks=1):
+        self.tasks += tasks
+        self.round_trips += counter[0]
+        metrics.REDIS_ROUND_TRIPS.labels(self.service).inc(counter[0])
+        metrics.REDIS_ROUND_TRIP_TASKS.labels(self.service).inc(tasks)
+
+    def stats(self):
+        return {
+            'tasks': self.tasks,
+            'redis_round_trips': self.round_trips,
+            'redis_round_trips_per_task': self.round_trips / self.tasks if self.tasks else 0.0
+        }
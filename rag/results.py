@@ -0,0 +1,114 @@
+import asyncio
+from contextlib import contextmanager
+from os import getenv
+from rag.storage import pack_text, unpack_text
+from rag.tracing import TRACEPARENT
+
+RESULTS_STREAM = 'results'
+RESULTS_GROUP = 'bots'
+# Results are spread over this many streams by chat_id
+RESULT_SHARDS = int(getenv('RESULT_SHARDS', '1'))
+RESULTS_STREAM_MAXLEN = int(getenv('RESULTS_STREAM_MAXLEN', '100000'))
+# Pub/sub channel carrying the ids of finished tasks
+TASK_DONE_CHANNEL = 'task_done'
+# Sent to the user when their task failed
+FAILED_ANSWER = "Sorry, I could not answer this question."
+
+
+def results_stream(chat_id):
+    if RESULT_SHARDS <= 1:
+        return RESULTS_STREAM
+    return f'{RESULTS_STREAM}:{int(chat_id) % RESULT_SHARDS}'
+
+
+def results_streams():
+    if RESULT_SHARDS <= 1:
+        return [RESULTS_STREAM]
+    return [f'{RESULTS_STREAM}:{shard}' for shard in range(RESULT_SHARDS)]
+
+
+def add_result(pipe, task, answer):
+    """
+    Adds the result of a task to its results stream, read by the bot
+    replicas through the bots consumer group
+    """
+    fields = {
+        'task_id': task['task_id'],
+        'user_id': int(task['user_id']),
+        'chat_id': int(task['chat_id']),
+        'stream': int(bool(task.get('stream'))),
+        **pack_text('result', answer)
+    }
+    if task.get(TRACEPARENT):
+        fields[TRACEPARENT] = task[TRACEPARENT]
+    pipe.xadd(
+        results_stream(task['chat_id']),
+        fields,
+        maxlen=RESULTS_STREAM_MAXLEN or None,
+        approximate=True
+    )
+
+
+def read_result(fields):
+    return {
+        'task_id': fields['task_id'],
+        'user_id': int(fields['user_id']),
+        'chat_id': int(fields['chat_id']),
+        'stream': fields.get('stream') == '1',
+        'result': unpack_text(fields, 'result')
+    }
+
+
+class CompletionNotifier:
+    """
+    Wakes requests waiting for tasks to finish. Workers publish the task_id
+    on TASK_DONE_CHANNEL when a task completes or fails; one subscription
+    per process dispatches that to the futures registered for the task, so
+    a waiting request costs a dict entry instead of repeated Redis reads.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.waiters = {}
+
+    @contextmanager
+    def watch(self, task_id):
+        """
+        Registers interest in task_id and yields a future that is resolved
+        when the task finishes. Register before reading the task's status,
+        so a completion in between is not missed.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(task_id, set()).add(future)
+        try:
+            yield future
+        finally:
+            futures = self.waiters.get(task_id)
+            if futures is not None:
+                futures.discard(future)
+                if not futures:
+                    del self.waiters[task_id]
+
+    def notify(self, task_id):
+        for future in self.waiters.pop(task_id, ()):
+            if not future.done():
+                future.set_result(None)
+
+    async def run(self):
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(TASK_DONE_CHANNEL)
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.notify(message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f'Completion listener error: {e}')
+                # Notifications may have been missed, so every waiter re-reads its task
+                for task_id in list(self.waiters):
+                    self.notify(task_id)
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
@@ -0,0 +1,245 @@
+import asyncio
+import json
+import math
+import time
+from os import getenv
+from rag.storage import TASKS_STREAM_MAXLEN
+
+FAIR_PREFIX = 'fair'
+FAIR_QUEUE_ENABLED = getenv('FAIR_QUEUE_ENABLED', '1') == '1'
+# Undelivered entries allowed in the tasks stream; the rest wait in per-user queues
+FAIR_STREAM_DEPTH = int(getenv('FAIR_STREAM_DEPTH', '4'))
+RATE_LIMIT_PER_MINUTE = float(getenv('RATE_LIMIT_PER_MINUTE', '6'))
+RATE_LIMIT_BURST = int(getenv('RATE_LIMIT_BURST', '5'))
+ADMISSION_MAX_QUEUE = int(getenv('ADMISSION_MAX_QUEUE', '200'))
+ADMISSION_MAX_WAIT_S = float(getenv('ADMISSION_MAX_WAIT_S', '120'))
+# Rough time one worker slot spends on a task, used to estimate the wait
+ADMISSION_TASK_SECONDS = float(getenv('ADMISSION_TASK_SECONDS', '20'))
+ADMISSION_REFRESH_S = float(getenv('ADMISSION_REFRESH_S', '1'))
+
+# Moves tasks from the per-user queues into the stream, one user at a time in
+# round-robin order, until the group has max_lag undelivered entries. While
+# the group is missing or Redis cannot compute its lag, the stream counts as
+# full and tasks stay in their queues.
+# KEYS: stream, ring of users with queued tasks, queued task counter
+# ARGV: group, max_lag, queue key prefix, max tasks to move, stream MAXLEN (0 for none)
+DISPATCH = """
+local lag = tonumber(ARGV[2])
+local ok, groups = pcall(redis.call, 'XINFO', 'GROUPS', KEYS[1])
+if ok then
+    for _, group in ipairs(groups) do
+        for i = 1, #group, 2 do
+            if group[i] == 'name' and group[i + 1] ~= ARGV[1] then break end
+            if group[i] == 'lag' then lag = tonumber(group[i + 1]) or lag end
+        end
+    end
+end
+local moved = 0
+while lag + moved < tonumber(ARGV[2]) and moved < tonumber(ARGV[4]) do
+    local user = redis.call('LPOP', KEYS[2])
+    if not user then break end
+    local queue = ARGV[3] .. user
+    local payload = redis.call('LPOP', queue)
+    if payload then
+        local fields = {}
+        for name, value in pairs(cjson.decode(payload)) do
+            table.insert(fields, name)
+            table.insert(fields, value)
+        end
+        if tonumber(ARGV[5]) > 0 then
+            redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[5], '*', unpack(fields))
+        else
+            redis.call('XADD', KEYS[1], '*', unpack(fields))
+        end
+        redis.call('DECR', KEYS[3])
+        moved = moved + 1
+    end
+    if redis.call('LLEN', queue) > 0 then
+        redis.call('RPUSH', KEYS[2], user)
+    end
+end
+return moved
+"""
+
+# Appends a task to its user's queue (adding the user to the ring when the
+# queue was empty) and dispatches right away if the stream has room.
+# KEYS/ARGV as DISPATCH, plus KEYS[4] the user's queue, ARGV[6] the user
+# and ARGV[7] the task. With KEYS[5], the task's status hash is set to the
+# field/value pairs from ARGV[8] on in the same call.
+ENQUEUE = """
+if #KEYS > 4 then
+    redis.call('HSET', KEYS[5], unpack(ARGV, 8))
+end
+if redis.call('RPUSH', KEYS[4], ARGV[7]) == 1 then
+    redis.call('RPUSH', KEYS[2], ARGV[6])
+end
+redis.call('INCR', KEYS[3])
+""" + DISPATCH
+
+# Token bucket refilled at ARGV[1] tokens per second up to ARGV[2]. Returns
+# 0 when a token was taken, otherwise the seconds until one is available.
+RATE_LIMIT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local retry = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(retry)
+"""
+
+
+class FairQueue:
+    """
+    Round-robin scheduling of tasks across users in front of the tasks stream.
+
+    New tasks go to a per-user list and only FAIR_STREAM_DEPTH undelivered
+    entries are kept in the stream itself, so a user who submits many
+    questions at once gets one task dispatched per turn while other users'
+    questions are interleaved. Workers call dispatch() before every read to
+    refill the stream. The scripts name per-user keys at runtime, so this
+    needs a single Redis instance, not a cluster.
+
+    Args:
+        redis: redis.asyncio client created with decode_responses=True
+    """
+
+    def __init__(self, redis, stream='tasks', group='workers', depth=FAIR_STREAM_DEPTH):
+        self.redis = redis
+        self.stream = stream
+        self.group = group
+        self.depth = depth
+        self._enqueue = redis.register_script(ENQUEUE)
+        self._dispatch = redis.register_script(DISPATCH)
+
+    def _keys(self):
+        return [self.stream, f'{FAIR_PREFIX}:users', f'{FAIR_PREFIX}:queued']
+
+    def _args(self, count):
+        return [self.group, self.depth, f'{FAIR_PREFIX}:queue:', count, TASKS_STREAM_MAXLEN]
+
+    async def enqueue(self, user_id, task, status=None, client=None):
+        """
+        Queues the task and, if status is given, writes it to the task:{id}
+        hash in the same script call. client can be a pipeline.
+        """
+        # String values keep cjson from turning large ids into floats
+        payload = json.dumps({name: str(value) for name, value in task.items()})
+        keys = self._keys() + [f'{FAIR_PREFIX}:queue:{user_id}']
+        args = self._args(self.depth) + [user_id, payload]
+        if status:
+            keys.append(f"task:{task['task_id']}")
+            args.extend(value for pair in status.items() for value in pair)
+        await self._enqueue(keys=keys, args=args, client=client)
+
+    async def dispatch(self, count=None):
+        """
+        Returns the number of tasks moved into the stream
+        """
+        return await self._dispatch(keys=self._keys(), args=self._args(count or self.depth))
+
+
+class RateLimiter:
+    """
+    Per-user token bucket: burst questions at once, refilled at
+    per_minute questions per minute. per_minute=0 disables the limit.
+    """
+
+    def __init__(self, redis, per_minute=RATE_LIMIT_PER_MINUTE, burst=RATE_LIMIT_BURST):
+        self.redis = redis
+        self.rate = per_minute / 60
+        self.burst = burst
+        self._take = redis.register_script(RATE_LIMIT)
+
+    async def retry_after(self, user_id):
+        """
+        Returns 0 if the user may submit now, otherwise the seconds to wait
+        """
+        if self.rate <= 0:
+            return 0
+        retry = float(await self._take(keys=[f'ratelimit:{user_id}'], args=[self.rate, self.burst]))
+        return math.ceil(retry) if retry > 0 else 0
+
+
+async def backlog(redis, stream='tasks', group='workers'):
+    """
+    Tasks waiting or in progress: queued in the per-user queues, undelivered
+    in the stream (group lag) and delivered but not acked (pending)
+    """
+    queued = int(await redis.get(f'{FAIR_PREFIX}:queued') or 0)
+    try:
+        groups = await redis.xinfo_groups(stream)
+    except Exception:
+        # The stream does not exist until the first task or worker
+        return queued
+    for info in groups:
+        if info['name'] == group:
+            lag = info.get('lag')
+            if lag is None:
+                # Redis cannot compute the lag after XDEL or trimming past
+                # unread entries; count the entries after the last delivered
+                lag = len(await redis.xrange(stream, min=f"({info['last-delivered-id']}", count=ADMISSION_MAX_QUEUE))
+            return queued + lag + info['pending']
+    # Nothing has been delivered before the group exists
+    return queued + await redis.xlen(stream)
+
+
+class AdmissionControl:
+    """
+    Rejects new tasks while the backlog is above max_queue or the estimated
+    wait, backlog * task_seconds / warm worker slots, is above max_wait.
+
+    The backlog and worker capacity are refreshed from Redis every
+    refresh seconds in the background, so check() costs no round trip.
+    """
+
+    def __init__(self, redis, max_queue=ADMISSION_MAX_QUEUE, max_wait=ADMISSION_MAX_WAIT_S,
+                 task_seconds=ADMISSION_TASK_SECONDS, refresh=ADMISSION_REFRESH_S, ready_ttl=15):
+        self.redis = redis
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.task_seconds = task_seconds
+        self.refresh = refresh
+        self.ready_ttl = ready_ttl
+        self.backlog = 0
+        self.slots = 0
+
+    async def update(self):
+        self.backlog = await backlog(self.redis)
+        workers = await self.redis.zrangebyscore('workers:ready', time.time() - self.ready_ttl, '+inf')
+        slots = await self.redis.hmget('workers:slots', workers) if workers else []
+        self.slots = sum(int(value or 1) for value in slots)
+
+    async def run(self):
+        while True:
+            try:
+                await self.update()
+            except Exception as e:
+                print(f'Admission control refresh failed: {e}')
+            await asyncio.sleep(self.refresh)
+
+    def estimated_wait(self):
+        if not self.slots:
+            return 0.0
+        return self.backlog * self.task_seconds / self.slots
+
+    def check(self):
+        """
+        Returns 0 if a task is admitted, otherwise a Retry-After in seconds
+        """
+        wait = self.estimated_wait()
+        if self.backlog >= self.max_queue or wait > self.max_wait:
+            return max(1, min(300, math.ceil(wait - self.max_wait) if wait > self.max_wait else 30))
+        # Counted until the next refresh so a burst cannot overshoot the limits
+        self.backlog += 1
+        return 0
@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import json
+import re
+from contextlib import asynccontextmanager
+from os import getenv
+
+INFLIGHT_PREFIX = 'inflight'
+COALESCE_ENABLED = getenv('COALESCE_ENABLED', '1') == '1'
+COALESCE_LEASE_MS = int(getenv('COALESCE_LEASE_MS', '90000'))
+
+# Claims the lease for a query, or attaches the task to the current leader.
+# Done in one script so a waiter can never slip in after the leader has
+# collected its waiters. Either way the task is marked as processing, unless
+# a leader already answered it (a claimed waiter message that ran again).
+JOIN_SCRIPT = """
+local status = redis.call('HGET', KEYS[3], 'status')
+if status == 'complete' or status == 'failed' then
+    return -1
+end
+redis.call('HSET', KEYS[3], 'status', 'processing')
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[3]) then
+    return 1
+end
+redis.call('RPUSH', KEYS[2], ARGV[2])
+redis.call('PEXPIRE', KEYS[2], ARGV[3] * 2)
+return 0
+"""
+
+# Hands back every waiter and releases the lease if it is still ours
+FINISH_SCRIPT = """
+local waiters = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[2])
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+return waiters
+"""
+
+# Gives up the lease without taking the waiters, which wait for the next leader
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def normalize_query(text):
+    text = re.sub(r'\s+', ' ', text.casefold()).strip()
+    return text.strip(' ?!.')
+
+
+class SingleFlight:
+    """
+    Deduplicates identical questions that are being answered at the same time.
+
+    The first task for a normalized query becomes the leader and holds a
+    lease in Redis while it generates the answer. Identical tasks arriving
+    meanwhile are stored as waiters and receive the leader's result when it
+    finishes. If the leader dies, its lease expires and the next identical
+    task takes over together with the queued waiters.
+
+    A waiter's stream message stays unacked until the leader acks it with
+    its own, so a worker that claims it after a crash (or once the waiters
+    list has expired) runs the task again: it joins afresh, leading or
+    waiting. Waiters can therefore show up twice; finish drops duplicates.
+
+    Args:
+        redis: redis.asyncio client created with decode_responses=True
+        lease_ms: lease lifetime, renewed while the leader is working
+    """
+
+    def __init__(self, redis, lease_ms=COALESCE_LEASE_MS):
+        self.redis = redis
+        self.lease_ms = lease_ms
+        self._join = redis.register_script(JOIN_SCRIPT)
+        self._finish = redis.register_script(FINISH_SCRIPT)
+        self._release = redis.register_script(RELEASE_SCRIPT)
+        self._renew = redis.register_script(RENEW_SCRIPT)
+
+    def _keys(self, text):
+        digest = hashlib.sha1(normalize_query(text).encode()).hexdigest()
+        return [f'{INFLIGHT_PREFIX}:{digest}', f'{INFLIGHT_PREFIX}:{digest}:waiters']
+
+    async def join(self, text, task, message_id):
+        """
+        Returns True if the task leads its query, False if it was attached
+        as a waiter to a task already in flight, None if it has already been
+        answered. A waiter keeps message_id, the id of its unacked stream
+        message, for the leader to ack.
+        """
+        leader = await self._join(
+            keys=self._keys(text) + [f"task:{task['task_id']}"],
+            args=[task['task_id'], json.dumps({**task, 'message_id': message_id}), self.lease_ms]
+        )
+        return None if leader == -1 else bool(leader)
+
+    async def finish(self, text, task_id):
+        """
+        Releases the lease and returns the tasks that waited for this answer
+        """
+        waiters = {}
+        for waiter in map(json.loads, await self._finish(keys=self._keys(text), args=[task_id])):
+            if waiter['task_id'] != task_id:
+                waiters.setdefault(waiter['task_id'], waiter)
+        return list(waiters.values())
+
+    async def release(self, text, task_id):
+        """
+        Releases the lease but leaves the waiters queued for the next leader
+        """
+        await self._release(keys=self._keys(text)[:1], args=[task_id])
+
+    @asynccontextmanager
+    async def hold(self, text, task_id):
+        """
+        Keeps the lease alive while the leader is generating the answer
+        """
+        async def renew():
+            while True:
+                await asyncio.sleep(self.lease_ms / 3000)
+                await self._renew(keys=self._keys(text)[:1], args=[task_id, self.lease_ms])
+
+        renewer = asyncio.create_task(renew())
+        try:
+            yield
+        finally:
+            renewer.cancel()
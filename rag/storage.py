@@ -0,0 +1,151 @@
+import asyncio
+import base64
+import sys
+import time
+import zlib
+from os import getenv
+
+# Results at least this long are stored zlib-compressed under "<field>_z"
+COMPRESS_MIN_BYTES = int(getenv('RESULT_COMPRESS_MIN_BYTES', '1024'))
+# Completed and failed task:{id} hashes expire after this many seconds
+TASK_RESULT_TTL = int(getenv('TASK_RESULT_TTL', '86400'))
+# Hard cap on the tasks stream, applied on every XADD (0 disables)
+TASKS_STREAM_MAXLEN = int(getenv('TASKS_STREAM_MAXLEN', '100000'))
+STREAM_TRIM_INTERVAL_S = float(getenv('STREAM_TRIM_INTERVAL_S', '60'))
+# Pending entries older than this no longer hold back trimming. Workers
+# claim or fail stuck tasks long before (WORKER_CLAIM_IDLE_MS, WORKER_MAX_CLAIMS).
+STREAM_TRIM_MAX_PENDING_S = float(getenv('STREAM_TRIM_MAX_PENDING_S', '3600'))
+
+
+def pack_text(field, text, min_bytes=COMPRESS_MIN_BYTES):
+    """
+    Returns the hash or stream fields that store text: {field: text}, or
+    {field_z: base64 zlib data} when text is at least min_bytes long.
+    Clients use decode_responses=True, hence base64 instead of raw bytes.
+    """
+    raw = text.encode('utf-8')
+    if len(raw) < min_bytes:
+        return {field: text}
+    return {f'{field}_z': base64.b64encode(zlib.compress(raw, 6)).decode()}
+
+
+def unpack_text(fields, field):
+    """
+    Reads a text written with pack_text from a hash or stream entry
+    """
+    packed = fields.get(f'{field}_z')
+    if packed is not None:
+        return zlib.decompress(base64.b64decode(packed)).decode('utf-8')
+    return fields.get(field)
+
+
+def unpack_fields(fields, field):
+    """
+    Copy of fields with field decoded and its packed variant removed
+    """
+    unpacked = {name: value for name, value in fields.items() if name != f'{field}_z'}
+    unpacked[field] = unpack_text(fields, field)
+    return unpacked
+
+
+async def trim_acked_entries(redis, stream='tasks', group='workers', max_pending_s=STREAM_TRIM_MAX_PENDING_S,
+                             on_expired=None):
+    """
+    Removes entries the group has acked: everything older than both
+    the oldest pending entry and the group's last delivered entry. Trimming
+    only below last-delivered-id keeps XINFO's lag valid. Entries added more
+    than max_pending_s ago are trimmed even if still pending, so one entry
+    nobody acks cannot stop trimming for good.
+
+    Args:
+        on_expired: async callable given the (message_id, fields) pairs of
+            those expired pending entries before they are trimmed; it must
+            ack them. Without it they are acked as they are.
+
+    Returns:
+        Number of entries removed
+    """
+    try:
+        groups = await redis.xinfo_groups(stream)
+    except Exception:
+        return 0
+    info = next((info for info in groups if info['name'] == group), None)
+    if info is None or info['last-delivered-id'] == '0-0':
+        return 0
+
+    min_id = info['last-delivered-id']
+    if info['pending']:
+        cutoff = f'{int((time.time() - max_pending_s) * 1000)}-0'
+        await expire_pending(redis, stream, group, cutoff, on_expired)
+        oldest = await redis.xpending_range(stream, group, min=cutoff, max='+', count=1)
+        if oldest:
+            min_id = min(min_id, oldest[0]['message_id'], key=lambda entry_id: tuple(map(int, entry_id.split('-'))))
+    return await redis.xtrim(stream, minid=min_id, approximate=False)
+
+
+async def expire_pending(redis, stream, group, cutoff, on_expired, batch=100):
+    """
+    Hands the pending entries below cutoff to on_expired, or acks them
+    """
+    while True:
+        expired = await redis.xpending_range(stream, group, min='-', max=f'({cutoff}', count=batch)
+        if not expired:
+            return
+        message_ids = [entry['message_id'] for entry in expired]
+        if on_expired is None:
+            await redis.xack(stream, group, *message_ids)
+        else:
+            async with redis.pipeline(transaction=False) as pipe:
+                for message_id in message_ids:
+                    pipe.xrange(stream, min=message_id, max=message_id)
+                entries = await pipe.execute()
+            await on_expired([(message_id, entry[0][1] if entry else {})
+                              for message_id, entry in zip(message_ids, entries)])
+        if len(expired) < batch:
+            return
+
+
+async def memory_report(redis, sample_size=200):
+    """
+    Bytes Redis spends per task, from a sample of task hashes, next to what
+    the same tasks would take with their results stored uncompressed
+    """
+    report = {'tasks_stream_entries': await redis.xlen('tasks')}
+    try:
+        report['tasks_stream_bytes'] = await redis.memory_usage('tasks') or 0
+    except Exception:
+        pass
+
+    stored = plain = hashes = 0
+    async for key in redis.scan_iter(match='task:*', count=500):
+        if key.count(':') != 1:
+            continue
+        fields = await redis.hgetall(key)
+        stored += sum(len(name) + len(value.encode('utf-8')) for name, value in fields.items())
+        plain += sum(len(name) + len(value.encode('utf-8')) for name, value in unpack_fields(fields, 'result').items())
+        hashes += 1
+        if hashes >= sample_size:
+            break
+
+    if hashes:
+        report['sampled_tasks'] = hashes
+        report['payload_bytes_per_task'] = stored / hashes
+        report['uncompressed_payload_bytes_per_task'] = plain / hashes
+    return report
+
+
+async def main():
+    from rag.redis_stats import connect
+
+    redis = connect(getenv('REDIS_URL', 'redis://localhost:6379'))
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == 'trim':
+            print(f"Removed {await trim_acked_entries(redis)} acked entries")
+        for name, value in (await memory_report(redis)).items():
+            print(f"{name}: {value:.1f}" if isinstance(value, float) else f"{name}: {value}")
+    finally:
+        await redis.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
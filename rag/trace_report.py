@@ -0,0 +1,94 @@
+import argparse
+import glob
+import json
+import os
+import statistics
+from collections import defaultdict
+from rag.tracing import TRACE_DIR
+
+
+def load_traces(directory=TRACE_DIR):
+    traces = defaultdict(list)
+    for path in glob.glob(os.path.join(directory, '*.jsonl')):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    recorded = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash
+                    continue
+                traces[recorded['trace_id']].append(recorded)
+    return traces
+
+
+def trace_duration(spans):
+    return max(s['start'] + s['duration'] for s in spans) - min(s['start'] for s in spans)
+
+
+def stage_times(spans):
+    """
+    Seconds per span name within one trace
+    """
+    stages = defaultdict(float)
+    for s in spans:
+        stages[s['name']] += s['duration']
+    return stages
+
+
+def slowest_report(traces, percentile=99, limit=10):
+    """
+    Compares the stages of the traces above the percentile with all traces
+
+    Returns:
+        Dictionary with the threshold, the mean seconds per stage of all and
+        of the slowest traces, and the slowest traces' stage breakdown
+    """
+    durations = {trace_id: trace_duration(spans) for trace_id, spans in traces.items()}
+    ordered = sorted(durations, key=durations.get, reverse=True)
+    threshold = statistics.quantiles(durations.values(), n=100)[percentile - 1] if len(durations) > 1 \
+        else max(durations.values(), default=0.0)
+    slow = [trace_id for trace_id in ordered if durations[trace_id] >= threshold] or ordered[:1]
+
+    def mean_stages(trace_ids):
+        totals = defaultdict(float)
+        for trace_id in trace_ids:
+            for name, seconds in stage_times(traces[trace_id]).items():
+                totals[name] += seconds
+        return {name: seconds / len(trace_ids) for name, seconds in sorted(totals.items())}
+
+    return {
+        'traces': len(durations),
+        'threshold_s': threshold,
+        'mean_stages_all': mean_stages(ordered) if ordered else {},
+        'mean_stages_slowest': mean_stages(slow) if slow else {},
+        'slowest': [{
+            'trace_id': trace_id,
+            'duration_s': durations[trace_id],
+            'spans': sorted(({'name': s['name'], 'offset_s': s['start'] - min(x['start'] for x in traces[trace_id]),
+                              'duration_s': s['duration'], **s['attributes']} for s in traces[trace_id]),
+                            key=lambda s: s['offset_s'])
+        } for trace_id in slow[:limit]]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stage breakdown of the slowest traces")
+    parser.add_argument('--dir', default=TRACE_DIR)
+    parser.add_argument('--percentile', type=int, default=99)
+    parser.add_argument('--limit', type=int, default=5)
+    args = parser.parse_args()
+
+    report = slowest_report(load_traces(args.dir), args.percentile, args.limit)
+    print(f"{report['traces']} traces, p{args.percentile} = {report['threshold_s']:.3f}s")
+    print(f"\n{'stage':<28}{'all (s)':>10}{'slowest (s)':>14}")
+    for name in report['mean_stages_all']:
+        print(f"{name:<28}{report['mean_stages_all'][name]:>10.3f}"
+              f"{report['mean_stages_slowest'].get(name, 0.0):>14.3f}")
+    for trace in report['slowest']:
+        print(f"\nTrace {trace['trace_id']}: {trace['duration_s']:.3f}s")
+        for s in trace['spans']:
+            print(f"  +{s['offset_s']:7.3f}s {s['duration_s']:7.3f}s  {s['name']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import importlib
+import json
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import getenv
+
+# "none", "jsonl", or "package.module:factory" called with the service name
+TRACE_EXPORTER = getenv('TRACE_EXPORTER', 'none')
+TRACE_DIR = getenv('TRACE_DIR', 'data/traces')
+# Fraction of new traces that are recorded; continued traces follow the caller
+TRACE_SAMPLE_RATE = float(getenv('TRACE_SAMPLE_RATE', '1'))
+# Field and header carrying the context, in W3C traceparent format
+TRACEPARENT = 'traceparent'
+
+_current = ContextVar('trace_span', default=None)
+_exporter = None
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, sampled=True, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes or {}
+        self.start = time.time()
+        self.end = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.end - self.start,
+            'attributes': self.attributes,
+            'error': self.error
+        }
+
+
+class JsonlExporter:
+    """
+    Appends one JSON line per span to TRACE_DIR/<service>-<pid>.jsonl, so
+    processes never write to the same file
+    """
+
+    def __init__(self, service, directory=TRACE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.file = open(os.path.join(directory, f'{service}-{os.getpid()}.jsonl'), 'a', buffering=1)
+
+    def __call__(self, span):
+        self.file.write(json.dumps(span, ensure_ascii=False) + '\n')
+
+
+def create_exporter(service, name=TRACE_EXPORTER):
+    if name == 'none':
+        return None
+    if name == 'jsonl':
+        return JsonlExporter(service)
+    module, _, factory = name.partition(':')
+    return getattr(importlib.import_module(module), factory)(service)
+
+
+def set_exporter(exporter):
+    """
+    Replaces the exporter: any callable taking a span dictionary, or None
+    to stop recording
+    """
+    global _exporter
+    _exporter = exporter
+
+
+def configure(service):
+    """
+    Creates the exporter selected by TRACE_EXPORTER for service
+    """
+    set_exporter(create_exporter(service))
+
+
+def parse_traceparent(value):
+    """
+    Returns (trace_id, span_id, sampled) from a traceparent, or None
+    """
+    parts = (value or '').split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2], parts[3] == '01'
+
+
+def current_traceparent():
+    """
+    traceparent of the active span, to pass on to the next hop
+    """
+    span = _current.get()
+    return span.traceparent if span is not None else None
+
+
+def _new_span(name, parent, attributes):
+    if parent is None:
+        parent = _current.get()
+    if isinstance(parent, Span):
+        return Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+    context = parse_traceparent(parent)
+    if context is not None:
+        trace_id, parent_id, sampled = context
+        return Span(name, trace_id, parent_id, sampled, attributes)
+    return Span(name, os.urandom(16).hex(), None, random.random() < TRACE_SAMPLE_RATE, attributes)
+
+
+def _export(span):
+    if _exporter is not None and span.sampled:
+        try:
+            _exporter(span.to_dict())
+        except Exception as e:
+            print(f'Could not export span {span.name}: {e}')
+
+
+@contextmanager
+def span(name, parent=None, **attributes):
+    """
+    Times the block as a span and makes it the parent of spans started
+    inside it, including in tasks created there.
+
+    Args:
+        parent: Span or traceparent string; defaults to the active span,
+            and a new trace is started when there is none
+    """
+    current = _new_span(name, parent, attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        _current.reset(token)
+        current.end = time.time()
+        _export(current)
+
+
+def record_span(name, start, end, parent=None, **attributes):
+    """
+    Records a span that was not timed with span(), e.g. time spent in a queue
+    """
+    recorded = _new_span(name, parent, attributes)
+    recorded.start = start
+    recorded.end = end
+    _export(recorded)
@@ -1,34 +1,27 @@
 import chromadb
 import json
-import uuid
+import hashlib
 import os
-from chromadb.utils import embedding_functions
+import sys
+import time
+from pathlib import Path
+from rag.embeddings import get_embedding_function
+from rag.cache import invalidate_answer_cache
+from rag.corpus import read_corpus, tee_corpus
+from rag.chunker import chunk_document, document_sections, CHUNKER_VERSION
+from rag.numpy_index import export_index
 
 chroma_path = os.getenv('CHROMA_PATH', 'data/chroma_db')
     
 chroma_client = chromadb.PersistentClient(path=chroma_path)
-embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-    model_name="all-MiniLM-L6-v2"
-)
+embedding_function = get_embedding_function()
 collection = chroma_client.get_or_create_collection(
     name="py_docs", 
     embedding_function=embedding_function,
     metadata={'description': "Python documentation embeddings"}
 )
 
-with open('data/docs/python_docs.json', 'r', encoding='utf-8') as f:
-    documents = json.load(f)
-
-def get_chunks(text, chunk_size=500, overlap=50):
-    words = text.split()
-    chunks = []
-    
-    for i in range(0, len(words), chunk_size - overlap):
-        chunk = ' '.join(words[i:i + chunk_size])
-        if len(chunk) > 100:
-            chunks.append(chunk)
-    
-    return chunks
+manifest_path = Path(os.getenv('INDEX_MANIFEST', 'data/docs/index_manifest.json'))
 
 def test_retrieval(query: str, n_results: int = 3):
     print(f"Testing query: '{query}'")
@@ -44,40 +37,151 @@ def test_retrieval(query: str, n_results: int = 3):
         print(f"   URL: {metadata['url']}")
         print(f"   Content preview: {doc[:200]}...")
 
-def process(documents, batch_size=100):
-    all_chunks = []
-    all_metadata = []
-    all_ids = []
-    
-    print(f"Processing {len(documents)} documents...")
-    
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def document_hash(doc):
+    # Covers everything chunks and their metadata are made from, so a
+    # changed title or heading is picked up even if the text is the same
+    return content_hash(json.dumps([doc['title'], document_sections(doc)], ensure_ascii=False))
+
+def chunk_id(url, index, chunk):
+    # Same URL, position and text always give the same ID, so re-runs
+    # upsert in place instead of duplicating the corpus
+    return content_hash(f"{url}#{index}#{content_hash(chunk)}")
+
+def load_manifest():
+    if not manifest_path.exists():
+        return {'documents': {}}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_manifest(manifest):
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = manifest_path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    tmp_path.replace(manifest_path)
+
+def process(documents, batch_size=100, rebuild=False):
+    """
+    Brings the collection in line with documents. Only chunks that are not
+    indexed yet get embedded and upserted, chunks of changed documents that
+    are already indexed only get their metadata updated, and chunks that no
+    longer exist are deleted. With rebuild=True the collection is emptied
+    first.
+
+    documents can be any iterable, e.g. a generator reading the corpus or a
+    running crawl. Chunks are upserted as soon as batch_size of them are
+    pending, so only one batch of text is held in memory at a time.
+    """
+    manifest = {'documents': {}} if rebuild else load_manifest()
+    if manifest.get('chunker') != CHUNKER_VERSION:
+        # Chunks of unchanged documents differ too, so none can be skipped
+        manifest = {'documents': {}}
+    existing_ids = set(collection.get(include=[])['ids'])
+    if rebuild and existing_ids:
+        old_ids = list(existing_ids)
+        for i in range(0, len(old_ids), batch_size):
+            collection.delete(ids=old_ids[i:i + batch_size])
+        existing_ids = set()
+
+    print(f"Processing documents ({len(existing_ids)} chunks indexed)...")
+
+    indexed = {}
+    wanted_ids = set()
+    batch = {'documents': [], 'metadatas': [], 'ids': []}
+    updates = {'metadatas': [], 'ids': []}
+    upserted = 0
+    updated = 0
+    unchanged = 0
+
+    def flush():
+        nonlocal upserted, updated
+        if batch['ids']:
+            collection.upsert(**batch)
+            upserted += len(batch['ids'])
+            for values in batch.values():
+                values.clear()
+        if updates['ids']:
+            collection.update(**updates)
+            updated += len(updates['ids'])
+            for values in updates.values():
+                values.clear()
+
     for doc in documents:
-        doc_chunks = get_chunks(doc['content']) 
-        
-        for i, chunk in enumerate(doc_chunks):
-            all_chunks.append(chunk)
-            all_ids.append(str(uuid.uuid4()))
-            all_metadata.append({
-                'title': doc['title'], 
+        doc_hash = document_hash(doc)
+        previous = manifest['documents'].get(doc['url'])
+        if previous and previous['hash'] == doc_hash and existing_ids.issuperset(previous['chunk_ids']):
+            # Nothing changed since the last run, no need to chunk it again
+            indexed[doc['url']] = previous
+            wanted_ids.update(previous['chunk_ids'])
+            unchanged += 1
+            continue
+
+        doc_ids = []
+        for i, chunk in enumerate(chunk_document(doc)):
+            cid = chunk_id(doc['url'], i, chunk['text'])
+            doc_ids.append(cid)
+            if cid in wanted_ids:
+                continue
+            wanted_ids.add(cid)
+            metadata = {
+                'title': doc['title'],
                 'url': doc['url'],
-                'chunk_index': i
-            })
-    
-    print(f"Created {len(all_chunks)} chunks. Adding to database...")
-    
-    for i in range(0, len(all_chunks), batch_size):
-        batch_end = min(i + batch_size, len(all_chunks))
-        
-        collection.add(
-            documents=all_chunks[i:batch_end],
-            metadatas=all_metadata[i:batch_end],
-            ids=all_ids[i:batch_end]
-        )
+                'chunk_index': i,
+                'heading': chunk['heading'],
+                'tokens': chunk['tokens']
+            }
+            if cid in existing_ids:
+                # Same text, no need to embed it again
+                updates['ids'].append(cid)
+                updates['metadatas'].append(metadata)
+            else:
+                batch['documents'].append(chunk['text'])
+                batch['ids'].append(cid)
+                batch['metadatas'].append(metadata)
+            if len(batch['ids']) + len(updates['ids']) >= batch_size:
+                flush()
+        wanted_ids.update(doc_ids)
+        indexed[doc['url']] = {'hash': doc_hash, 'title': doc['title'], 'chunk_ids': doc_ids}
+    flush()
+
+    stale_ids = list(existing_ids - wanted_ids)
+    for i in range(0, len(stale_ids), batch_size):
+        collection.delete(ids=stale_ids[i:i + batch_size])
+
+    print(f"{len(indexed)} documents, {unchanged} unchanged, {upserted} chunks embedded, "
+          f"{updated} metadata updated, {len(stale_ids)} deleted")
+
+    save_manifest({
+        'collection': collection.name,
+        'chunker': CHUNKER_VERSION,
+        'updated': time.time(),
+        'documents': indexed
+    })
             
-    print(f"Vector database created! Total chunks: {collection.count()}")
+    print(f"Vector database updated! Total chunks: {collection.count()}")
+
+    if not upserted and not updated and not stale_ids:
+        return
+
+    try:
+        removed = invalidate_answer_cache()
+        print(f"Answer cache invalidated ({removed} keys removed)")
+    except Exception as e:
+        print(f"Could not invalidate answer cache: {e}")
 
 def main():    
-    process(documents)
+    if '--scrape' in sys.argv:
+        # Scrape, parse, chunk, embed and upsert in one pass, saving the corpus on the way
+        from rag.python_document_parser import iter_all_sections
+        documents = tee_corpus(iter_all_sections())
+    else:
+        documents = read_corpus()
+    process(documents, rebuild='--rebuild' in sys.argv)
+    if '--export-numpy' in sys.argv:
+        export_index(collection)
     
     print("Testing retrieval system")
     
@@ -0,0 +1,166 @@
+import asyncio
+import glob
+import math
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+import logging
+from os import getenv
+import redis.asyncio as aioredis
+from rag.scheduling import backlog
+from rag import metrics
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+REDIS_URL = getenv("REDIS_URL", "redis://redis:6379")
+SUPERVISOR_MIN_WORKERS = int(getenv("SUPERVISOR_MIN_WORKERS", "1"))
+SUPERVISOR_MAX_WORKERS = int(getenv("SUPERVISOR_MAX_WORKERS", "4"))
+# Backlog (undelivered plus in-flight tasks) one worker process is sized for
+SCALE_TASKS_PER_WORKER = int(getenv("SCALE_TASKS_PER_WORKER", getenv("WORKER_CONCURRENCY", "1")))
+SCALE_INTERVAL_S = float(getenv("SCALE_INTERVAL_S", "5"))
+# A lower target must hold this long before a worker is removed
+SCALE_DOWN_DELAY_S = float(getenv("SCALE_DOWN_DELAY_S", "120"))
+WORKER_DRAIN_TIMEOUT = float(getenv("WORKER_DRAIN_TIMEOUT", "120"))
+
+class Supervisor:
+    """
+    Runs between min_workers and max_workers worker.py processes and sizes
+    the pool from the backlog: tasks waiting in the per-user queues, the
+    group's lag (entries not yet delivered) and its pending entries
+    (delivered, not acked).
+
+    Scale-up is immediate. Scale-down waits until the lower target has held
+    for down_delay seconds, then stops one process at a time with SIGTERM so
+    it finishes the tasks it already read. Processes that exit on their own
+    are replaced.
+    """
+    def __init__(self, min_workers=SUPERVISOR_MIN_WORKERS, max_workers=SUPERVISOR_MAX_WORKERS,
+                 tasks_per_worker=SCALE_TASKS_PER_WORKER, interval=SCALE_INTERVAL_S,
+                 down_delay=SCALE_DOWN_DELAY_S):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.tasks_per_worker = max(tasks_per_worker, 1)
+        self.interval = interval
+        self.down_delay = down_delay
+        self.redis = None
+        self.workers = {}
+        self.draining = {}
+        self.next_index = 0
+        self.below_since = None
+        self.stopping = False
+
+    def target(self, queued):
+        wanted = math.ceil(queued / self.tasks_per_worker)
+        return max(self.min_workers, min(self.max_workers, wanted))
+
+    async def start_worker(self):
+        worker_id = f"worker-{socket.gethostname()}-{self.next_index}"
+        self.next_index += 1
+        # Own session: a Ctrl-C on the supervisor reaches workers only as SIGTERM
+        process = await asyncio.create_subprocess_exec(sys.executable, 'worker.py', worker_id,
+                                                       start_new_session=True)
+        self.workers[worker_id] = process
+        logger.info(f"Started {worker_id} (pid {process.pid})")
+
+    def stop_worker(self, worker_id):
+        process = self.workers.pop(worker_id)
+        if process.returncode is None:
+            process.send_signal(signal.SIGTERM)
+            self.draining[worker_id] = (process, time.monotonic())
+        logger.info(f"Stopping {worker_id} (pid {process.pid})")
+
+    def reap(self):
+        for worker_id, process in list(self.workers.items()):
+            if process.returncode is not None:
+                logger.warning(f"{worker_id} exited with {process.returncode}")
+                del self.workers[worker_id]
+                metrics.mark_process_dead(process.pid)
+        for worker_id, (process, since) in list(self.draining.items()):
+            if process.returncode is not None:
+                logger.info(f"{worker_id} drained and exited")
+                del self.draining[worker_id]
+                metrics.mark_process_dead(process.pid)
+            elif time.monotonic() - since > WORKER_DRAIN_TIMEOUT + 30:
+                process.kill()
+
+    async def scale(self):
+        self.reap()
+        queued = await backlog(self.redis)
+        target = self.target(queued)
+        current = len(self.workers)
+
+        if target > current:
+            logger.info(f"Backlog {queued}: scaling up from {current} to {target} workers")
+            for _ in range(target - current):
+                await self.start_worker()
+            self.below_since = None
+        elif target < current:
+            now = time.monotonic()
+            if self.below_since is None:
+                self.below_since = now
+            elif now - self.below_since >= self.down_delay:
+                logger.info(f"Backlog {queued}: scaling down from {current} to {current - 1} workers")
+                # The newest process goes first
+                self.stop_worker(list(self.workers)[-1])
+                self.below_since = now
+        else:
+            self.below_since = None
+
+    async def run(self):
+        self.redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+        try:
+            while not self.stopping:
+                try:
+                    await self.scale()
+                except Exception as e:
+                    logger.exception(f"Supervisor error: {e}")
+                await asyncio.sleep(self.interval)
+        finally:
+            await self.shutdown()
+            await self.redis.aclose()
+
+    async def shutdown(self):
+        for worker_id in list(self.workers):
+            self.stop_worker(worker_id)
+        processes = [process for process, _ in self.draining.values()]
+        if processes:
+            logger.info(f"Waiting for {len(processes)} workers to drain")
+            await asyncio.wait([asyncio.create_task(p.wait()) for p in processes],
+                               timeout=WORKER_DRAIN_TIMEOUT + 5)
+            for process in processes:
+                if process.returncode is None:
+                    process.kill()
+
+def serve_worker_metrics():
+    """
+    Makes worker processes write their metrics to files in a shared
+    directory and serves the sum on WORKER_METRICS_PORT
+    """
+    if not metrics.WORKER_METRICS_PORT:
+        return
+    directory = os.environ.get(metrics.MULTIPROC_DIR_ENV)
+    if directory:
+        # Left over from a previous run
+        for path in glob.glob(os.path.join(directory, '*.db')):
+            os.remove(path)
+    else:
+        directory = os.environ[metrics.MULTIPROC_DIR_ENV] = tempfile.mkdtemp(prefix='worker-metrics-')
+    metrics.serve_multiprocess_metrics(metrics.WORKER_METRICS_PORT)
+    logger.info(f"Serving worker metrics on :{metrics.WORKER_METRICS_PORT} from {directory}")
+
+async def main():
+    serve_worker_metrics()
+    supervisor = Supervisor()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(signum, lambda: setattr(supervisor, 'stopping', True))
+        except NotImplementedError:
+            pass
+    await supervisor.run()
+
+if __name__ == "__main__":
+    asyncio.run(main())
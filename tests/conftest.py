@@ -0,0 +1,20 @@
+import pytest
+from fakeredis.commands_mixins.scripting_mixin import ScriptingCommandsMixin
+
+
+@pytest.fixture(autouse=True)
+def xinfo_in_scripts(monkeypatch):
+    """
+    fakeredis looks up container commands such as XINFO GROUPS by their
+    full name, so redis.call('XINFO', 'GROUPS', key) in a script fails
+    there while Redis runs it. Joins the subcommand for the scheduling
+    scripts.
+    """
+    call = ScriptingCommandsMixin._lua_redis_call
+
+    def lua_redis_call(self, lua_runtime, expected_globals, op, *args):
+        if op.lower() == b'xinfo' and args:
+            return call(self, lua_runtime, expected_globals, op + b' ' + args[0], *args[1:])
+        return call(self, lua_runtime, expected_globals, op, *args)
+
+    monkeypatch.setattr(ScriptingCommandsMixin, '_lua_redis_call', lua_redis_call)
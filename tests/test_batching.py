@@ -0,0 +1,74 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from rag import rag
+from rag.batching import MicroBatcher
+
+
+def test_requests_in_one_window_share_a_batch():
+    batches = []
+
+    def run_batch(requests):
+        batches.append(list(requests))
+        return [request * 10 for request in requests]
+
+    async def run():
+        batcher = MicroBatcher(run_batch, ThreadPoolExecutor(1), window_ms=20, max_batch_size=100)
+        return await asyncio.gather(*(batcher.submit(i) for i in range(5)))
+
+    assert asyncio.run(run()) == [0, 10, 20, 30, 40]
+    assert batches == [[0, 1, 2, 3, 4]]
+
+
+def test_a_full_batch_runs_without_waiting_for_the_window():
+    batches = []
+
+    def run_batch(requests):
+        batches.append(list(requests))
+        return requests
+
+    async def run():
+        batcher = MicroBatcher(run_batch, ThreadPoolExecutor(1), window_ms=10_000, max_batch_size=4)
+        results = await asyncio.wait_for(asyncio.gather(*(batcher.submit(i, size=2) for i in range(4))), 5)
+        return results, batcher.stats()
+
+    results, stats = asyncio.run(run())
+    assert results == [0, 1, 2, 3]
+    assert batches == [[0, 1], [2, 3]]
+    assert stats['batches'] == 2 and stats['requests'] == 4 and stats['units'] == 8
+
+
+def test_a_failed_batch_fails_each_of_its_requests():
+    def run_batch(requests):
+        raise RuntimeError('model unavailable')
+
+    async def run():
+        batcher = MicroBatcher(run_batch, ThreadPoolExecutor(1), window_ms=5, max_batch_size=10)
+        return await asyncio.gather(batcher.submit('a'), batcher.submit('b'), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_running_batches_are_referenced_until_done():
+    async def run():
+        batcher = MicroBatcher(lambda requests: requests, ThreadPoolExecutor(1), window_ms=5, max_batch_size=1)
+        submitted = asyncio.ensure_future(batcher.submit('a'))
+        await asyncio.sleep(0)
+        assert len(batcher.running) == 1
+        assert await submitted == 'a'
+        await asyncio.sleep(0)
+        assert not batcher.running
+
+    asyncio.run(run())
+
+
+def test_retrieval_requests_get_their_own_number_of_results(monkeypatch):
+    calls = []
+
+    def retrieve_batch(queries, n_top_results):
+        calls.append((queries, n_top_results))
+        return [[f'{query}-{i}' for i in range(n_top_results)] for query in queries]
+
+    monkeypatch.setattr(rag, 'retrieve_batch', retrieve_batch)
+    assert rag.retrieve_requests([('a', 1), ('b', 3)]) == [['a-0'], ['b-0', 'b-1', 'b-2']]
+    assert calls == [(['a', 'b'], 3)]
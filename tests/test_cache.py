@@ -0,0 +1,132 @@
+import asyncio
+import fakeredis.aioredis
+import numpy as np
+from rag.cache import AnswerCache, CACHE_PREFIX
+
+VECTORS = {query: np.eye(8, dtype=np.float32)[i] for i, query in enumerate('abcdefgh')}
+
+
+def embed(queries):
+    return [VECTORS[query] for query in queries]
+
+
+def stored_ids(redis):
+    return redis.hkeys(f'{CACHE_PREFIX}:0:vectors')
+
+
+def test_mirror_follows_other_processes_through_the_log():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        writer = AnswerCache(redis, embed, max_entries=3)
+        reader = AnswerCache(redis, embed, max_entries=3)
+        reloads = []
+        reload = reader._reload
+
+        async def counted_reload(generation):
+            reloads.append(generation)
+            await reload(generation)
+
+        reader._reload = counted_reload
+
+        await writer.store('a', 'A')
+        assert await reader.lookup('a') == 'A'
+        for query in 'bcde':
+            await writer.store(query, query.upper())
+            await reader.lookup('h')
+            assert sorted(reader._ids) == sorted(await stored_ids(redis))
+        assert await reader.lookup('e') == 'E'
+        # Only the first sync loads everything
+        assert len(reloads) == 1
+
+    asyncio.run(run())
+
+
+def test_mirror_reloads_after_falling_behind_the_trimmed_log():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        writer = AnswerCache(redis, embed, max_entries=3)
+        reader = AnswerCache(redis, embed, max_entries=3)
+        await writer.store('a', 'A')
+        assert await reader.lookup('a') == 'A'
+
+        for query in 'bcdef':
+            await writer.store(query, query.upper())
+        await redis.xtrim(f'{CACHE_PREFIX}:0:log', maxlen=1)
+
+        assert await reader.lookup('f') == 'F'
+        assert sorted(reader._ids) == sorted(await stored_ids(redis))
+
+    asyncio.run(run())
+
+
+def test_mirror_reloads_on_a_new_generation():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        cache = AnswerCache(redis, embed)
+        await cache.store('a', 'A')
+        assert await cache.lookup('a') == 'A'
+
+        await redis.incr(f'{CACHE_PREFIX}:generation')
+        assert await cache.lookup('a') is None
+        assert cache._ids == []
+
+    asyncio.run(run())
+
+
+def test_lookup_many_matches_a_batch():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        cache = AnswerCache(redis, embed, policy='lfu')
+        await cache.store('a', 'A')
+        await cache.store('b', 'B')
+
+        assert await cache.lookup_many(['a', 'c', 'b', 'a']) == ['A', None, 'B', 'A']
+        uses = dict(await redis.zrange(f'{CACHE_PREFIX}:0:frequency', 0, -1, withscores=True))
+        assert sorted(uses.values()) == [2.0, 3.0]
+
+    asyncio.run(run())
+
+
+def test_lookup_drops_expired_entries():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        cache = AnswerCache(redis, embed)
+        await cache.store('a', 'A')
+        await cache.lookup('a')
+        await redis.delete(f'{CACHE_PREFIX}:0:entry:{cache._ids[0]}')
+
+        assert await cache.lookup('a') is None
+        assert await stored_ids(redis) == []
+
+    asyncio.run(run())
+
+
+def test_lfu_keeps_new_entries():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        cache = AnswerCache(redis, embed, max_entries=2, policy='lfu')
+        await cache.store('a', 'A')
+        await cache.store('b', 'B')
+        for _ in range(3):
+            await cache.lookup('a')
+
+        await cache.store('c', 'C')
+        assert await cache.lookup('c') == 'C'
+        assert await cache.lookup('a') == 'A'
+        assert await cache.lookup('b') is None
+
+    asyncio.run(run())
+
+
+def test_lru_evicts_the_least_recently_used():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        cache = AnswerCache(redis, embed, max_entries=2, policy='lru')
+        await cache.store('a', 'A')
+        await cache.store('b', 'B')
+        await cache.lookup('a')
+
+        await cache.store('c', 'C')
+        assert await cache.lookup_many(['a', 'b', 'c']) == ['A', None, 'C']
+
+    asyncio.run(run())
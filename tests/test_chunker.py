@@ -0,0 +1,90 @@
+import re
+import pytest
+from rag import chunker
+
+PIECE = re.compile(r'\w+|[^\w\s]')
+
+
+class WordTokenizer:
+    """
+    Stand-in for the model's tokenizer: every word and punctuation mark is
+    one word piece
+    """
+
+    def __call__(self, text, add_special_tokens=False, return_offsets_mapping=False, verbose=False):
+        spans = [match.span() for match in PIECE.finditer(text)]
+        encoding = {'input_ids': list(range(len(spans)))}
+        if return_offsets_mapping:
+            encoding['offset_mapping'] = spans
+        return encoding
+
+
+@pytest.fixture(autouse=True)
+def word_tokenizer(monkeypatch):
+    monkeypatch.setattr(chunker, 'tokenizer', WordTokenizer())
+    monkeypatch.setattr(chunker, 'chunk_min_chars', 1)
+
+
+def sentence(words, end='.'):
+    return ' '.join(f'w{i}' for i in range(words)) + end
+
+
+def test_short_block_is_kept_whole():
+    block = {'type': 'p', 'text': 'A short paragraph.'}
+    assert chunker.split_block(block, 10) == [('A short paragraph.', 4)]
+
+
+def test_prose_is_split_at_sentence_ends():
+    text = ' '.join([sentence(3), sentence(4), sentence(5)])
+    pieces = chunker.split_block({'type': 'p', 'text': text}, 10)
+    assert pieces == [(f'{sentence(3)} {sentence(4)}', 9), (sentence(5), 6)]
+
+
+def test_code_is_split_at_line_breaks_and_keeps_them():
+    text = 'def f(x):\n    return x\n\nprint(f(1))'
+    pieces = chunker.split_block({'type': 'pre', 'text': text}, 8)
+    assert pieces == [('def f(x):\n    return x', 8), ('print(f(1))', 7)]
+
+
+def test_long_sentence_falls_back_to_word_boundaries():
+    text = sentence(25)
+    pieces = chunker.split_block({'type': 'p', 'text': text}, 10)
+    assert [tokens for _, tokens in pieces] == [10, 10, 6]
+    assert ' '.join(piece for piece, _ in pieces) == text
+
+
+def test_word_longer_than_the_budget_is_cut():
+    text = '-' * 12
+    assert chunker.split_block({'type': 'p', 'text': text}, 5) == [('-----', 5), ('-----', 5), ('--', 2)]
+
+
+def test_piece_token_counts_match_the_tokenizer():
+    text = ' '.join(sentence(n, end) for n, end in zip(range(1, 30), '.!?' * 10))
+    for piece, tokens in chunker.split_block({'type': 'p', 'text': text}, 12):
+        assert tokens <= 12
+        assert chunker.count_tokens(piece) == tokens
+
+
+def test_chunks_stay_within_sections_and_the_budget():
+    doc = {'sections': [
+        {'heading': 'One', 'blocks': [{'type': 'p', 'text': sentence(4)}, {'type': 'p', 'text': sentence(4)}]},
+        {'heading': 'Two', 'blocks': [{'type': 'p', 'text': sentence(3)}]}
+    ]}
+    chunks = chunker.chunk_document(doc, max_tokens=20, overlap_tokens=0)
+    assert [(chunk['heading'], chunk['tokens']) for chunk in chunks] == [('One', 10), ('Two', 4)]
+    assert chunks[0]['text'] == f'{sentence(4)}\n\n{sentence(4)}'
+
+
+def test_short_last_block_overlaps_into_the_next_chunk():
+    blocks = [{'type': 'p', 'text': sentence(6)}, {'type': 'p', 'text': sentence(2)}, {'type': 'p', 'text': sentence(6)}]
+    chunks = chunker.chunk_document({'sections': [{'heading': '', 'blocks': blocks}]}, max_tokens=12, overlap_tokens=3)
+    assert [chunk['text'] for chunk in chunks] == [
+        f'{sentence(6)}\n\n{sentence(2)}',
+        f'{sentence(2)}\n\n{sentence(6)}'
+    ]
+
+
+def test_documents_without_sections_are_chunked_by_paragraph():
+    doc = {'content': f'{sentence(3)}\n\n{sentence(3)}'}
+    chunks = chunker.chunk_document(doc, max_tokens=4, overlap_tokens=0)
+    assert [chunk['text'] for chunk in chunks] == [sentence(3), sentence(3)]
@@ -0,0 +1,133 @@
+import asyncio
+import time
+import pytest
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError
+from aiogram.methods import SendMessage
+from outbox import Outbox, TokenBucket, split_message
+
+
+def test_short_text_is_one_message():
+    assert split_message('Hello') == ['Hello']
+    assert split_message('') == ['']
+
+
+def test_split_prefers_paragraphs_then_lines_then_sentences():
+    paragraphs = 'a' * 30 + '\n\n' + 'b' * 30
+    assert split_message(paragraphs, limit=40) == ['a' * 30 + '\n\n', 'b' * 30]
+    lines = 'a' * 30 + '\n' + 'b' * 5 + '. ' + 'c' * 30
+    assert split_message(lines, limit=40) == ['a' * 30 + '\n', 'b' * 5 + '. ' + 'c' * 30]
+    sentences = 'a' * 25 + '. ' + 'b' * 5 + ' ' + 'c' * 20
+    assert split_message(sentences, limit=40) == ['a' * 25 + '. ', 'b' * 5 + ' ' + 'c' * 20]
+
+
+def test_split_cuts_mid_word_only_without_a_separator():
+    assert split_message('x' * 25, limit=10) == ['x' * 10, 'x' * 10, 'x' * 5]
+    # A space in the first half of the part would leave too short a part
+    assert split_message('ab ' + 'x' * 20, limit=10) == ['ab ' + 'x' * 7, 'x' * 10, 'x' * 3]
+
+
+def test_split_parts_fit_and_keep_the_text():
+    text = ' '.join(f'Sentence {i} is here.' for i in range(500)) + '\n\n' + 'tail ' * 300
+    parts = split_message(text, limit=4096)
+    assert all(len(part) <= 4096 for part in parts)
+    assert ''.join(parts) == text
+
+
+def test_split_drops_whitespace_only_parts():
+    assert split_message('a' * 10 + ' ' * 20, limit=10) == ['a' * 10]
+
+
+def test_bucket_spaces_out_callers_after_the_burst(monkeypatch):
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(round(seconds, 2))
+
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+    bucket = TokenBucket(rate=10, burst=2)
+
+    async def run():
+        for _ in range(4):
+            await bucket.acquire()
+
+    asyncio.run(run())
+    assert sleeps == [0.1, 0.2]
+
+
+def test_overlapping_pauses_do_not_add_up():
+    bucket = TokenBucket(rate=1, burst=3)
+    bucket.pause(5)
+    bucket.pause(5)
+    assert bucket.tokens == pytest.approx(-5, abs=0.01)
+    bucket.pause(2)
+    assert bucket.tokens == pytest.approx(-5, abs=0.01)
+    assert not bucket.idle()
+
+
+def test_long_retry_after_is_a_global_flood():
+    async def run():
+        outbox = Outbox(chat_rate=1)
+        assert not outbox.global_flood(1, 1)
+        assert outbox.global_flood(2, 1)
+        assert outbox.global_flood(3, 10)
+
+    asyncio.run(run())
+
+
+def test_retry_after_from_the_same_chat_is_not_global():
+    async def run():
+        outbox = Outbox(chat_rate=1)
+        assert not outbox.global_flood(1, 1)
+        assert not outbox.global_flood(1, 1)
+        outbox.flood_until = time.monotonic() - 1
+        assert not outbox.global_flood(2, 1)
+
+    asyncio.run(run())
+
+
+def flood(retry_after):
+    return TelegramRetryAfter(SendMessage(chat_id=1, text='x'), 'Flood control exceeded', retry_after)
+
+
+def test_send_retries_and_pauses_the_global_bucket_on_a_global_flood(monkeypatch):
+    async def sleep(seconds):
+        pass
+
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+
+    async def run():
+        outbox = Outbox(chat_rate=1)
+        errors = [flood(30), TelegramNetworkError(SendMessage(chat_id=1, text='x'), 'timeout')]
+
+        async def request():
+            if errors:
+                raise errors.pop(0)
+            return 'sent'
+
+        result = await outbox.submit(1, request)
+        return result, outbox
+
+    result, outbox = asyncio.run(run())
+    assert result == 'sent'
+    assert outbox.retries == 2 and outbox.sent == 1 and outbox.failed == 0
+    assert outbox.global_bucket.tokens < 0
+
+
+def test_send_gives_up_after_max_retries(monkeypatch):
+    async def sleep(seconds):
+        pass
+
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+
+    async def run():
+        outbox = Outbox(max_retries=2)
+
+        async def request():
+            raise flood(1)
+
+        with pytest.raises(TelegramRetryAfter):
+            await outbox.submit(1, request)
+        return outbox
+
+    outbox = asyncio.run(run())
+    assert outbox.retries == 2 and outbox.failed == 1 and outbox.pending == 0
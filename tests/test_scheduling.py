@@ -0,0 +1,118 @@
+import asyncio
+import json
+import fakeredis.aioredis
+from rag.scheduling import FairQueue, RateLimiter, AdmissionControl, backlog, FAIR_PREFIX
+
+
+def task(user_id, n):
+    return {'task_id': f'{user_id}-{n}', 'user_id': user_id, 'text': 'question'}
+
+
+async def stream_users(redis):
+    return [fields['user_id'] for _, fields in await redis.xrange('tasks')]
+
+
+def test_dispatch_keeps_the_depth_before_the_group_exists():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        queue = FairQueue(redis, depth=4)
+        for n in range(7):
+            await queue.enqueue(1, task(1, n))
+
+        # No worker has created the group yet: nothing may skip the queues
+        assert await redis.xlen('tasks') == 0
+        assert await backlog(redis) == 7
+
+        await redis.xgroup_create('tasks', 'workers', id='0', mkstream=True)
+        assert await queue.dispatch() == 4
+        assert await redis.xlen('tasks') == 4
+        assert await backlog(redis) == 7
+
+    asyncio.run(run())
+
+
+def test_dispatch_treats_an_unknown_lag_as_full():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        await redis.xgroup_create('tasks', 'workers', id='0', mkstream=True)
+        queue = FairQueue(redis, depth=3)
+        for n in range(5):
+            await queue.enqueue(1, task(1, n))
+        # Deleting an undelivered entry makes Redis report the lag as nil
+        middle_id = (await redis.xrange('tasks'))[1][0]
+        await redis.xdel('tasks', middle_id)
+        assert (await redis.xinfo_groups('tasks'))[0]['lag'] is None
+
+        assert await queue.dispatch() == 0
+        assert await backlog(redis) == 4
+
+    asyncio.run(run())
+
+
+def test_dispatch_takes_turns_between_users():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        queue = FairQueue(redis, depth=1)
+        for n in range(3):
+            await queue.enqueue(1, task(1, n))
+        await queue.enqueue(2, task(2, 0))
+        await queue.enqueue(3, task(3, 0))
+        await redis.xgroup_create('tasks', 'workers', id='0', mkstream=True)
+
+        for _ in range(5):
+            await redis.xreadgroup('workers', 'worker', {'tasks': '>'})
+            await queue.dispatch()
+        assert await stream_users(redis) == ['1', '2', '3', '1', '1']
+        assert int(await redis.get(f'{FAIR_PREFIX}:queued')) == 0
+
+    asyncio.run(run())
+
+
+def test_enqueue_writes_the_status_and_keeps_large_ids_exact():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        await redis.xgroup_create('tasks', 'workers', id='0', mkstream=True)
+        queue = FairQueue(redis)
+        user_id = 9007199254740993
+        await queue.enqueue(user_id, task(user_id, 0), status={'status': 'queued'})
+
+        assert await redis.hget(f'task:{user_id}-0', 'status') == 'queued'
+        assert await stream_users(redis) == [str(user_id)]
+
+    asyncio.run(run())
+
+
+def test_rate_limiter_allows_a_burst_then_asks_to_wait():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        limiter = RateLimiter(redis, per_minute=6, burst=2)
+        waits = [await limiter.retry_after(1) for _ in range(3)]
+        other_user = await limiter.retry_after(2)
+        return waits, other_user
+
+    waits, other_user = asyncio.run(run())
+    assert waits[:2] == [0, 0]
+    assert 0 < waits[2] <= 10
+    assert other_user == 0
+
+
+def test_admission_control_rejects_above_the_queue_limit():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        admission = AdmissionControl(redis, max_queue=3)
+        await redis.set(f'{FAIR_PREFIX}:queued', 2)
+        await admission.update()
+        return [admission.check() for _ in range(3)]
+
+    first, second, third = asyncio.run(run())
+    assert first == 0
+    assert second > 0 and third > 0
+
+
+def test_queued_payloads_are_json():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        await FairQueue(redis).enqueue(1, task(1, 0))
+        return await redis.lrange(f'{FAIR_PREFIX}:queue:1', 0, -1)
+
+    assert [json.loads(payload)['task_id'] for payload in asyncio.run(run())] == ['1-0']
@@ -0,0 +1,45 @@
+import asyncio
+import fakeredis.aioredis
+from rag.results import results_stream
+from worker import Worker
+
+
+def test_worker_runs_up_to_its_concurrency_and_acks_each_task():
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        await redis.xgroup_create('tasks', 'workers', id='0', mkstream=True)
+        worker = Worker('worker-test')
+        worker.task_queue = redis
+        worker.concurrency = 3
+        running = 0
+        most_running = 0
+
+        async def rag(text, on_token=None):
+            nonlocal running, most_running
+            running += 1
+            most_running = max(most_running, running)
+            await asyncio.sleep(0.05)
+            running -= 1
+            return f'answer to {text}'
+
+        worker.rag = rag
+        task_ids = [f'task-{i}' for i in range(7)]
+        for task_id in task_ids:
+            await redis.hset(f'task:{task_id}', 'status', 'queued')
+            await redis.xadd('tasks', {'task_id': task_id, 'user_id': '1', 'chat_id': '1', 'text': task_id})
+
+        loop = asyncio.create_task(worker.run())
+        for _ in range(200):
+            statuses = [await redis.hget(f'task:{task_id}', 'status') for task_id in task_ids]
+            if statuses == ['complete'] * len(task_ids):
+                break
+            await asyncio.sleep(0.01)
+        worker.stopping = True
+        await asyncio.wait_for(loop, 10)
+
+        assert statuses == ['complete'] * len(task_ids)
+        assert most_running == 3
+        assert (await redis.xpending('tasks', 'workers'))['pending'] == 0
+        assert await redis.xlen(results_stream(1)) == len(task_ids)
+
+    asyncio.run(run())
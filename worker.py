@@ -1,77 +1,430 @@
 import asyncio
-import redis.asyncio as aioredis
 import sys
-import json
+import os
+import signal
+import socket
+import time
 import logging
 from os import getenv
-from rag.rag import answer
+from rag.rag import answer, warm_up, init_embedding_function, open_http_client, close_http_client
+from rag.cache import AnswerCache, CACHE_ENABLED
+from rag.singleflight import SingleFlight, COALESCE_ENABLED
+from rag.scheduling import FairQueue, FAIR_QUEUE_ENABLED
+from rag.redis_stats import connect, count_round_trips, RoundTripStats
+from rag.results import add_result, TASK_DONE_CHANNEL, FAILED_ANSWER
+from rag.storage import pack_text, trim_acked_entries, TASK_RESULT_TTL, STREAM_TRIM_INTERVAL_S
+from rag import metrics, tracing
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+TOKEN_STREAM_TTL = int(getenv("TOKEN_STREAM_TTL", "3600"))
+TOKEN_FLUSH_MS = int(getenv("TOKEN_FLUSH_MS", "100"))
+# Warm workers refresh their entry in the workers:ready sorted set this often;
+# the gateway counts entries younger than READY_TTL
+READY_HEARTBEAT_S = float(getenv("READY_HEARTBEAT_S", "5"))
+# Seconds a stopping worker waits for its in-flight tasks before exiting
+WORKER_DRAIN_TIMEOUT = float(getenv("WORKER_DRAIN_TIMEOUT", "120"))
+# Tasks left pending this long are claimed by another worker: their worker
+# crashed, was killed, gave up draining or failed to handle them. A worker
+# keeps the idle time of the tasks it is running below this.
+WORKER_CLAIM_IDLE_MS = int(getenv("WORKER_CLAIM_IDLE_MS", "300000"))
+WORKER_CLAIM_INTERVAL_S = float(getenv("WORKER_CLAIM_INTERVAL_S", "30"))
+# Claims after which a task is failed instead of being retried again
+WORKER_MAX_CLAIMS = int(getenv("WORKER_MAX_CLAIMS", "3"))
+
+class TokenStream:
+    """
+    Appends generated tokens to the task:{id}:tokens stream read by the bot
+    and the SSE endpoint. Tokens are buffered and flushed at most every
+    TOKEN_FLUSH_MS so a 500 token answer does not cost 500 XADDs.
+    """
+    def __init__(self, redis, task_id: str):
+        self.redis = redis
+        self.key = f'task:{task_id}:tokens'
+        self.buffer = []
+        self.last_flush = time.monotonic()
+
+    async def __call__(self, token: str):
+        self.buffer.append(token)
+        if (time.monotonic() - self.last_flush) * 1000 >= TOKEN_FLUSH_MS:
+            await self.flush()
+
+    async def flush(self):
+        if self.buffer:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.xadd(self.key, {'type': 'token', 'text': ''.join(self.buffer)})
+                pipe.expire(self.key, TOKEN_STREAM_TTL)
+                await pipe.execute()
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def close(self, pipe, event_type: str, text: str):
+        """
+        Adds the remaining tokens and the final event to pipe
+        """
+        if self.buffer:
+            pipe.xadd(self.key, {'type': 'token', 'text': ''.join(self.buffer)})
+            self.buffer = []
+        pipe.xadd(self.key, {'type': event_type, **pack_text('text', text)})
+        pipe.expire(self.key, TOKEN_STREAM_TTL)
+
+def read_task(task_data: dict):
+    """
+    The task as passed on to results and coalesced waiters, from its
+    stream message
+    """
+    task = {
+        'task_id': task_data['task_id'],
+        'user_id': int(task_data['user_id']),
+        'chat_id': int(task_data.get('chat_id', task_data['user_id'])),
+        'stream': task_data.get('stream') == '1'
+    }
+    if task_data.get(tracing.TRACEPARENT):
+        # Carried on to the result, also when the task is answered as a coalesced waiter
+        task[tracing.TRACEPARENT] = task_data[tracing.TRACEPARENT]
+    return task
+
+def message_ids(tasks: list, message_id: str):
+    """
+    The stream message of the leading task and those of coalesced waiters
+    """
+    return [message_id] + [task['message_id'] for task in tasks[1:] if task.get('message_id')]
+
 class Worker:
     def __init__(self, worker_id: str):
         self.task_queue = None
+        self.answer_cache = None
+        self.inflight = None
+        self.fair_queue = None
+        self.round_trip_stats = RoundTripStats('worker')
         self.worker_id = worker_id
         self.redis_url = getenv("REDIS_URL", "redis://redis:6379")
+        self.concurrency = int(getenv("WORKER_CONCURRENCY", "1"))
+        self.stopping = False
+        # XAUTOCLAIM position, so each scan continues where the last one stopped
+        self.claim_cursor = '0-0'
+
+    def stop(self):
+        """
+        Stops reading new tasks; run() returns once the tasks already read
+        are finished (see drain)
+        """
+        logger.info(f'{self.worker_id} is stopping')
+        self.stopping = True
 
     async def connect_to_queue(self):
-        self.task_queue = aioredis.from_url(self.redis_url, decode_responses=True)
+        self.task_queue = connect(self.redis_url)
+        # Caps each Ollama host across all worker processes
+        open_http_client(self.task_queue)
+        if CACHE_ENABLED:
+            self.answer_cache = AnswerCache(self.task_queue, init_embedding_function())
+        if COALESCE_ENABLED:
+            self.inflight = SingleFlight(self.task_queue)
+        if FAIR_QUEUE_ENABLED:
+            self.fair_queue = FairQueue(self.task_queue)
         try:
             await self.task_queue.xgroup_create("tasks", "workers", id="0", mkstream=True)
             logger.info("Created consumer group")
         except Exception as e:
             logger.info(f"Consumer group already exists or error: {e}")
 
-    async def rag(self, text: str):
+    async def warm_up(self):
+        """
+        Loads and exercises the embedder, the vector store and the Ollama
+        model before the worker reads its first task
+        """
+        start = time.perf_counter()
+        timings = await warm_up()
+        timings['total'] = time.perf_counter() - start
+        logger.info(f"{self.worker_id} warmed up in " + ", ".join(
+            f"{phase}={seconds:.2f}s" for phase, seconds in timings.items()))
+        return timings
+
+    async def heartbeat(self, timings: dict):
+        await self.task_queue.hset(f'workers:startup:{self.worker_id}', mapping={
+            phase: f'{seconds:.3f}' for phase, seconds in timings.items()
+        })
+        # Read by the gateway's admission control to estimate waits
+        await self.task_queue.hset('workers:slots', self.worker_id, self.concurrency)
         try:
-            return await answer(text)
-        except Exception as e:
-            logger.exception(f"{self.worker_id}: RAG error: {e}")
-            return f"Error: {str(e)}"
-    
-    async def process_task(self, task_data: dict):
+            while not self.stopping:
+                await self.task_queue.zadd('workers:ready', {self.worker_id: time.time()})
+                await asyncio.sleep(READY_HEARTBEAT_S)
+        finally:
+            await self.task_queue.zrem('workers:ready', self.worker_id)
+            await self.task_queue.hdel('workers:slots', self.worker_id)
+
+    async def trim_stream(self):
+        """
+        Periodically drops acked entries from the tasks stream
+        """
+        while not self.stopping:
+            await asyncio.sleep(STREAM_TRIM_INTERVAL_S)
+            try:
+                removed = await trim_acked_entries(self.task_queue, on_expired=self.fail_expired)
+                if removed:
+                    logger.info(f"{self.worker_id} trimmed {removed} acked entries from tasks")
+            except Exception as e:
+                logger.warning(f"{self.worker_id} could not trim tasks: {e}")
+
+    async def rag(self, text: str, on_token=None):
+        """
+        Answers text; errors are raised so the task ends as failed
+        """
+        return await answer(text, cache=self.answer_cache, on_token=on_token)
+
+    async def complete_tasks(self, tasks: list, answer: str, message_id: str, tokens: TokenStream):
+        """
+        Stores the answer for the task and its coalesced waiters, ends their
+        token streams, adds the results for the bot and acks the stream
+        entry with those of the waiters, all in one pipeline. tokens is the
+        token stream of tasks[0].
+        """
+        async with self.task_queue.pipeline(transaction=False) as pipe:
+            for task in tasks:
+                pipe.hset(f'task:{task["task_id"]}', mapping={
+                    'status': 'complete',
+                    **pack_text('result', answer)
+                })
+                pipe.expire(f'task:{task["task_id"]}', TASK_RESULT_TTL)
+                stream = tokens if task is tasks[0] else TokenStream(self.task_queue, task['task_id'])
+                stream.close(pipe, 'done', answer)
+                add_result(pipe, task, answer)
+                pipe.publish(TASK_DONE_CHANNEL, task['task_id'])
+            pipe.xack("tasks", "workers", *message_ids(tasks, message_id))
+            await pipe.execute()
+
+    async def fail_tasks(self, tasks: list, message_id: str, tokens: TokenStream):
+        """
+        Marks the tasks as failed, ends their token streams with an error
+        event and tells their users through the results stream
+        """
+        async with self.task_queue.pipeline(transaction=False) as pipe:
+            for task in tasks:
+                pipe.hset(f'task:{task["task_id"]}', 'status', 'failed')
+                pipe.expire(f'task:{task["task_id"]}', TASK_RESULT_TTL)
+                stream = tokens if task is tasks[0] else TokenStream(self.task_queue, task['task_id'])
+                stream.close(pipe, 'error', 'Task failed')
+                add_result(pipe, task, FAILED_ANSWER)
+                pipe.publish(TASK_DONE_CHANNEL, task['task_id'])
+            pipe.xack("tasks", "workers", *message_ids(tasks, message_id))
+            await pipe.execute()
+
+    async def process_task(self, message_id: str, task_data: dict):
+        """
+        Answers the task and acks its stream entry
+        """
         task_id = task_data.get('task_id')
         text = task_data.get('text', '')
-        user_id = task_data.get('user_id')
 
-        if not task_id or not user_id:
+        if not task_id or not task_data.get('user_id'):
             logger.error(f"Invalid task data: {task_data}")
+            await self.task_queue.xack("tasks", "workers", message_id)
+            metrics.TASKS_PROCESSED.labels('invalid').inc()
             return
 
-        logger.info(f'{self.worker_id} is processing {task_id}')
+        started = time.monotonic()
+        now = time.time()
+        metrics.QUEUE_WAIT.labels('stream').observe(metrics.entry_age(message_id, now))
+        enqueued = now - metrics.entry_age(message_id, now)
+        if task_data.get('queued_at'):
+            enqueued = float(task_data['queued_at'])
+            metrics.QUEUE_WAIT.labels('total').observe(now - enqueued)
 
-        await self.task_queue.hset(f'task:{task_id}', 'status', 'processing')
+        traceparent = task_data.get(tracing.TRACEPARENT)
+        tracing.record_span('worker.queue_wait', enqueued, now, parent=traceparent, task_id=task_id)
+        task = read_task(task_data)
+        with tracing.span('worker.task', parent=traceparent, task_id=task_id, worker=self.worker_id) as task_span:
+            # join also marks the task as processing
+            leads = await self.inflight.join(text, task, message_id) if self.inflight is not None else True
+            if leads is None:
+                await self.task_queue.xack("tasks", "workers", message_id)
+                task_span.set(outcome='duplicate')
+                logger.info(f'{self.worker_id}: {task_id} was already answered')
+                return
+            if not leads:
+                # The leader for this question delivers the answer to us as well
+                # and acks the message, which stays pending until then
+                metrics.TASKS_PROCESSED.labels('coalesced').inc()
+                task_span.set(outcome='coalesced')
+                logger.info(f'{self.worker_id}: {task_id} attached to an identical question in flight')
+                return
 
-        try:
-            answer = await self.rag(text)
-            await self.task_queue.hset(f'task:{task_id}', mapping={
-                'status': 'complete',
-                'result': answer
-            })
-            await self.task_queue.publish(
-                "results",
-                json.dumps({
-                    "task_id": task_id,
-                    "user_id": int(user_id),
-                    "result": answer
-                })
-            )
-            logger.info(f'{self.worker_id}: {task_id} completed')
+            logger.info(f'{self.worker_id} is processing {task_id}')
+
+            if self.inflight is None:
+                await self.task_queue.hset(f'task:{task_id}', 'status', 'processing')
+
+            waiters = []
+            tokens = TokenStream(self.task_queue, task_id)
+            try:
+                if self.inflight is None:
+                    answer = await self.rag(text, tokens)
+                else:
+                    try:
+                        async with self.inflight.hold(text, task_id):
+                            answer = await self.rag(text, tokens)
+                    except asyncio.CancelledError:
+                        # The waiters stay queued with their messages unacked, for the
+                        # next leader of this question or the workers that claim them
+                        await self.inflight.release(text, task_id)
+                        raise
+                    except Exception:
+                        waiters = await self.inflight.finish(text, task_id)
+                        raise
+                    waiters = await self.inflight.finish(text, task_id)
 
+                with tracing.span('worker.complete', tasks=1 + len(waiters)):
+                    await self.complete_tasks([task] + waiters, answer, message_id, tokens)
+                metrics.TASKS_PROCESSED.labels('complete').inc()
+                task_span.set(outcome='complete', coalesced=len(waiters))
+                metrics.TASK_SECONDS.labels('complete').observe(time.monotonic() - started)
+                logger.info(f'{self.worker_id}: {task_id} completed ({len(waiters)} coalesced)')
+
+            except Exception as e:
+                logger.exception(f'{self.worker_id}: {task_id} failed with error: {e}')
+                await self.fail_tasks([task] + waiters, message_id, tokens)
+                metrics.TASKS_PROCESSED.labels('failed').inc()
+                task_span.set(outcome='failed', error=str(e))
+                metrics.TASK_SECONDS.labels('failed').observe(time.monotonic() - started)
+
+    async def keep_claimed(self, message_id: str):
+        """
+        Resets the idle time of a message while its task runs, so a task
+        taking longer than WORKER_CLAIM_IDLE_MS is not claimed by another
+        worker. JUSTID leaves the delivery count alone.
+        """
+        while True:
+            await asyncio.sleep(WORKER_CLAIM_IDLE_MS / 3000)
+            try:
+                await self.task_queue.xclaim('tasks', 'workers', self.worker_id, 0, [message_id], justid=True)
+            except Exception as e:
+                logger.warning(f"{self.worker_id} could not refresh {message_id}: {e}")
+
+    async def reclaim(self, count: int):
+        """
+        Claims up to count messages that have been pending for
+        WORKER_CLAIM_IDLE_MS. Messages of tasks that already finished are
+        acked, and tasks claimed more than WORKER_MAX_CLAIMS times are failed.
+
+        Returns:
+            (message_id, task_data) pairs to process again
+        """
+        self.claim_cursor, claimed, *_ = await self.task_queue.xautoclaim(
+            'tasks', 'workers', self.worker_id, WORKER_CLAIM_IDLE_MS, start_id=self.claim_cursor, count=count)
+        retry = []
+        valid = []
+        for message_id, task_data in claimed:
+            if task_data and task_data.get('task_id') and task_data.get('user_id'):
+                valid.append((message_id, task_data))
+            elif task_data:
+                # process_task acks invalid tasks
+                retry.append((message_id, task_data))
+            else:
+                # Trimmed from the stream, nothing left to retry
+                await self.task_queue.xack('tasks', 'workers', message_id)
+        if not valid:
+            return retry
+
+        async with self.task_queue.pipeline(transaction=False) as pipe:
+            for _, task_data in valid:
+                pipe.hincrby(f"task:{task_data['task_id']}", 'claims', 1)
+                pipe.hget(f"task:{task_data['task_id']}", 'status')
+            replies = await pipe.execute()
+        for (message_id, task_data), claims, status in zip(valid, replies[::2], replies[1::2]):
+            task_id = task_data['task_id']
+            if status in ('complete', 'failed'):
+                await self.task_queue.xack('tasks', 'workers', message_id)
+                metrics.TASKS_RECLAIMED.labels('finished').inc()
+            elif claims > WORKER_MAX_CLAIMS:
+                logger.error(f'{self.worker_id}: {task_id} was claimed {claims} times, failing it')
+                await self.fail_tasks([read_task(task_data)], message_id, TokenStream(self.task_queue, task_id))
+                metrics.TASKS_RECLAIMED.labels('failed').inc()
+            else:
+                logger.warning(f'{self.worker_id} claimed {task_id} ({message_id}) for attempt {claims + 1}')
+                metrics.TASKS_RECLAIMED.labels('retried').inc()
+                retry.append((message_id, task_data))
+        return retry
+
+    async def fail_expired(self, entries: list):
+        """
+        Fails the tasks of entries that stayed pending for
+        STREAM_TRIM_MAX_PENDING_S before trimming drops them, so their
+        status does not stay queued or processing for good. Entries of
+        finished tasks and entries already gone are only acked.
+        """
+        valid = []
+        done = []
+        for message_id, task_data in entries:
+            if task_data.get('task_id') and task_data.get('user_id'):
+                valid.append((message_id, task_data))
+            else:
+                done.append(message_id)
+        async with self.task_queue.pipeline(transaction=False) as pipe:
+            for _, task_data in valid:
+                pipe.hget(f"task:{task_data['task_id']}", 'status')
+            statuses = await pipe.execute()
+        for (message_id, task_data), status in zip(valid, statuses):
+            if status in ('complete', 'failed'):
+                done.append(message_id)
+                continue
+            logger.error(f"{self.worker_id}: {task_data['task_id']} was pending too long, failing it")
+            await self.fail_tasks([read_task(task_data)], message_id, TokenStream(self.task_queue, task_data['task_id']))
+            metrics.TASKS_RECLAIMED.labels('expired').inc()
+        if done:
+            await self.task_queue.xack('tasks', 'workers', *done)
+
+    async def handle_message(self, message_id: str, task_data: dict):
+        round_trips = count_round_trips()
+        keeper = asyncio.create_task(self.keep_claimed(message_id))
+        try:
+            await self.process_task(message_id, task_data)
         except Exception as e:
-            logger.exception(f'{self.worker_id}: {task_id} failed with error: {e}')
-            await self.task_queue.hset(f'task:{task_id}', 'status', 'failed')
+            # Left unacked, the message stays pending and is claimed again
+            # after WORKER_CLAIM_IDLE_MS
+            logger.exception(f"{self.worker_id} failed to handle {message_id}: {e}")
+            return
+        finally:
+            keeper.cancel()
+        self.round_trip_stats.add(round_trips)
+        if self.round_trip_stats.tasks % 100 == 0:
+            logger.info(f"{self.worker_id} Redis round trips: {self.round_trip_stats.stats()}")
 
     async def run(self):
-        logger.info(f'{self.worker_id} is running')
+        logger.info(f'{self.worker_id} is running with concurrency {self.concurrency}')
+        in_flight = set()
+        next_claim = time.monotonic() + WORKER_CLAIM_INTERVAL_S
 
-        while True:
+        def start(message_id, task_data):
+            task = asyncio.create_task(self.handle_message(message_id, task_data))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+
+        while not self.stopping:
             try:
+                free_slots = self.concurrency - len(in_flight)
+                if free_slots <= 0:
+                    await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+
+                if time.monotonic() >= next_claim:
+                    claimed = await self.reclaim(free_slots)
+                    # A cursor other than 0-0 means the scan of the pending list is not finished
+                    next_claim = time.monotonic() + (WORKER_CLAIM_INTERVAL_S if self.claim_cursor == '0-0' else 0)
+                    for message_id, task_data in claimed:
+                        start(message_id, task_data)
+                    if claimed:
+                        continue
+
+                if self.fair_queue is not None:
+                    # Refills the stream from the per-user queues
+                    await self.fair_queue.dispatch(free_slots)
+
                 messages = await self.task_queue.xreadgroup(
                     groupname='workers',
                     consumername=self.worker_id,
                     streams={'tasks': '>'},
-                    count=1,
+                    count=free_slots,
                     block=5000
                 )
 
@@ -80,21 +433,62 @@ class Worker:
 
                 for stream_name, message_stream in messages:
                     for message_id, task_data in message_stream:
-                        await self.process_task(task_data)
-                        await self.task_queue.xack("tasks", "workers", message_id)
-                        
+                        start(message_id, task_data)
+
             except asyncio.CancelledError:
                 logger.info(f"{self.worker_id} was cancelled")
+                # Unacked messages stay pending in the group until another worker claims them
+                for task in in_flight:
+                    task.cancel()
                 break
             except Exception as e:
                 logger.exception(f"{self.worker_id} error in worker loop: {e}")
                 await asyncio.sleep(2)  # Wait before retrying
 
+        if self.stopping:
+            await self.drain(in_flight)
+
+    async def drain(self, in_flight: set):
+        if in_flight:
+            logger.info(f'{self.worker_id} is draining {len(in_flight)} tasks')
+            done, pending = await asyncio.wait(in_flight, timeout=WORKER_DRAIN_TIMEOUT)
+            for task in pending:
+                task.cancel()
+        # A consumer without pending messages can be removed from the group;
+        # otherwise it stays so the messages can be claimed
+        pending = await self.task_queue.xpending_range(
+            'tasks', 'workers', min='-', max='+', count=1, consumername=self.worker_id)
+        if not pending:
+            await self.task_queue.xgroup_delconsumer('tasks', 'workers', self.worker_id)
+        logger.info(f'{self.worker_id} drained')
+
 async def main():
-    worker_id = sys.argv[1] if len(sys.argv) > 1 else "worker-1"
+    # Consumer names must be unique in the group, also across replicas
+    worker_id = sys.argv[1] if len(sys.argv) > 1 else f"worker-{socket.gethostname()}-{os.getpid()}"
     worker = Worker(worker_id)
-    await worker.connect_to_queue()
-    await worker.run()
+    tracing.configure('worker')
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, worker.stop)
+    except NotImplementedError:
+        pass
+    metrics.serve_metrics(metrics.WORKER_METRICS_PORT)
+    open_http_client()
+    background = []
+    try:
+        # Warm up first so the worker only joins the group once it is fast
+        timings = await worker.warm_up()
+        await worker.connect_to_queue()
+        background.append(asyncio.create_task(worker.heartbeat(timings)))
+        background.append(asyncio.create_task(worker.trim_stream()))
+        await worker.run()
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        await close_http_client()
+        if worker.task_queue is not None:
+            await worker.task_queue.aclose()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file